@@ -0,0 +1,252 @@
+"""
+Several TV-Select accounts in one scheduler daemon.
+
+With ACCOUNTS in config.py the scheduler works for every account listed
+instead of the single tv-select/email one:
+
+    ACCOUNTS = [
+        # pass entries tv-select/alice/email and tv-select/alice/password
+        {"name": "alice"},
+        {"name": "bob", "email": "tv-select/bob/email", "password": "tv-select/bob/password"},
+    ]
+
+At CURL_HOUR:CURL_MINUTE the schedules of all the accounts are fetched
+at once over one HTTP session, each into info_progs.<name>.json, and
+merged into info_progs.json, the plan the planner and the control socket
+work from. Every account records into ~/videos_select/<name>/.
+
+A programme selected by several accounts (same channel, start and title)
+is captured once, into the directory of the first of them, for the
+longest of the durations asked; when the capture ends the recording and
+its sidecars are hard linked into the directories of the others
+(recorder.py --share-with DIR). The pre-buffer, the resource governor
+and the offloader see a single capture; the transcoder encodes it once
+and links the result for every account, and the offloader copies it
+once and links the copies on the target.
+
+    accounts.py status
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+from offload import checksum_path
+from planner import fetch_schedule
+from programme import parse_duration, programme_id
+from seek_index import index_path
+
+logger = logging.getLogger("__name__")
+
+DATA_DIR = Path.home() / ".local/share/tvselect-fr-live-stream"
+SCHEDULE_FILE = DATA_DIR / "info_progs.json"
+RECORDINGS_DIR = Path.home() / "videos_select"
+
+NAME_RE = re.compile(r"[a-zA-Z0-9_-]+")
+
+
+class Account:
+    """One TV-Select account; email and password are filled from pass."""
+
+    def __init__(self, name, email_entry=None, password_entry=None):
+        if not isinstance(name, str) or not NAME_RE.fullmatch(name):
+            raise ValueError(f"Invalid account name {name!r}")
+        self.name = name
+        self.email_entry = email_entry or f"tv-select/{name}/email"
+        self.password_entry = password_entry or f"tv-select/{name}/password"
+        self.email = None
+        self.password = None
+
+    @property
+    def schedule_file(self):
+        return DATA_DIR / f"info_progs.{self.name}.json"
+
+    @property
+    def output_dir(self):
+        return RECORDINGS_DIR / self.name
+
+
+def load_accounts(entries):
+    """Return the Account of every ACCOUNTS entry; raise ValueError on a bad one."""
+    accounts = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            raise ValueError(f"Invalid account {entry!r}")
+        account = Account(entry.get("name"), entry.get("email"), entry.get("password"))
+        if any(other.name == account.name for other in accounts):
+            raise ValueError(f"Account {account.name} is listed twice")
+        accounts.append(account)
+    return accounts
+
+
+def fetch_all(accounts, api_url):
+    """Fetch the schedule of every account; return the accounts whose fetch succeeded."""
+    if not accounts:
+        return []
+    with Session() as session:
+        adapter = HTTPAdapter(pool_maxsize=len(accounts))
+        session.mount("https://", adapter)
+        with ThreadPoolExecutor(max_workers=len(accounts)) as pool:
+            results = list(pool.map(
+                lambda account: fetch_schedule(
+                    api_url, account.email, account.password, account.schedule_file, session
+                ),
+                accounts,
+            ))
+    for account, fetched in zip(accounts, results):
+        if not fetched:
+            logger.error("Could not fetch the schedule of the account %s", account.name)
+    return [account for account, fetched in zip(accounts, results) if fetched]
+
+
+def _seconds(entry):
+    try:
+        return parse_duration(entry.get("duration"))
+    except ValueError:
+        return 0.0
+
+
+def merge(accounts, dest=SCHEDULE_FILE):
+    """
+    Merge the schedules of accounts into dest, one entry per programme
+    with the names of the accounts wanting it in "accounts"; return the
+    number of programmes and of the ones shared.
+    """
+    merged = {}
+    for account in accounts:
+        try:
+            with open(account.schedule_file, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            logger.exception("Cannot read the schedule of the account %s", account.name)
+            continue
+        if not isinstance(entries, list):
+            logger.error("The schedule of the account %s is not a list", account.name)
+            continue
+        account.output_dir.mkdir(parents=True, exist_ok=True)
+
+        for n, entry in enumerate(entries):
+            try:
+                key = programme_id(entry)
+            except (KeyError, TypeError):
+                # Left for load_programmes to report.
+                key = f"{account.name}#{n}"
+            if key not in merged:
+                merged[key] = dict(entry) if isinstance(entry, dict) else entry
+                if isinstance(entry, dict):
+                    merged[key]["accounts"] = [account.name]
+                continue
+            shared = merged[key]
+            if account.name not in shared["accounts"]:
+                shared["accounts"].append(account.name)
+            if _seconds(entry) > _seconds(shared):
+                shared["duration"] = entry["duration"]
+
+    programmes = list(merged.values())
+    tmp = Path(dest).with_name(Path(dest).name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(programmes, f, indent=4, ensure_ascii=False)
+    os.replace(tmp, dest)
+
+    shared = sum(
+        1 for entry in programmes if isinstance(entry, dict) and len(entry["accounts"]) > 1
+    )
+    logger.info(
+        "Merged the schedules of %d accounts: %d programmes, %d recorded once for several accounts",
+        len(accounts), len(programmes), shared,
+    )
+    return len(programmes), shared
+
+
+def share(path, directories):
+    """Hard link a finished recording and its sidecars into directories."""
+    path = Path(path)
+    for directory in directories:
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for source in (path, Path(index_path(path)), Path(checksum_path(path))):
+            if not source.exists():
+                continue
+            target = directory / source.name
+            try:
+                os.link(source, target)
+            except FileExistsError:
+                logger.warning("%s already exists, not shared", target)
+            except OSError:
+                # Another file system.
+                shutil.copyfile(source, target)
+        logger.info("Shared %s with %s", path.name, directory)
+
+
+def shared_links(path, recordings_dir=RECORDINGS_DIR):
+    """Return the other hard links of path share() made in the account directories."""
+    path = Path(path)
+    stat = path.stat()
+    if stat.st_nlink < 2:
+        return []
+    root = Path(recordings_dir)
+    directories = [root] + [
+        entry for entry in root.iterdir() if entry.is_dir() and not entry.name.startswith(".")
+    ]
+    links = []
+    for directory in directories:
+        other = directory / path.name
+        try:
+            if other != path and os.path.samestat(other.stat(), stat):
+                links.append(other)
+        except OSError:
+            continue
+    return links
+
+
+class ShareTap:
+    """
+    CaptureWriter tap sharing the recording with other accounts when it
+    is closed; it goes after the taps writing sidecars.
+    """
+
+    def __init__(self, path, directories):
+        self.path = path
+        self.directories = directories
+
+    def feed(self, data):
+        pass
+
+    def close(self):
+        share(self.path, self.directories)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Accounts of the scheduler.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status", help="list the programmes of the merged schedule by account")
+    parser.parse_args(argv)
+
+    try:
+        with open(SCHEDULE_FILE, "r", encoding="utf-8") as f:
+            programmes = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Cannot read {SCHEDULE_FILE}: {e}")
+        return 1
+    for entry in programmes:
+        if not isinstance(entry, dict):
+            continue
+        names = entry.get("accounts") or ["-"]
+        print(
+            f"{entry.get('start', '?')} {entry.get('channel', '?')}: {entry.get('title', '?')} "
+            f"({', '.join(names)})"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+import logging
+
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+from security_sanitizer import global_sanitizer
+
+LOGS_DIR = Path.home() / ".local/share/tvselect-fr-live-stream/logs"
+
+log_format = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+log_datefmt = "%d-%m-%Y %H:%M:%S"
+
+
+def setup_logging(log_name, max_bytes=10 * 1024 * 1024, backup_count=5):
+    """
+    Configure logging for a long-running helper the same way the launch
+    scripts do: a rotating file under the logs directory plus warnings on
+    stderr, both behind global_sanitizer.
+    """
+    log_handler = RotatingFileHandler(
+        LOGS_DIR / log_name, maxBytes=max_bytes, backupCount=backup_count
+    )
+    formatter = logging.Formatter(log_format, log_datefmt)
+    log_handler.setFormatter(formatter)
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel(logging.WARNING)
+
+    for handler in (log_handler, stream_handler):
+        handler.addFilter(global_sanitizer)
+
+    logger = logging.getLogger("__name__")
+    logger.addFilter(global_sanitizer)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format=log_format,
+        datefmt=log_datefmt,
+        handlers=[log_handler, stream_handler],
+    )
+    return logger
@@ -3,6 +3,9 @@ set -euo pipefail
 
 INSTALL_DIR="$HOME/tvselect-fr-live-stream"
 CONFIG_DIR="$HOME/.config/tvselect-fr-live-stream"
+DATA_DIR="$HOME/.local/share/tvselect-fr-live-stream"
+RELEASES_DIR="$DATA_DIR/releases"
+PYTHON="$DATA_DIR/.venv/bin/python3"
 LAST_RELEASE_FILE="$CONFIG_DIR/.last_release"
 
 REPO="tvselect/tvselect-fr-live-stream"
@@ -84,20 +87,38 @@ echo "[INFO] Signature verified successfully."
 # ----------------------------------------------------------------------
 # 7. Install new version
 # ----------------------------------------------------------------------
+# Every release gets its own directory and $INSTALL_DIR is a symlink to
+# the current one, swapped atomically by hot_upgrade.py. at jobs and
+# captures never see a missing directory, and the running scheduler and
+# recorders move to the new release without dropping their captures.
 echo "[INFO] Installing update..."
 
 EXTRACTED_DIR="$tmp_dir/tvselect-fr-live-stream-${VERSION}"
 
 unzip -q "$zip_file" -d "$tmp_dir"
 
-if [ -d "$INSTALL_DIR" ]; then
-    mv "$INSTALL_DIR" "$INSTALL_DIR.old"
+mkdir -p "$RELEASES_DIR"
+
+# The first update turns the installed directory into the first release.
+if [ -d "$INSTALL_DIR" ] && [ ! -L "$INSTALL_DIR" ]; then
+    initial_release="$RELEASES_DIR/initial-$(date +%Y%m%d%H%M%S)"
+    mv "$INSTALL_DIR" "$initial_release"
+    ln -s "$initial_release" "$INSTALL_DIR"
 fi
 
 echo "[INFO] Installing new version..."
-mv "$EXTRACTED_DIR" "$INSTALL_DIR"
-
-rm -rf "$INSTALL_DIR.old"
+rm -rf "$RELEASES_DIR/$VERSION"
+mv "$EXTRACTED_DIR" "$RELEASES_DIR/$VERSION"
+
+if [ -L "$INSTALL_DIR" ]; then
+    if ! "$PYTHON" "$RELEASES_DIR/$VERSION/hot_upgrade.py" activate "$RELEASES_DIR/$VERSION"; then
+        echo "[ERROR] The new release failed its checks, keeping the installed one."
+        rm -rf "$tmp_dir"
+        exit 1
+    fi
+else
+    ln -s "$RELEASES_DIR/$VERSION" "$INSTALL_DIR"
+fi
 
 # ----------------------------------------------------------------------
 # 8. Save installed version
@@ -0,0 +1,211 @@
+"""
+Benchmark the fetch-and-plan path on synthetic schedules.
+
+A local mock of TV-Select's /api/v1/prog serves generated schedules of
+10 to 10k programmes with a configurable channel mix. Each run drives
+the real code: planner.fetch_schedule (the body of update_info_json),
+programme.load_programmes (streamed load, validation, filenames and
+CHANNELS_URL lookup), planner.build_jobs (TF1 purge steps, scripts) and
+planner.submit_jobs
+against a fake `at` backend. Wall time and peak traced memory are
+reported per stage; times include the tracemalloc overhead, so compare
+runs with each other rather than with production.
+
+Usage: python3 bench_planner.py [--sizes 10,100,1000,10000]
+                                [--mix tf1=0.3,other=0.65,unknown=0.05]
+                                [--at-latency MS] [--seed N]
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Benchmark runs must not fill the real trace files.
+os.environ["TVSELECT_TRACE"] = "0"
+
+from channels_url import CHANNELS_URL
+from planner import build_jobs, fetch_schedule, submit_jobs
+from programme import TF1_CHANNELS, load_programmes
+
+MOCK_EMAIL = "bench@example.org"
+MOCK_PASSWORD = "bench-password"
+
+TITLE_WORDS = [
+    "Journal", "Météo", "Le grand débat", "Cinéma", "L'été", "Série", "Épisode",
+    "Documentaire", "C'est à vous", "Spécial", "N°1", "Quiz/Jeu", "Sport:", "Île",
+]
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        group, _, weight = item.partition("=")
+        mix[group.strip()] = float(weight)
+    unknown = set(mix) - {"tf1", "other", "unknown"}
+    if unknown:
+        raise ValueError(f"Unknown channel groups: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def generate_schedule(size, mix, seed=0, now=None):
+    """Return size programmes shaped like the TV-Select API answer."""
+    rng = random.Random(seed)
+    now = now or datetime.now()
+    channels = {
+        "tf1": [c for c in TF1_CHANNELS if c in CHANNELS_URL],
+        "other": [c for c in CHANNELS_URL if c not in TF1_CHANNELS],
+        "unknown": ["Chaîne inconnue", "Local TV"],
+    }
+    groups = list(mix)
+    weights = [mix[g] for g in groups]
+
+    programmes = []
+    for i in range(size):
+        group = rng.choices(groups, weights)[0]
+        start = now + timedelta(minutes=rng.randrange(2, 24 * 60))
+        title = " ".join(rng.sample(TITLE_WORDS, rng.randint(1, 4))) + f" {i}"
+        programmes.append({
+            "channel": rng.choice(channels[group]),
+            "title": title,
+            "start": start.strftime("%H:%M"),
+            "duration": str(rng.choice([900, 1800, 3600, 5400, 7200])),
+        })
+    return programmes
+
+
+class MockApiHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/api/v1/prog":
+            self.send_error(404)
+            return
+        expected = base64.b64encode(f"{MOCK_EMAIL}:{MOCK_PASSWORD}".encode()).decode()
+        if self.headers.get("Authorization") != f"Basic {expected}":
+            self.send_error(401)
+            return
+        body = self.server.body
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mock_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockApiHandler)
+    server.body = b"[]"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class FakeAtBackend:
+    """Stand-in for AtBackend: records the steps, optionally slept like `at`."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.steps = 0
+        self._lock = threading.Lock()
+
+    def submit(self, step):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.steps += 1
+        return 0, b"job 1 at Thu Jan  1 00:00:00 2026\n"
+
+
+def measure(stage, results, func, *args, **kwargs):
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    value = func(*args, **kwargs)
+    results[stage] = (time.perf_counter() - start, tracemalloc.get_traced_memory()[1] - base)
+    return value
+
+
+def run(size, mix, at_latency, seed, server, workdir):
+    server.body = json.dumps(generate_schedule(size, mix, seed), ensure_ascii=False).encode()
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/v1/prog"
+    dest = os.path.join(workdir, "info_progs.json")
+    backend = FakeAtBackend(at_latency)
+    results = {}
+
+    tracemalloc.start()
+    try:
+        if not measure("fetch", results, fetch_schedule, url, MOCK_EMAIL, MOCK_PASSWORD, dest):
+            raise RuntimeError("fetch from the mock API failed")
+        programmes, _ = measure("load", results, load_programmes, dest, CHANNELS_URL)
+        jobs = measure(
+            "build", results, build_jobs,
+            programmes, lambda channel: True, {"PATH": "/usr/bin:/bin"}, {},
+        )
+        measure("submit", results, submit_jobs, jobs, None, backend=backend)
+    finally:
+        tracemalloc.stop()
+    return results, len(jobs), backend.steps
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the fetch-and-plan path.")
+    parser.add_argument("--sizes", default="10,100,1000,10000")
+    parser.add_argument("--mix", default="tf1=0.3,other=0.65,unknown=0.05",
+                        help="weights of TF1-group, other and unknown channels")
+    parser.add_argument("--at-latency", type=float, default=0.0,
+                        help="simulated duration of one `at` call, in ms")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="show the planner logs")
+    args = parser.parse_args(argv)
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    if not args.verbose:
+        logging.getLogger("__name__").setLevel(logging.CRITICAL)
+
+    server = start_mock_api()
+    stages = ("fetch", "load", "build", "submit")
+    print(f"{'programmes':>10} {'jobs':>6} {'steps':>6} "
+          + " ".join(f"{s + ' ms':>10} {s + ' KiB':>11}" for s in stages)
+          + f" {'total ms':>9}")
+    try:
+        with tempfile.TemporaryDirectory(prefix="bench_planner_") as workdir:
+            for size in sizes:
+                results, jobs, steps = run(
+                    size, mix, args.at_latency / 1000, args.seed, server, workdir
+                )
+                total = sum(t for t, _ in results.values())
+                print(
+                    f"{size:>10} {jobs:>6} {steps:>6} "
+                    + " ".join(
+                        f"{results[s][0] * 1000:>10.1f} {results[s][1] / 1024:>11.0f}"
+                        for s in stages
+                    )
+                    + f" {total * 1000:>9.1f}"
+                )
+    finally:
+        server.shutdown()
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"peak RSS of the process: {peak_rss / 1024:.1f} MiB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""
+Benchmark the chunked transcode against the number of chunks.
+
+The same recording is transcoded by transcode.Transcoder cut into 1, 2,
+4, ... chunks, with as many ffmpeg workers as CPUs (or --workers). Wall
+time, speed-up over a single chunk and the size of the result are
+printed for each run. Without --input a test recording of --duration
+seconds is generated with ffmpeg first.
+
+Usage: python3 bench_transcode.py [--input PATH] [--duration S] [--chunks 1,2,4,8] [--workers N]
+"""
+import argparse
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+from seek_index import index_path
+from transcode import DEFAULT_ARGS, DEFAULT_FORMAT, MUXERS, Transcoder
+
+
+def generate(path, duration):
+    # A 720p stream with a keyframe every two seconds, like a broadcast.
+    subprocess.run(
+        [
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+            "-f", "lavfi", "-i", "testsrc2=size=1280x720:rate=25",
+            "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000",
+            "-t", str(duration),
+            "-c:v", "libx264", "-preset", "ultrafast", "-g", "50",
+            "-c:a", "aac", "-f", "mpegts", str(path),
+        ],
+        check=True,
+    )
+
+
+def run(source, chunks, workers, ffmpeg_args, fmt):
+    transcoder = Transcoder(
+        ffmpeg_args, fmt, workers, chunks, capture_workers=workers, min_chunk=1
+    )
+    start = time.monotonic()
+    dest = transcoder.transcode(source)
+    elapsed = time.monotonic() - start
+    size = dest.stat().st_size
+    dest.unlink()
+    Path(str(dest) + ".sha256").unlink(missing_ok=True)
+    return elapsed, size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the chunked transcode.")
+    parser.add_argument("--input", type=Path, help="recording to transcode")
+    parser.add_argument("--duration", type=int, default=120, help="seconds of test recording")
+    parser.add_argument("--chunks", default="1,2,4,8,16", help="chunk counts to try")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--ffmpeg-args", type=shlex.split, default=DEFAULT_ARGS)
+    parser.add_argument("--format", choices=sorted(MUXERS), default=DEFAULT_FORMAT)
+    args = parser.parse_args(argv)
+
+    if shutil.which("ffmpeg") is None:
+        print("ffmpeg is not installed", file=sys.stderr)
+        return 1
+    try:
+        counts = [int(n) for n in args.chunks.split(",")]
+    except ValueError:
+        parser.error("--chunks is a comma separated list of numbers")
+
+    directory = Path(tempfile.mkdtemp(prefix="bench_transcode_"))
+    try:
+        source = directory / "bench.ts"
+        if args.input:
+            source.symlink_to(args.input.resolve())
+            if os.path.exists(index_path(args.input)):
+                Path(index_path(source)).symlink_to(Path(index_path(args.input)).resolve())
+        else:
+            generate(source, args.duration)
+        print(f"{source.stat().st_size / 1e6:.1f} MB in, {args.workers} workers")
+
+        print(f"{'chunks':>6} {'wall s':>8} {'speed-up':>8} {'MB out':>8}")
+        baseline = None
+        for count in counts:
+            elapsed, size = run(source, count, args.workers, args.ffmpeg_args, args.format)
+            baseline = baseline or elapsed
+            print(f"{count:>6} {elapsed:>8.1f} {baseline / elapsed:>8.2f} {size / 1e6:>8.1f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""
+Benchmark the recording write path against streamlink's own writes.
+
+For 1 to N concurrent writers (one process each, like concurrent
+captures) every writer pushes the same amount of stream data to its own
+file, either with small buffered writes as `streamlink -o` does or
+through recorder.CaptureWriter. Throughput, write stalls and the number
+of extents of the resulting files (when filefrag is available) are
+printed for each run.
+
+Usage: python3 bench_writer.py [--dir DIR] [--size MB] [--writers N] [--rate KBPS]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from multiprocessing import Pool
+from pathlib import Path
+
+from recorder import BLOCK_SIZE, FSYNC_INTERVAL, CaptureWriter
+
+STREAMLINK_CHUNK = 8192
+READ_SIZE = 64 * 1024
+
+
+def _payload(size):
+    # Incompressible enough that no filesystem can cheat.
+    return os.urandom(size)
+
+
+def _write_streamlink(path, total, rate_bytes, _options):
+    data = _payload(STREAMLINK_CHUNK)
+    latencies = []
+    start = time.monotonic()
+    with open(path, "wb") as f:
+        for n in range(total // STREAMLINK_CHUNK):
+            t = time.monotonic()
+            f.write(data)
+            latencies.append(time.monotonic() - t)
+            _pace(start, (n + 1) * STREAMLINK_CHUNK, rate_bytes)
+    return latencies
+
+
+def _write_capture(path, total, rate_bytes, options):
+    data = _payload(READ_SIZE)
+    latencies = []
+    start = time.monotonic()
+    writer = CaptureWriter(
+        path,
+        expected_size=total,
+        block_size=options["block_size"],
+        fsync_interval=options["fsync_interval"],
+    )
+    try:
+        for n in range(total // READ_SIZE):
+            t = time.monotonic()
+            writer.write(data)
+            latencies.append(time.monotonic() - t)
+            _pace(start, (n + 1) * READ_SIZE, rate_bytes)
+    finally:
+        writer.close()
+    return latencies
+
+
+def _pace(start, written, rate_bytes):
+    if rate_bytes:
+        delay = start + written / rate_bytes - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+WRITERS = {"streamlink": _write_streamlink, "capture": _write_capture}
+
+
+def _run_one(args):
+    mode, path, total, rate_bytes, options = args
+    return WRITERS[mode](path, total, rate_bytes, options)
+
+
+def count_extents(path):
+    if shutil.which("filefrag") is None:
+        return None
+    result = subprocess.run(["filefrag", path], capture_output=True, text=True)
+    try:
+        return int(result.stdout.rsplit(":", 1)[1].split()[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def run(mode, writers, directory, total, rate_bytes, options):
+    paths = [os.path.join(directory, f"{mode}_{writers}_{i}.ts") for i in range(writers)]
+    start = time.monotonic()
+    with Pool(writers) as pool:
+        results = pool.map(_run_one, [(mode, p, total, rate_bytes, options) for p in paths])
+    subprocess.run(["sync"], check=False)
+    elapsed = time.monotonic() - start
+
+    latencies = sorted(x for r in results for x in r)
+    extents = [count_extents(p) for p in paths]
+    for p in paths:
+        os.unlink(p)
+    return {
+        "mode": mode,
+        "writers": writers,
+        "throughput": writers * total / elapsed / (1024 * 1024),
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0.0,
+        "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+        "extents": statistics.mean(extents) if None not in extents else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the recording write path.")
+    parser.add_argument("--dir", default=str(Path.home() / "videos_select"),
+                        help="directory on the disk to test")
+    parser.add_argument("--size", type=int, default=256, help="MB written per writer")
+    parser.add_argument("--writers", type=int, default=6, help="maximum concurrent writers")
+    parser.add_argument("--rate", type=int, default=0, help="kbps per writer, 0 for unpaced")
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE // 1024, help="KiB")
+    parser.add_argument("--fsync-interval", type=float, default=FSYNC_INTERVAL)
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.dir, exist_ok=True)
+    directory = tempfile.mkdtemp(prefix="bench_writer_", dir=args.dir)
+    total = args.size * 1024 * 1024
+    rate_bytes = args.rate * 1000 // 8
+    options = {"block_size": args.block_size * 1024, "fsync_interval": args.fsync_interval}
+
+    print(f"{'mode':<11} {'writers':>7} {'MB/s':>8} {'p99 ms':>8} {'max ms':>8} {'extents':>8}")
+    try:
+        for writers in range(1, args.writers + 1):
+            for mode in WRITERS:
+                r = run(mode, writers, directory, total, rate_bytes, options)
+                extents = f"{r['extents']:.0f}" if r["extents"] is not None else "-"
+                print(
+                    f"{r['mode']:<11} {r['writers']:>7} {r['throughput']:>8.1f} "
+                    f"{r['p99_ms']:>8.2f} {r['max_ms']:>8.2f} {extents:>8}"
+                )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+"""
+Bounded buffer between the network read and the disk write of a capture.
+
+recorder.py reads the stream into a CaptureBuffer and a writer thread
+moves it to disk. When the disk stalls for a moment (an fsync, wear
+levelling on an SD card) the reads go on into the free room of the
+buffer instead of leaving streamlink blocked on a full pipe, which loses
+the live edge of the HLS playlist. The reader only waits when the buffer
+is full: that backpressure is counted, with the fill high-water mark, in
+the capture timing.
+
+The buffer is allocated once per capture. Its size is the stream rate
+times the worst block write latency seen on the disk of the recordings
+by the last captures, kept in write_latency.json, with headroom:
+
+    capture_buffer.py status [--bitrate KBPS]
+"""
+import argparse
+import fcntl
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from pathlib import Path
+
+logger = logging.getLogger("__name__")
+
+DATA_DIR = Path.home() / ".local/share/tvselect-fr-live-stream"
+LATENCY_FILE = DATA_DIR / "write_latency.json"
+RECORDINGS_DIR = Path.home() / "videos_select"
+
+MIN_SIZE = 4 * 1024 * 1024
+MAX_SIZE = 64 * 1024 * 1024
+# Assumed until a capture has measured the disk.
+DEFAULT_STALL = 2.0
+HEADROOM = 2.0
+# How fast an old worst stall is forgotten, per capture.
+DECAY = 0.9
+
+
+class CaptureBuffer:
+    """
+    Ring buffer of one producer thread reading a file descriptor and one
+    consumer thread writing the data out.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._cond = threading.Condition()
+        # Bytes produced and consumed since the start; their difference
+        # is the fill.
+        self._produced = 0
+        self._consumed = 0
+        self._closed = False
+        self._error = None
+        self.peak = 0
+        self.backpressure_wait = 0.0
+        self.backpressure_events = 0
+
+    @property
+    def used(self):
+        return self._produced - self._consumed
+
+    def open(self):
+        """Make an empty, drained buffer usable again (a new streamlink)."""
+        with self._cond:
+            self._closed = False
+            self._error = None
+
+    def read_from(self, fd, max_size):
+        """
+        Read up to max_size bytes of fd straight into the buffer and
+        return how many, 0 at the end of the stream. Waits while the
+        buffer is full; raises what made the consumer fail.
+        """
+        with self._cond:
+            if self.used == self.size and self._error is None:
+                self.backpressure_events += 1
+                start = time.monotonic()
+                while self.used == self.size and self._error is None:
+                    self._cond.wait()
+                self.backpressure_wait += time.monotonic() - start
+            if self._error is not None:
+                raise self._error
+            offset = self._produced % self.size
+            room = min(self.size - self.used, self.size - offset, max_size)
+        # Only this thread writes to the free part of the buffer.
+        count = os.readv(fd, [self._view[offset:offset + room]])
+        with self._cond:
+            self._produced += count
+            self.peak = max(self.peak, self.used)
+            self._cond.notify_all()
+        return count
+
+    def peek(self):
+        """
+        Wait for data and return a view of the next contiguous bytes, or
+        None once the buffer is closed and empty.
+        """
+        with self._cond:
+            while not self.used and not self._closed:
+                self._cond.wait()
+            if not self.used:
+                return None
+            offset = self._consumed % self.size
+            return self._view[offset:offset + min(self.used, self.size - offset)]
+
+    def consume(self, count):
+        """Give back the room of count bytes returned by peek()."""
+        with self._cond:
+            self._consumed += count
+            self._cond.notify_all()
+
+    def close(self):
+        """No more data: the consumer stops once it has everything."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def fail(self, error):
+        """The consumer failed with error; the producer raises it."""
+        with self._cond:
+            self._error = error
+            self._cond.notify_all()
+
+    def raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def drain_into(self, writer):
+        """Write everything to writer until the buffer is closed; run in a thread."""
+        try:
+            while True:
+                data = self.peek()
+                if data is None:
+                    return
+                writer.write(data)
+                self.consume(len(data))
+        except BaseException as e:
+            self.fail(e)
+
+
+def _device(directory):
+    try:
+        return str(os.stat(directory).st_dev)
+    except OSError:
+        return None
+
+
+def _read_latencies():
+    try:
+        with open(LATENCY_FILE, "r", encoding="utf-8") as f:
+            latencies = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+    return latencies if isinstance(latencies, dict) else {}
+
+
+def worst_stall(directory=RECORDINGS_DIR):
+    """Return the worst block write latency known on the disk of directory, in seconds."""
+    entry = _read_latencies().get(_device(directory))
+    if not isinstance(entry, dict):
+        return DEFAULT_STALL
+    return float(entry.get("stall", DEFAULT_STALL))
+
+
+def record_stall(directory, seconds):
+    """Fold the worst block write latency of a capture into what is known of its disk."""
+    device = _device(directory)
+    if device is None or seconds <= 0:
+        return
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    with open(DATA_DIR / "write_latency.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        latencies = _read_latencies()
+        previous = latencies.get(device)
+        stall = seconds
+        if isinstance(previous, dict):
+            stall = max(seconds, float(previous.get("stall", 0.0)) * DECAY)
+        latencies[device] = {
+            "directory": str(directory),
+            "stall": round(stall, 3),
+            "last": round(seconds, 3),
+            "updated": int(time.time()),
+        }
+        tmp = LATENCY_FILE.with_name(LATENCY_FILE.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(latencies, f, indent=4)
+        os.replace(tmp, LATENCY_FILE)
+
+
+def buffer_size(bitrate_kbps, stall, alignment=4096):
+    """Return the buffer size riding out stall seconds at bitrate_kbps."""
+    size = int(bitrate_kbps * 1000 / 8 * stall * HEADROOM)
+    size = -(-size // alignment) * alignment
+    return min(max(size, MIN_SIZE), MAX_SIZE)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Capture buffers sized from the disk write latency.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    status = sub.add_parser("status", help="show the measured stalls and the buffer sizes")
+    status.add_argument("--bitrate", type=int, default=6000, help="kbps")
+    args = parser.parse_args(argv)
+
+    latencies = _read_latencies()
+    if not latencies:
+        print(f"No write latency measured yet, buffers are sized for a {DEFAULT_STALL:.1f}s stall")
+    for device, entry in latencies.items():
+        if not isinstance(entry, dict):
+            continue
+        stall = float(entry.get("stall", DEFAULT_STALL))
+        print(
+            f"{entry.get('directory', device)}: worst stall {stall:.2f}s "
+            f"(last capture {float(entry.get('last', 0.0)):.2f}s), "
+            f"buffer {buffer_size(args.bitrate, stall) / 1024 / 1024:.0f} MiB at {args.bitrate} kbps"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,287 @@
+"""
+Journal of the captures in progress, to resume them after a crash.
+
+recorder.py keeps one small JSON entry per running capture under
+~/.local/share/tvselect-fr-live-stream/journal: the programme, the file
+being written, the bytes written so far, when the programme ends and the
+recorder arguments. The entry goes away when the capture ends normally;
+it stays behind when the recorder is killed, or stopped early by a
+signal as happens on shutdown.
+
+recover() replays the journal: every programme whose end is still ahead
+is restarted at once for the time left, into a continuation part next to
+the interrupted file (Title_Chan.part2.ts, then .part3.ts...). The
+scheduler daemon runs it when it starts; with the cron setup, install.py
+adds an @reboot crontab line running it at boot:
+
+    capture_journal.py recover
+    capture_journal.py status
+"""
+import argparse
+import fcntl
+import json
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+
+from planner import LOG_PIPE, RECORDER, VENV_ACTIVATE
+
+logger = logging.getLogger("__name__")
+
+JOURNAL_DIR = Path.home() / ".local/share/tvselect-fr-live-stream/journal"
+CANCELLED_DIR = Path.home() / ".local/share/tvselect-fr-live-stream/cancelled"
+BOOT_ID_FILE = Path("/proc/sys/kernel/random/boot_id")
+
+UPDATE_INTERVAL = 10.0
+# Not worth a new part when less than this is left of the programme.
+MIN_REMAINING = 30.0
+
+ENTRY_SUFFIX = ".json"
+
+
+def boot_id():
+    try:
+        return BOOT_ID_FILE.read_text(encoding="utf-8").strip()
+    except OSError:
+        return None
+
+
+def continuation_path(programme, part):
+    """Return the file of the given part of a recording; part 1 is the file itself."""
+    path = Path(programme)
+    if part <= 1:
+        return path
+    return path.with_name(f"{path.stem}.part{part}{path.suffix}")
+
+
+class CaptureJournal:
+    """
+    The journal entry of one capture. It is also a CaptureWriter tap, so
+    the bytes written are kept up to date at most every interval seconds.
+    """
+
+    def __init__(self, output, url, quality, streamlink_args, options, planned_end,
+                 part=1, programme=None, directory=JOURNAL_DIR, interval=UPDATE_INTERVAL):
+        self.output = str(output)
+        self.programme = str(programme or output)
+        self.part = part
+        self.url = url
+        self.quality = quality
+        self.streamlink_args = list(streamlink_args)
+        self.options = options
+        self.planned_end = planned_end
+        self.directory = Path(directory)
+        self.interval = interval
+        self.path = self.directory / (Path(self.output).name + ENTRY_SUFFIX)
+        self.bytes_written = 0
+        self.started = time.time()
+        self._last_write = 0.0
+
+    def as_dict(self):
+        return {
+            "programme": self.programme,
+            "output": self.output,
+            "part": self.part,
+            "url": self.url,
+            "quality": self.quality,
+            "streamlink_args": self.streamlink_args,
+            "options": self.options,
+            "planned_end": self.planned_end,
+            "started": self.started,
+            "bytes_written": self.bytes_written,
+            "updated": time.time(),
+            "pid": os.getpid(),
+            "boot_id": boot_id(),
+        }
+
+    def write(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.as_dict(), f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._last_write = time.monotonic()
+
+    def feed(self, data):
+        self.bytes_written += len(data)
+        if time.monotonic() - self._last_write >= self.interval:
+            self.write()
+
+    def close(self):
+        self.write()
+
+    def remove(self):
+        self.path.unlink(missing_ok=True)
+
+
+def load_entries(directory=JOURNAL_DIR):
+    entries = []
+    for path in sorted(Path(directory).glob("*" + ENTRY_SUFFIX)):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            logger.warning("Unreadable capture journal entry %s, removed", path.name)
+            path.unlink(missing_ok=True)
+            continue
+        entry["path"] = path
+        entries.append(entry)
+    return entries
+
+
+def is_running(entry):
+    """Return True if the recorder that wrote entry is still alive."""
+    if entry.get("boot_id") != boot_id():
+        return False
+    try:
+        with open(f"/proc/{entry['pid']}/cmdline", "rb") as f:
+            return b"recorder.py" in f.read()
+    except OSError:
+        return False
+
+
+def recorder_args(entry, output, duration, part):
+    """Return the recorder.py arguments resuming entry into output."""
+    args = ["--duration", str(int(duration)), "--output", str(output),
+            "--part", str(part), "--continues", entry["programme"]]
+    for name, value in entry["options"].items():
+        flag = "--" + name.replace("_", "-")
+        if value is True:
+            args.append(flag)
+        elif isinstance(value, list):
+            for item in value:
+                args += [flag, str(item)]
+        elif value not in (None, False):
+            args += [flag, str(value)]
+    return args + [entry["url"], entry["quality"], *entry["streamlink_args"]]
+
+
+def launch(args, log_name, env):
+    """Start recorder.py with args like an at job would, detached from us."""
+    script = (
+        VENV_ACTIVATE +
+        f"&& python3 {RECORDER} {shlex.join(args)} "
+        f"2>&1 | python3 {LOG_PIPE} {shlex.quote(log_name)}"
+    )
+    return subprocess.Popen(
+        ["/bin/sh", "-c", script],
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def _release_preallocation(path):
+    # The interrupted recorder never truncated its file, so the space
+    # preallocated past the end is still reserved.
+    try:
+        os.truncate(path, os.path.getsize(path))
+    except OSError:
+        pass
+
+
+def recover(env=None, now=None, directory=JOURNAL_DIR, launcher=launch):
+    """
+    Resume the interrupted captures of the journal; return the outputs of
+    the continuation parts started.
+
+    env is the environment of the resumed recorders; TF1 captures are
+    left in the journal when it has no STREAMLINK_TF1_EMAIL.
+    """
+    env = dict(os.environ if env is None else env)
+    now = now or time.time()
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    started = []
+
+    with open(directory / ".recover.lock", "w") as lock:
+        # Two recoveries at once would resume everything twice.
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        for entry in load_entries(directory):
+            if is_running(entry):
+                continue
+
+            name = Path(entry["programme"]).name
+            remaining = entry["planned_end"] - now
+            _release_preallocation(entry["output"])
+
+            if (CANCELLED_DIR / name).exists():
+                logger.info("Not resuming %s, it was cancelled.", name)
+                entry["path"].unlink(missing_ok=True)
+                continue
+            if remaining < MIN_REMAINING:
+                logger.warning(
+                    "Lost the end of %s: the capture was interrupted after %d bytes.",
+                    Path(entry["output"]).name,
+                    entry["bytes_written"],
+                )
+                entry["path"].unlink(missing_ok=True)
+                continue
+            if entry["options"].get("tf1") and not env.get("STREAMLINK_TF1_EMAIL"):
+                logger.error("Cannot resume %s without the TF1 credentials.", name)
+                continue
+
+            part = entry["part"] + 1
+            while continuation_path(entry["programme"], part).exists():
+                part += 1
+            output = continuation_path(entry["programme"], part)
+
+            try:
+                launcher(
+                    recorder_args(entry, output, remaining, part),
+                    f"record_{Path(entry['programme']).stem}",
+                    env,
+                )
+            except OSError:
+                logger.exception("Could not resume %s", name)
+                continue
+
+            entry["path"].unlink(missing_ok=True)
+            started.append(str(output))
+            logger.warning(
+                "Resumed %s into %s for the remaining %ds (%d bytes saved before the interruption).",
+                name,
+                output.name,
+                remaining,
+                entry["bytes_written"],
+            )
+
+    return started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Journal of the captures in progress.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("recover", help="resume the interrupted captures")
+    sub.add_parser("status", help="show the journal")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.command == "recover":
+        started = recover()
+        print(f"{len(started)} captures resumed")
+        return 0
+
+    now = time.time()
+    for entry in load_entries():
+        state = "running" if is_running(entry) else "interrupted"
+        print(
+            f"{Path(entry['output']).name}: {state}, part {entry['part']}, "
+            f"{entry['bytes_written']} bytes, ends in {entry['planned_end'] - now:.0f}s"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
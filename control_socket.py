@@ -0,0 +1,439 @@
+"""
+Local control API of the scheduler daemon.
+
+scheduler_launch.py serves a Unix socket (mode 0600) under
+~/.local/share/tvselect-fr-live-stream. Clients send one JSON object per
+line, {"command": ..., ...}, and get one JSON object per line back, with
+"ok" set to false and an "error" when the request failed:
+
+    status                          scheduler state, captures on air, programmes to come
+    watch [interval]                the status again every interval seconds
+    add channel duration [title] [start]
+                                    record now, or at start (HH:MM) through `at`
+    cancel output | title channel   cancel a programme to come, or stop one on air
+
+Every request is served by the daemon's event loop; the blocking parts
+(reading the schedule, `at`, stopping a recorder) run in worker threads,
+so no request holds the daily scheduling up. The same commands are
+available from the shell:
+
+    control_socket.py status
+    control_socket.py watch [--interval 2]
+    control_socket.py add CHANNEL DURATION [--title T] [--start HH:MM]
+    control_socket.py cancel (--output NAME | --title T --channel C)
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from datetime import datetime
+from pathlib import Path
+
+from capture_journal import is_running, load_entries
+from channels_url import CHANNELS_URL
+from planner import AtBackend, ImmediateBackend, build_jobs, submit_jobs
+from programme import InvalidProgramme, Programme, load_programmes, output_name, parse_duration
+from recorder import CANCELLED_DIR, cancel_recording
+
+logger = logging.getLogger("__name__")
+
+DATA_DIR = Path.home() / ".local/share/tvselect-fr-live-stream"
+SCHEDULE_FILE = DATA_DIR / "info_progs.json"
+CONTROL_SOCKET = DATA_DIR / "control.sock"
+RECORDINGS_DIR = Path.home() / "videos_select"
+
+MAX_REQUEST = 64 * 1024
+WATCH_INTERVAL = 2.0
+MIN_WATCH_INTERVAL = 0.5
+STOP_TIMEOUT = 15.0
+
+
+def control_socket_path():
+    return Path(os.environ.get("TVSELECT_CONTROL_SOCKET", CONTROL_SOCKET))
+
+
+class RequestError(Exception):
+    """A request that cannot be served; the message is sent to the client."""
+
+
+class SchedulerState:
+    """What the daily loop is doing, for the status command."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.next_run = None
+        self.last_run = None
+        self.last_result = None
+        self.busy = False
+        self.upgrade_pending = False
+
+    def as_dict(self):
+        return {
+            "started": self.started,
+            "last_run": self.last_run,
+            "last_result": self.last_result,
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        """The state handed over by the scheduler process this one replaces."""
+        state = cls()
+        state.started = values.get("started", state.started)
+        state.last_run = values.get("last_run")
+        state.last_result = values.get("last_result")
+        return state
+
+
+class SchedulerControl:
+    """The commands of the control API."""
+
+    def __init__(self, state, safe_env, tf1_env, can_process_tf1, policies=None,
+                 log_file=None, schedule_file=SCHEDULE_FILE, roll_minutes=0):
+        self.state = state
+        self.safe_env = safe_env
+        self.tf1_env = tf1_env
+        self.can_process_tf1 = can_process_tf1
+        self.policies = policies
+        self.roll_minutes = roll_minutes
+        self.log_file = log_file
+        self.schedule_file = Path(schedule_file)
+        self.added = []
+        self.prebuffer = None
+
+    async def handle(self, request):
+        command = request.get("command")
+        if command == "status":
+            return await asyncio.to_thread(self.status)
+        if command == "add":
+            return await self.add(request)
+        if command == "cancel":
+            return await self.cancel(request)
+        raise RequestError(f"unknown command {command!r}")
+
+    def status(self):
+        now = time.time()
+        active = []
+        for entry in load_entries():
+            if not is_running(entry):
+                continue
+            try:
+                on_disk = os.path.getsize(entry["output"])
+            except OSError:
+                # Rolled captures write their parts, not the output itself.
+                on_disk = entry["bytes_written"]
+            length = max(entry["planned_end"] - entry["started"], 1)
+            active.append({
+                "output": Path(entry["output"]).name,
+                "part": entry["part"],
+                "pid": entry["pid"],
+                "bytes": on_disk,
+                "progress": round(min(max((now - entry["started"]) / length, 0.0), 1.0), 3),
+                "ends_in": round(entry["planned_end"] - now),
+            })
+
+        upcoming = []
+        today = datetime.now().strftime("%H:%M")
+        for programme in self._scheduled() + self.added:
+            if programme.start < today:
+                continue
+            upcoming.append({
+                "output": programme.filename,
+                "title": programme.title,
+                "channel": programme.channel,
+                "start": programme.start,
+                "duration": programme.seconds,
+                "cancelled": (CANCELLED_DIR / programme.filename).exists(),
+            })
+        upcoming.sort(key=lambda p: p["start"])
+
+        return {
+            "scheduler": {
+                "pid": os.getpid(),
+                "uptime": round(now - self.state.started),
+                "next_run": self.state.next_run,
+                "last_run": self.state.last_run,
+                "last_result": self.state.last_result,
+                "busy": self.state.busy,
+            },
+            "active": active,
+            "upcoming": upcoming,
+            "prebuffer": self.prebuffer.status() if self.prebuffer is not None else None,
+        }
+
+    def upcoming(self):
+        """The programmes still to start today, cancelled ones left out."""
+        today = datetime.now().strftime("%H:%M")
+        return [
+            programme for programme in self._scheduled() + self.added
+            if programme.start >= today and not (CANCELLED_DIR / programme.filename).exists()
+        ]
+
+    def _scheduled(self):
+        try:
+            programmes, _ = load_programmes(self.schedule_file, CHANNELS_URL)
+        except (OSError, json.JSONDecodeError):
+            return []
+        return programmes
+
+    async def add(self, request):
+        now = datetime.now()
+        current = now.strftime("%H:%M")
+        start = request.get("start") or current
+        entry = {
+            "channel": request.get("channel"),
+            # The last three characters of a title never reach the file name.
+            "title": request.get("title") or f"{request.get('channel')} {now:%d-%m %Hh%M}min",
+            "start": start,
+            "duration": request.get("duration"),
+        }
+        try:
+            programme = Programme.from_dict(entry, CHANNELS_URL)
+        except InvalidProgramme as e:
+            raise RequestError(str(e)) from None
+        if programme.start < current:
+            raise RequestError(f"{programme.start} is already past, leave --start out to record now")
+        immediate = programme.start == current
+
+        if (RECORDINGS_DIR / programme.filename).exists():
+            raise RequestError(f"{programme.filename} already exists")
+
+        jobs = build_jobs(
+            [programme], self.can_process_tf1, self.safe_env, self.tf1_env,
+            policies=self.policies, roll_minutes=self.roll_minutes,
+        )
+        if not jobs:
+            raise RequestError(f"{programme.channel} cannot be recorded without TF1 credentials")
+
+        backend = ImmediateBackend() if immediate else AtBackend()
+        try:
+            report = await asyncio.to_thread(submit_jobs, jobs, self.log_file, backend)
+        except OSError as e:
+            raise RequestError(f"cannot submit the recording: {e}") from None
+        if report.failed:
+            raise RequestError(jobs[0].output.decode(errors="replace").strip() or "submission failed")
+
+        if not immediate:
+            self.added.append(programme)
+        logger.info(
+            "Control API: %s %s on %s (%ds)",
+            "recording" if immediate else f"scheduled at {start}",
+            programme.filename,
+            programme.channel,
+            programme.seconds,
+        )
+        return {"output": programme.filename, "start": start, "immediate": immediate}
+
+    async def cancel(self, request):
+        if request.get("output"):
+            name = Path(request["output"]).name
+        elif request.get("title") and request.get("channel"):
+            name = output_name(request)
+        else:
+            raise RequestError("cancel needs an output, or a title and a channel")
+
+        if await asyncio.to_thread(self._stop, name):
+            logger.info("Control API: stopped %s", name)
+            return {"output": name, "stopped": True}
+
+        today = datetime.now().strftime("%H:%M")
+        upcoming = await asyncio.to_thread(self._scheduled)
+        if not any(p.filename == name and p.start >= today for p in upcoming + self.added):
+            raise RequestError(f"no programme to come writes {name}")
+        cancel_recording(name)
+        logger.info("Control API: cancelled %s", name)
+        return {"output": name, "stopped": False}
+
+    def _stop(self, name):
+        """Stop the running captures of name; return whether there was one."""
+        entries = [
+            entry for entry in load_entries()
+            if Path(entry["programme"]).name == name and is_running(entry)
+        ]
+        for entry in entries:
+            try:
+                os.kill(entry["pid"], signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + STOP_TIMEOUT
+        while any(is_running(entry) for entry in entries) and time.monotonic() < deadline:
+            time.sleep(0.2)
+        # A stopped capture must not be resumed by the crash recovery.
+        for entry in entries:
+            entry["path"].unlink(missing_ok=True)
+        return bool(entries)
+
+
+async def _send(writer, payload):
+    writer.write((json.dumps(payload, ensure_ascii=False) + "\n").encode())
+    await writer.drain()
+
+
+async def _serve_client(control, reader, writer):
+    try:
+        while True:
+            try:
+                line = await reader.readline()
+            except (asyncio.LimitOverrunError, ValueError):
+                await _send(writer, {"ok": False, "error": "request too long"})
+                break
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError
+            except ValueError:
+                await _send(writer, {"ok": False, "error": "requests are JSON objects"})
+                continue
+
+            if request.get("command") == "watch":
+                try:
+                    interval = max(float(request.get("interval", WATCH_INTERVAL)), MIN_WATCH_INTERVAL)
+                except (TypeError, ValueError):
+                    interval = WATCH_INTERVAL
+                while True:
+                    await _send(writer, {"ok": True, **await asyncio.to_thread(control.status)})
+                    await asyncio.sleep(interval)
+
+            try:
+                await _send(writer, {"ok": True, **await control.handle(request)})
+            except RequestError as e:
+                await _send(writer, {"ok": False, "error": str(e)})
+            except Exception:
+                logger.exception("Control API request %r failed", request.get("command"))
+                await _send(writer, {"ok": False, "error": "internal error, see the logs"})
+    except (ConnectionError, BrokenPipeError):
+        pass
+    finally:
+        writer.close()
+
+
+def _in_use(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(str(path))
+        except OSError:
+            return False
+    return True
+
+
+async def start_server(control, path=None, sock=None):
+    """
+    Serve control on the Unix socket path; return the asyncio server, or
+    None. sock is a socket already listening on path, handed over by the
+    previous scheduler process.
+    """
+    if sock is not None:
+        server = await asyncio.start_unix_server(
+            lambda reader, writer: _serve_client(control, reader, writer),
+            sock=sock,
+            limit=MAX_REQUEST,
+        )
+        logger.info("Control API still listening on %s", sock.getsockname())
+        return server
+
+    path = Path(path or control_socket_path())
+    if path.exists():
+        if _in_use(path):
+            logger.error("Another scheduler serves %s, the control API is disabled", path)
+            return None
+        path.unlink()
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    old_umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(
+            lambda reader, writer: _serve_client(control, reader, writer),
+            path=str(path),
+            limit=MAX_REQUEST,
+        )
+    finally:
+        os.umask(old_umask)
+    logger.info("Control API listening on %s", path)
+    return server
+
+
+def request(payload, path=None, timeout=30):
+    """Send one request and yield the answers (several for watch)."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(str(path or control_socket_path()))
+        client.sendall((json.dumps(payload) + "\n").encode())
+        with client.makefile("r", encoding="utf-8") as answers:
+            for line in answers:
+                yield json.loads(line)
+                if payload["command"] != "watch":
+                    return
+
+
+def _print_status(status):
+    scheduler = status["scheduler"]
+    print(f"scheduler pid {scheduler['pid']}, next run {scheduler['next_run'] or '?'}, "
+          f"last run {scheduler['last_run'] or 'never'} ({scheduler['last_result'] or '-'})"
+          f"{', running now' if scheduler['busy'] else ''}")
+    for capture in status["active"]:
+        print(f"  on air   {capture['output']} part {capture['part']}: "
+              f"{capture['progress']:.0%}, {capture['bytes'] / 1e6:.1f} MB, "
+              f"ends in {capture['ends_in']}s")
+    for programme in status["upcoming"]:
+        print(f"  {'cancelled' if programme['cancelled'] else 'upcoming'} "
+              f"{programme['start']} {programme['output']} ({programme['duration']:.0f}s)")
+    prebuffer = status.get("prebuffer")
+    if prebuffer:
+        print(f"  pre-buffer {prebuffer['bytes'] / 1e6:.1f} MB of {prebuffer['max_bytes'] / 1e6:.1f} MB")
+        for channel in prebuffer["channels"]:
+            print(f"    {channel['url']} ({channel['quality']}): {channel['seconds']:.0f}s, "
+                  f"{channel['bytes'] / 1e6:.1f} MB, {channel['readers']} readers")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Control the scheduler daemon.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status", help="show the scheduler state")
+    watch = sub.add_parser("watch", help="show the scheduler state continuously")
+    watch.add_argument("--interval", type=float, default=WATCH_INTERVAL)
+    add = sub.add_parser("add", help="record a programme now or later today")
+    add.add_argument("channel")
+    add.add_argument("duration", help="seconds, or timeout(1) syntax")
+    add.add_argument("--title")
+    add.add_argument("--start", help="HH:MM, now by default")
+    cancel = sub.add_parser("cancel", help="cancel a programme to come or stop one on air")
+    cancel.add_argument("--output")
+    cancel.add_argument("--title")
+    cancel.add_argument("--channel")
+    args = parser.parse_args(argv)
+
+    payload = {key: value for key, value in vars(args).items() if value is not None}
+    if args.command == "add":
+        try:
+            payload["duration"] = str(int(parse_duration(args.duration)))
+        except ValueError:
+            parser.error(f"invalid duration {args.duration!r}")
+
+    try:
+        for answer in request(payload, timeout=None if args.command == "watch" else 30):
+            if not answer.pop("ok"):
+                print(f"error: {answer['error']}", file=sys.stderr)
+                return 1
+            if args.command in ("status", "watch"):
+                if args.command == "watch":
+                    print(f"--- {datetime.now():%H:%M:%S}")
+                _print_status(answer)
+            else:
+                print(json.dumps(answer, ensure_ascii=False))
+    except (FileNotFoundError, ConnectionRefusedError):
+        print("The scheduler is not running.", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
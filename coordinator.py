@@ -0,0 +1,441 @@
+"""
+Spread the recordings of one schedule over several boxes.
+
+The coordinator node watches the info_progs.json fetched by
+scheduler_launch.py and serves a small JSON API. Worker nodes heartbeat
+it with their free bandwidth, free disk and active captures; the reply
+lists the programmes the worker must record. A worker that misses its
+heartbeats loses the programmes that have not ended yet, and they are
+handed to the remaining workers. Programmes already on air are restarted
+on the next minute for their remaining duration.
+
+    coordinator.py serve  [--host H] [--port P] [--schedule FILE] [--token T]
+                          [--heartbeat-timeout SECONDS]
+    coordinator.py worker --coordinator URL --worker-id ID [--bandwidth-kbps N]
+                          [--max-captures N] [--token T] [--dry-run]
+
+A worker hands new programmes to launch_stream_record.py (or the command
+given with --launch-cmd) through a schedule file of its own, and cancels
+revoked ones with recorder.cancel_recording(). With --dry-run it only
+logs what it would do, so several workers can run on one machine.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timedelta
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import requests
+
+from app_logging import setup_logging
+from channels_url import CHANNELS_URL
+from programme import load_programmes, log_invalid, output_name, parse_duration
+from recorder import cancel_recording
+from resource_governor import find_capture_processes
+
+logger = logging.getLogger("__name__")
+
+DATA_DIR = Path.home() / ".local/share/tvselect-fr-live-stream"
+SCHEDULE_FILE = DATA_DIR / "info_progs.json"
+RECORDINGS_DIR = Path.home() / "videos_select"
+
+DEFAULT_PORT = 8766
+HEARTBEAT_INTERVAL = 10.0
+HEARTBEAT_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+REBALANCE_INTERVAL = 5.0
+
+# Rough cost of one capture when nothing better is known.
+DEFAULT_BITRATE_KBPS = 6000
+DEFAULT_BANDWIDTH_KBPS = 30000
+DEFAULT_MAX_CAPTURES = 4
+
+DEFAULT_LAUNCH_CMD = (
+    f"{DATA_DIR}/.venv/bin/python3 "
+    f"{Path.home()}/tvselect-fr-live-stream/launch_stream_record.py"
+)
+
+
+def programme_window(video, now=None):
+    """Return (start, end) datetimes of a programme scheduled today."""
+    now = now or datetime.now()
+    hour, minute = (int(x) for x in video["start"].split(":"))
+    start = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return start, start + timedelta(seconds=parse_duration(video["duration"]))
+
+
+class WorkerState:
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.last_seen = 0.0
+        self.free_bandwidth_kbps = 0
+        self.free_disk_bytes = 0
+        self.active_captures = 0
+        self.max_captures = DEFAULT_MAX_CAPTURES
+
+    def as_dict(self):
+        return {
+            "worker_id": self.worker_id,
+            "last_seen": round(time.time() - self.last_seen, 1),
+            "free_bandwidth_kbps": self.free_bandwidth_kbps,
+            "free_disk_bytes": self.free_disk_bytes,
+            "active_captures": self.active_captures,
+            "max_captures": self.max_captures,
+        }
+
+
+class Coordinator:
+    """Assignment state shared by the HTTP handler and the rebalance loop."""
+
+    def __init__(self, schedule_file=SCHEDULE_FILE, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                 bitrate_kbps=DEFAULT_BITRATE_KBPS):
+        self.schedule_file = Path(schedule_file)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.bitrate_kbps = bitrate_kbps
+        self.workers = {}
+        self.programmes = {}
+        self.assignments = {}
+        self._schedule_mtime = None
+        self._unplaced = set()
+        self._lock = threading.Lock()
+
+    def reload_schedule(self):
+        try:
+            mtime = self.schedule_file.stat().st_mtime
+        except FileNotFoundError:
+            return
+        if mtime == self._schedule_mtime:
+            return
+
+        try:
+            programmes, errors = load_programmes(self.schedule_file, CHANNELS_URL)
+        except (OSError, json.JSONDecodeError):
+            logger.exception("Cannot load %s", self.schedule_file)
+            return
+
+        self._schedule_mtime = mtime
+        # Entries that cannot be recorded are left out, never assigned.
+        log_invalid(errors, self.schedule_file.name)
+        self.programmes = {programme.id: programme.fields for programme in programmes}
+        self.assignments = {
+            pid: worker for pid, worker in self.assignments.items()
+            if pid in self.programmes
+        }
+        logger.info("Loaded %d programmes from %s", len(self.programmes), self.schedule_file)
+
+    def heartbeat(self, report):
+        with self._lock:
+            worker = self.workers.get(report["worker_id"])
+            if worker is None:
+                worker = self.workers[report["worker_id"]] = WorkerState(report["worker_id"])
+                logger.info("Worker %s joined", worker.worker_id)
+            worker.last_seen = time.time()
+            worker.free_bandwidth_kbps = int(report.get("free_bandwidth_kbps", 0))
+            worker.free_disk_bytes = int(report.get("free_disk_bytes", 0))
+            worker.active_captures = int(report.get("active_captures", 0))
+            worker.max_captures = int(report.get("max_captures", DEFAULT_MAX_CAPTURES))
+
+            self._rebalance()
+            return [
+                {**self.programmes[pid], "id": pid}
+                for pid, worker_id in self.assignments.items()
+                if worker_id == worker.worker_id
+            ]
+
+    def rebalance(self):
+        with self._lock:
+            self._rebalance()
+
+    def _rebalance(self, now=None):
+        self.reload_schedule()
+        now = now or datetime.now()
+
+        for worker in list(self.workers.values()):
+            if time.time() - worker.last_seen <= self.heartbeat_timeout:
+                continue
+            lost = [pid for pid, wid in self.assignments.items() if wid == worker.worker_id]
+            for pid in lost:
+                del self.assignments[pid]
+                video = self.programmes[pid]
+                start, end = programme_window(video, now)
+                if start <= now < end:
+                    # Already on air: restart on the next minute for what is left.
+                    restart = (now + timedelta(minutes=1)).replace(second=0, microsecond=0)
+                    video["start"] = restart.strftime("%H:%M")
+                    video["duration"] = int((end - restart).total_seconds())
+            logger.warning(
+                "Worker %s stopped heartbeating, reassigning %d programmes",
+                worker.worker_id,
+                len(lost),
+            )
+            del self.workers[worker.worker_id]
+
+        pending = sorted(
+            (pid for pid in self.programmes if pid not in self.assignments),
+            key=lambda pid: programme_window(self.programmes[pid], now)[0],
+        )
+        for pid in pending:
+            start, end = programme_window(self.programmes[pid], now)
+            if end <= now:
+                continue
+            worker = self._pick_worker(start, end)
+            if worker is None:
+                if pid not in self._unplaced:
+                    logger.warning("No worker can take %s for now", pid)
+                    self._unplaced.add(pid)
+                continue
+            self._unplaced.discard(pid)
+            self.assignments[pid] = worker.worker_id
+            logger.info("Assigned %s to %s", pid, worker.worker_id)
+
+    def _pick_worker(self, start, end):
+        """Return the least loaded worker able to take one more capture over [start, end)."""
+        best, best_headroom = None, None
+        size = self.bitrate_kbps * 1000 / 8 * (end - start).total_seconds()
+
+        for worker in self.workers.values():
+            overlapping, committed_disk = 0, 0
+            for pid, wid in self.assignments.items():
+                if wid != worker.worker_id:
+                    continue
+                other_start, other_end = programme_window(self.programmes[pid])
+                committed_disk += self.bitrate_kbps * 1000 / 8 * (
+                    other_end - other_start
+                ).total_seconds()
+                if other_start < end and start < other_end:
+                    overlapping += 1
+
+            headroom = worker.free_bandwidth_kbps - (overlapping + 1) * self.bitrate_kbps
+            if (
+                headroom < 0
+                or overlapping + worker.active_captures >= worker.max_captures
+                or committed_disk + size > worker.free_disk_bytes
+            ):
+                continue
+            if best is None or headroom > best_headroom:
+                best, best_headroom = worker, headroom
+
+        return best
+
+    def status(self):
+        with self._lock:
+            return {
+                "workers": [worker.as_dict() for worker in self.workers.values()],
+                "assignments": self.assignments,
+                "unassigned": [pid for pid in self.programmes if pid not in self.assignments],
+            }
+
+
+class CoordinatorHandler(BaseHTTPRequestHandler):
+    coordinator = None
+    token = None
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def _authorized(self):
+        if self.token and self.headers.get("X-Coordinator-Token") != self.token:
+            self.send_error(HTTPStatus.FORBIDDEN)
+            return False
+        return True
+
+    def _send_json(self, payload, status=HTTPStatus.OK):
+        body = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path != "/status":
+            return self.send_error(HTTPStatus.NOT_FOUND)
+        self._send_json(self.coordinator.status())
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if self.path != "/heartbeat":
+            return self.send_error(HTTPStatus.NOT_FOUND)
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            report = json.loads(self.rfile.read(length))
+            worker_id = str(report["worker_id"])
+        except (ValueError, KeyError, TypeError):
+            return self.send_error(HTTPStatus.BAD_REQUEST)
+        report["worker_id"] = worker_id
+        self._send_json({"assignments": self.coordinator.heartbeat(report)})
+
+
+def serve(host, port, schedule_file, token=None, heartbeat_timeout=HEARTBEAT_TIMEOUT):
+    coordinator = Coordinator(schedule_file, heartbeat_timeout)
+    handler = type("Handler", (CoordinatorHandler,), {"coordinator": coordinator, "token": token})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+
+    def rebalance_loop():
+        while True:
+            time.sleep(REBALANCE_INTERVAL)
+            try:
+                coordinator.rebalance()
+            except Exception:
+                logger.exception("Rebalance failed")
+
+    threading.Thread(target=rebalance_loop, daemon=True).start()
+    logger.info("Coordinator listening on %s:%d", host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class Worker:
+    """Heartbeat the coordinator and apply the assignments it returns."""
+
+    def __init__(self, coordinator_url, worker_id, bandwidth_kbps=DEFAULT_BANDWIDTH_KBPS,
+                 max_captures=DEFAULT_MAX_CAPTURES, launch_cmd=DEFAULT_LAUNCH_CMD,
+                 token=None, dry_run=False, bitrate_kbps=DEFAULT_BITRATE_KBPS):
+        self.coordinator_url = coordinator_url.rstrip("/")
+        self.worker_id = worker_id
+        self.bandwidth_kbps = bandwidth_kbps
+        self.max_captures = max_captures
+        self.launch_cmd = shlex.split(launch_cmd)
+        self.token = token
+        self.dry_run = dry_run
+        self.bitrate_kbps = bitrate_kbps
+        self.submitted = {}
+        self.session = requests.Session()
+
+    def report(self):
+        active = 0 if self.dry_run else len(find_capture_processes())
+        try:
+            free_disk = shutil.disk_usage(RECORDINGS_DIR).free
+        except FileNotFoundError:
+            free_disk = shutil.disk_usage(Path.home()).free
+        return {
+            "worker_id": self.worker_id,
+            "free_bandwidth_kbps": max(self.bandwidth_kbps - active * self.bitrate_kbps, 0),
+            "free_disk_bytes": free_disk,
+            "active_captures": active,
+            "max_captures": self.max_captures,
+        }
+
+    def heartbeat(self):
+        headers = {"X-Coordinator-Token": self.token} if self.token else {}
+        response = self.session.post(
+            f"{self.coordinator_url}/heartbeat", json=self.report(), headers=headers, timeout=5
+        )
+        response.raise_for_status()
+        return response.json()["assignments"]
+
+    def apply(self, assignments):
+        assigned = {video.pop("id"): video for video in assignments}
+
+        for pid in set(self.submitted) - set(assigned):
+            video = self.submitted.pop(pid)
+            if programme_window(video)[0] <= datetime.now():
+                # Too late to cancel: the capture has started or is over.
+                continue
+            logger.info("Programme %s was moved to another worker, cancelling it", pid)
+            if not self.dry_run:
+                cancel_recording(output_name(video))
+
+        new = {pid: video for pid, video in assigned.items() if pid not in self.submitted}
+        if not new:
+            return
+
+        logger.info("Worker %s takes %d new programmes", self.worker_id, len(new))
+        if self.dry_run:
+            for pid in new:
+                logger.info("[dry-run] would record %s", pid)
+        elif not self.launch(list(new.values())):
+            return
+        self.submitted.update(new)
+
+    def launch(self, videos):
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", suffix=".json", dir=DATA_DIR, delete=False
+        ) as f:
+            json.dump(videos, f, ensure_ascii=False)
+        try:
+            result = subprocess.run(
+                self.launch_cmd,
+                env={**os.environ, "TVSELECT_INFO_PROGS": f.name},
+                timeout=300,
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            logger.exception("Could not run %s", self.launch_cmd)
+            return False
+        finally:
+            os.remove(f.name)
+        return result.returncode == 0
+
+    def run(self, interval=HEARTBEAT_INTERVAL):
+        while True:
+            try:
+                self.apply(self.heartbeat())
+            except (requests.RequestException, ValueError, KeyError):
+                logger.warning("Heartbeat to %s failed", self.coordinator_url, exc_info=True)
+            time.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Distribute recordings across boxes.")
+    sub = parser.add_subparsers(dest="mode", required=True)
+
+    serve_parser = sub.add_parser("serve", help="run the coordinator")
+    serve_parser.add_argument("--host", default="0.0.0.0")
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument("--schedule", default=str(SCHEDULE_FILE))
+    serve_parser.add_argument("--token", default=None)
+    serve_parser.add_argument("--heartbeat-timeout", type=float, default=HEARTBEAT_TIMEOUT)
+
+    worker_parser = sub.add_parser("worker", help="run a worker node")
+    worker_parser.add_argument("--coordinator", required=True, help="e.g. http://box1:8766")
+    worker_parser.add_argument("--worker-id", required=True)
+    worker_parser.add_argument("--bandwidth-kbps", type=int, default=DEFAULT_BANDWIDTH_KBPS)
+    worker_parser.add_argument("--max-captures", type=int, default=DEFAULT_MAX_CAPTURES)
+    worker_parser.add_argument("--launch-cmd", default=DEFAULT_LAUNCH_CMD)
+    worker_parser.add_argument("--interval", type=float, default=HEARTBEAT_INTERVAL)
+    worker_parser.add_argument("--token", default=None)
+    worker_parser.add_argument("--dry-run", action="store_true")
+
+    args = parser.parse_args(argv)
+
+    if args.mode == "worker" and not re.match(r"^[a-zA-Z0-9_.-]+$", args.worker_id):
+        parser.error("the worker id may only contain letters, digits, '.', '_' and '-'")
+
+    if args.mode == "serve":
+        setup_logging("coordinator.log")
+        serve(args.host, args.port, args.schedule, args.token, args.heartbeat_timeout)
+    else:
+        setup_logging(f"coordinator_worker_{args.worker_id}.log")
+        Worker(
+            args.coordinator,
+            args.worker_id,
+            args.bandwidth_kbps,
+            args.max_captures,
+            args.launch_cmd,
+            args.token,
+            args.dry_run,
+        ).run(args.interval)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,263 @@
+"""
+Hot upgrade of the installed version.
+
+Every release is unpacked on its own under
+~/.local/share/tvselect-fr-live-stream/releases/<version>, and
+~/tvselect-fr-live-stream is a symlink to the current one. The symlink is
+swapped with rename(2), so an at job or a cron line starting at that
+moment sees the old release or the new one, never a missing directory.
+auto_update.sh unpacks a release and runs
+
+    hot_upgrade.py activate RELEASE_DIR
+
+which checks that the release compiles and that its recorder starts,
+swaps the symlink and sends SIGHUP to the scheduler daemon and to every
+recorder. Both re-exec themselves from the new release:
+
+- the scheduler keeps its control socket listening, and its state;
+- a recorder keeps its output file open (and flock()ed), and its
+  streamlink process, which holds the playlist position, together with
+  the pipe streamlink writes to. No segment is lost: the new recorder
+  reads what streamlink wrote in the meantime.
+
+Only the processes that advertise it, with a file named after their pid
+in handover/ written once their SIGHUP handler is installed, are
+signalled: SIGHUP would kill a process still starting, or one from a
+release before hot upgrades. What a process hands over is passed to the
+new one in TVSELECT_HANDOVER.
+Older releases stay on disk because running processes may still import
+modules from them; only the KEEP_RELEASES most recently activated are kept.
+
+    hot_upgrade.py activate RELEASE_DIR [--no-handover]
+    hot_upgrade.py handover
+    hot_upgrade.py status
+"""
+import argparse
+import atexit
+import json
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+
+from pathlib import Path
+
+logger = logging.getLogger("__name__")
+
+INSTALL_DIR = Path.home() / "tvselect-fr-live-stream"
+RELEASES_DIR = Path.home() / ".local/share/tvselect-fr-live-stream/releases"
+HANDOVER_DIR = Path.home() / ".local/share/tvselect-fr-live-stream/handover"
+ACTIVATED_MARKER = ".activated"
+
+HANDOVER_ENV = "TVSELECT_HANDOVER"
+HANDED_OVER = ("scheduler_launch.py", "recorder.py")
+
+KEEP_RELEASES = 3
+SMOKE_TIMEOUT = 120
+
+
+class UpgradeError(Exception):
+    pass
+
+
+def current_release(install_dir=INSTALL_DIR):
+    """Return the release the install directory points to, or None."""
+    if not install_dir.is_symlink():
+        return None
+    return install_dir.resolve()
+
+
+def smoke_test(release):
+    """Raise UpgradeError unless release compiles and its recorder starts."""
+    for command in (
+        [sys.executable, "-m", "compileall", "-q", str(release)],
+        [sys.executable, str(release / "recorder.py"), "--help"],
+    ):
+        try:
+            result = subprocess.run(command, capture_output=True, timeout=SMOKE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            raise UpgradeError(f"{command[-2]} {command[-1]} timed out") from None
+        if result.returncode:
+            error = result.stderr.decode(errors="replace").strip()[-500:]
+            raise UpgradeError(f"{command[-2]} {command[-1]} failed: {error}")
+
+
+def swap(release, install_dir=INSTALL_DIR):
+    """Point install_dir to release in one rename."""
+    if install_dir.exists() and not install_dir.is_symlink():
+        raise UpgradeError(f"{install_dir} is a directory, not a release symlink")
+    tmp = install_dir.with_name(f".{install_dir.name}.{os.getpid()}")
+    tmp.unlink(missing_ok=True)
+    tmp.symlink_to(release)
+    os.replace(tmp, install_dir)
+
+
+def find_processes(scripts=HANDED_OVER):
+    """Yield (pid, script) for the processes of this user running one of scripts."""
+    uid = os.getuid()
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit() or int(entry.name) == os.getpid():
+            continue
+        try:
+            if entry.stat().st_uid != uid:
+                continue
+            args = (entry / "cmdline").read_bytes().split(b"\0")
+        except OSError:
+            continue
+        if len(args) > 1:
+            script = os.path.basename(args[1].decode(errors="replace"))
+            if script in scripts:
+                yield int(entry.name), script
+
+
+def _pidfile(pid):
+    return HANDOVER_DIR / str(pid)
+
+
+def advertise_handover(script):
+    """Tell signal_handover that this process takes SIGHUP as a handover."""
+    HANDOVER_DIR.mkdir(parents=True, exist_ok=True)
+    pidfile = _pidfile(os.getpid())
+    pidfile.write_text(script)
+    atexit.register(pidfile.unlink, missing_ok=True)
+
+
+def advertised(pid, script):
+    try:
+        return _pidfile(pid).read_text() == script
+    except OSError:
+        return False
+
+
+def signal_handover(scripts=HANDED_OVER):
+    """Ask the running scheduler and recorders to re-exec; return how many were signalled."""
+    count = 0
+    running = set()
+    for pid, script in find_processes(scripts):
+        running.add(str(pid))
+        if not advertised(pid, script):
+            logger.info("%s (pid %d) cannot take a handover, left alone", script, pid)
+            continue
+        try:
+            os.kill(pid, signal.SIGHUP)
+        except ProcessLookupError:
+            continue
+        logger.info("Asked %s (pid %d) to move to the new release", script, pid)
+        count += 1
+    if HANDOVER_DIR.is_dir():
+        for pidfile in HANDOVER_DIR.iterdir():
+            if pidfile.name not in running:
+                pidfile.unlink(missing_ok=True)
+    return count
+
+
+def _activated(release):
+    # Releases never activated (failed checks) go first.
+    try:
+        return (release / ACTIVATED_MARKER).stat().st_mtime
+    except OSError:
+        return 0.0
+
+
+def prune(keep=KEEP_RELEASES, releases_dir=RELEASES_DIR):
+    """Remove the releases activated before the keep most recent ones."""
+    current = current_release()
+    releases = sorted(
+        (path for path in releases_dir.iterdir() if path.is_dir()), key=_activated, reverse=True
+    )
+    for old in releases[keep:]:
+        if old.resolve() != current:
+            logger.info("Removing the old release %s", old.name)
+            shutil.rmtree(old, ignore_errors=True)
+
+
+def activate(release, handover=True):
+    """Make release the installed version; return the previous one."""
+    release = Path(release).resolve()
+    smoke_test(release)
+    previous = current_release()
+    if previous is not None and not (previous / ACTIVATED_MARKER).exists():
+        (previous / ACTIVATED_MARKER).touch()
+    swap(release)
+    (release / ACTIVATED_MARKER).touch()
+    logger.info("Installed release is now %s", release.name)
+    if handover:
+        signal_handover()
+    prune()
+    return previous
+
+
+def take_handover():
+    """Return what the previous process handed over, or None, and clear it from the environment."""
+    value = os.environ.pop(HANDOVER_ENV, None)
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        logger.error("Ignoring an unreadable %s", HANDOVER_ENV)
+        return None
+
+
+def reexec(script, state, fds=()):
+    """
+    Replace this process by script of the installed release, with the
+    same arguments. state is passed on as JSON; fds stay open.
+    """
+    for fd in fds:
+        os.set_inheritable(fd, True)
+    path = INSTALL_DIR / script
+    if not path.exists():
+        path = Path(sys.argv[0]).absolute()
+    env = dict(os.environ)
+    env[HANDOVER_ENV] = json.dumps(state)
+    # The new process advertises itself again once it can take a SIGHUP;
+    # an ignored SIGHUP stays ignored through exec until then.
+    _pidfile(os.getpid()).unlink(missing_ok=True)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    logging.shutdown()
+    os.execve(sys.executable, [sys.executable, str(path), *sys.argv[1:]], env)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Switch to another release without a restart.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    activate_parser = sub.add_parser("activate", help="install a release unpacked in RELEASE_DIR")
+    activate_parser.add_argument("release", type=Path)
+    activate_parser.add_argument(
+        "--no-handover", action="store_true", help="leave the running processes alone"
+    )
+    sub.add_parser("handover", help="move the running processes to the installed release")
+    sub.add_parser("status", help="show the releases and the processes to hand over")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.command == "activate":
+        try:
+            previous = activate(args.release, handover=not args.no_handover)
+        except (OSError, UpgradeError) as e:
+            logger.error("Release %s not installed: %s", args.release, e)
+            return 1
+        print(f"{previous.name if previous else 'none'} -> {args.release.resolve().name}")
+        return 0
+
+    if args.command == "handover":
+        print(f"{signal_handover()} processes signalled")
+        return 0
+
+    current = current_release()
+    print(f"installed: {current or INSTALL_DIR}")
+    if RELEASES_DIR.is_dir():
+        for release in sorted(RELEASES_DIR.iterdir(), key=_activated, reverse=True):
+            print(f"  {release.name}{' (current)' if release.resolve() == current else ''}")
+    for pid, script in find_processes():
+        note = "" if advertised(pid, script) else " (no handover)"
+        print(f"running: {script} pid {pid}{note}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
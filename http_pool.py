@@ -0,0 +1,404 @@
+"""
+Cheaper connection setup for the captures.
+
+Every capture runs its own streamlink process, and they all hit the same
+few CDN hosts: the France Télévisions channels all resolve to the
+france.tv CDN. install() makes a process cheaper to connect:
+
+* DNS answers are cached for DNS_TTL seconds, in memory and in a file
+  shared by every capture, so captures starting together do one lookup
+  per host.
+* urllib3 connections of the process share one SSLContext per set of TLS
+  parameters (the CA bundle is loaded once), and TLS sessions are kept
+  per host and offered again: reconnects and new connections resume the
+  session instead of doing a full handshake.
+
+recorder.py installs it in itself and starts streamlink through this
+module (`http_pool.py streamlink ARGS...`), unless TVSELECT_HTTP_POOL=0.
+TLS sessions cannot leave a process, so they are only shared between
+the connections of one capture.
+
+At exit each process appends what it saved to logs/http_pool.jsonl:
+
+    python3 http_pool.py report [--days 7]
+"""
+import argparse
+import atexit
+import fcntl
+import json
+import logging
+import os
+import socket
+import ssl
+import sys
+import threading
+import time
+import weakref
+
+from datetime import date, datetime, timedelta
+
+from app_logging import LOGS_DIR
+
+logger = logging.getLogger("__name__")
+
+DNS_CACHE_FILE = LOGS_DIR.parent / "dns_cache.json"
+STATS_FILE = LOGS_DIR / "http_pool.jsonl"
+DNS_TTL = 120.0
+MAX_SESSIONS_PER_HOST = 4
+
+
+def enabled():
+    return os.environ.get("TVSELECT_HTTP_POOL") != "0"
+
+
+class PoolStats:
+    def __init__(self):
+        self.dns_hits = 0
+        self.dns_lookups = 0
+        self.dns_lookup_time = 0.0
+        self.full_handshakes = 0
+        self.full_handshake_time = 0.0
+        self.resumed_handshakes = 0
+        self.resumed_handshake_time = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, field, count_field=None, elapsed=None):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+            if count_field:
+                setattr(self, count_field, getattr(self, count_field) + elapsed)
+
+    def latency_gained(self):
+        """Estimated connection setup time saved, in seconds."""
+        gained = 0.0
+        if self.dns_lookups:
+            gained += self.dns_hits * self.dns_lookup_time / self.dns_lookups
+        if self.full_handshakes and self.resumed_handshakes:
+            full = self.full_handshake_time / self.full_handshakes
+            resumed = self.resumed_handshake_time / self.resumed_handshakes
+            gained += self.resumed_handshakes * max(full - resumed, 0.0)
+        return gained
+
+    def as_dict(self):
+        return {
+            "dns_hits": self.dns_hits,
+            "dns_lookups": self.dns_lookups,
+            "dns_lookup_time": round(self.dns_lookup_time, 4),
+            "full_handshakes": self.full_handshakes,
+            "full_handshake_time": round(self.full_handshake_time, 4),
+            "resumed_handshakes": self.resumed_handshakes,
+            "resumed_handshake_time": round(self.resumed_handshake_time, 4),
+            "latency_gained": round(self.latency_gained(), 4),
+        }
+
+
+stats = PoolStats()
+
+
+class DnsCache:
+    """getaddrinfo() answers kept for ttl seconds, in memory and in a shared file."""
+
+    def __init__(self, path=DNS_CACHE_FILE, ttl=DNS_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._memory = {}
+        self._lock = threading.Lock()
+        self._getaddrinfo = socket.getaddrinfo
+
+    @staticmethod
+    def _key(host, port, family, type, proto, flags):
+        return f"{host}|{port}|{int(family)}|{int(type)}|{proto}|{flags}"
+
+    def _read_file(self, lock_type):
+        try:
+            f = open(self.path, "r+", encoding="utf-8")
+        except FileNotFoundError:
+            return None, {}
+        fcntl.flock(f, lock_type)
+        try:
+            return f, json.load(f)
+        except ValueError:
+            return f, {}
+
+    def _lookup_file(self, key, now):
+        f, entries = self._read_file(fcntl.LOCK_SH)
+        if f is not None:
+            f.close()
+        entry = entries.get(key)
+        if entry and now - entry["at"] < self.ttl:
+            return entry
+        return None
+
+    def _store_file(self, key, entry, now):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8"):
+            pass
+        f, entries = self._read_file(fcntl.LOCK_EX)
+        try:
+            entries = {k: v for k, v in entries.items() if now - v["at"] < self.ttl}
+            entries[key] = entry
+            f.seek(0)
+            f.truncate()
+            json.dump(entries, f)
+        finally:
+            f.close()
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        if not isinstance(host, str) or _is_ip(host) or host == "localhost":
+            return self._getaddrinfo(host, port, family, type, proto, flags)
+
+        key = self._key(host, port, family, type, proto, flags)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+        if not entry or now - entry["at"] >= self.ttl:
+            try:
+                entry = self._lookup_file(key, now)
+            except OSError:
+                entry = None
+        if entry:
+            with self._lock:
+                self._memory[key] = entry
+            stats.add("dns_hits")
+            return [
+                (socket.AddressFamily(f), socket.SocketKind(t), p, name, tuple(addr))
+                for f, t, p, name, addr in entry["answers"]
+            ]
+
+        start = time.monotonic()
+        answers = self._getaddrinfo(host, port, family, type, proto, flags)
+        stats.add("dns_lookups", "dns_lookup_time", time.monotonic() - start)
+        entry = {
+            "at": now,
+            "answers": [[int(f), int(t), p, name, list(addr)] for f, t, p, name, addr in answers],
+        }
+        with self._lock:
+            self._memory[key] = entry
+        try:
+            self._store_file(key, entry, now)
+        except OSError:
+            pass
+        return answers
+
+    def install(self):
+        socket.getaddrinfo = self.getaddrinfo
+
+
+def _is_ip(host):
+    try:
+        socket.inet_pton(socket.AF_INET6 if ":" in host else socket.AF_INET, host.strip("[]"))
+    except OSError:
+        return False
+    return True
+
+
+class TlsSessionCache:
+    """
+    TLS sessions per host, offered again on the next connection.
+
+    A session only resumes on the SSLContext it was made with, so the
+    contexts urllib3 creates are shared (one per set of parameters).
+    TLS 1.3 tickets arrive after the handshake, so sessions are also
+    taken from the sockets as they close.
+    """
+
+    def __init__(self, max_per_host=MAX_SESSIONS_PER_HOST):
+        self.max_per_host = max_per_host
+        self._sessions = {}
+        self._live = {}
+        self._contexts = {}
+        self._lock = threading.Lock()
+
+    def keep(self, host, sock):
+        try:
+            session = sock.session
+        except (OSError, ValueError, AttributeError):
+            return
+        if session is None:
+            return
+        # A TLS 1.3 session can only resume once its ticket has arrived.
+        if not session.has_ticket and sock.version() == "TLSv1.3":
+            return
+        with self._lock:
+            sessions = self._sessions.setdefault(host, [])
+            if session not in sessions:
+                sessions.append(session)
+                del sessions[:-self.max_per_host]
+
+    def session_for(self, host, context):
+        with self._lock:
+            live = list(self._live.get(host, ()))
+        for sock in live:
+            if sock.context is context:
+                self.keep(host, sock)
+        with self._lock:
+            sessions = self._sessions.get(host, [])
+            now = time.time()
+            while sessions and now - sessions[-1].time > sessions[-1].timeout:
+                sessions.pop()
+            return sessions[-1] if sessions else None
+
+    def _socket_class(self):
+        cache = self
+
+        class ResumingSocket(ssl.SSLSocket):
+            def _real_close(self):
+                if self.server_hostname:
+                    cache.keep(self.server_hostname, self)
+                super()._real_close()
+
+        return ResumingSocket
+
+    def _wrap(self, context, original_wrap):
+        def wrap_socket(sock, *args, server_hostname=None, session=None, **kwargs):
+            if session is None and server_hostname and not kwargs.get("server_side"):
+                session = self.session_for(server_hostname, context)
+            start = time.monotonic()
+            ssock = original_wrap(sock, *args, server_hostname=server_hostname,
+                                  session=session, **kwargs)
+            elapsed = time.monotonic() - start
+            if ssock.session_reused:
+                stats.add("resumed_handshakes", "resumed_handshake_time", elapsed)
+            else:
+                stats.add("full_handshakes", "full_handshake_time", elapsed)
+            if server_hostname:
+                self.keep(server_hostname, ssock)
+                with self._lock:
+                    self._live.setdefault(server_hostname, weakref.WeakSet()).add(ssock)
+            return ssock
+        return wrap_socket
+
+    def shared_context(self, factory):
+        """Wrap an SSLContext factory so equal calls share one resuming context."""
+        def create_context(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            with self._lock:
+                context = self._contexts.get(key)
+            if context is not None:
+                return context
+
+            context = factory(*args, **kwargs)
+            context.sslsocket_class = self._socket_class()
+            context.wrap_socket = self._wrap(context, context.wrap_socket)
+            loaded = set()
+            load = context.load_verify_locations
+
+            def load_verify_locations(cafile=None, capath=None, cadata=None):
+                # urllib3 loads the CA bundle on every connection.
+                key = (cafile, capath, cadata if not isinstance(cadata, bytes) else hash(cadata))
+                if key not in loaded:
+                    load(cafile, capath, cadata)
+                    loaded.add(key)
+
+            context.load_verify_locations = load_verify_locations
+            with self._lock:
+                return self._contexts.setdefault(key, context)
+        return create_context
+
+    def install(self):
+        import urllib3.connection
+
+        urllib3.connection.create_urllib3_context = self.shared_context(
+            urllib3.connection.create_urllib3_context
+        )
+
+
+def write_stats(name):
+    record = {"time": time.time(), "name": name, "pid": os.getpid(), **stats.as_dict()}
+    try:
+        STATS_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(STATS_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError:
+        pass
+    if stats.dns_hits or stats.resumed_handshakes:
+        logger.info(
+            "Connection setup: %d DNS lookups and %d TLS handshakes saved, about %.0f ms gained.",
+            stats.dns_hits,
+            stats.resumed_handshakes,
+            stats.latency_gained() * 1000,
+        )
+
+
+_installed = False
+
+
+def install(name):
+    """Install the DNS cache and TLS session sharing in this process."""
+    global _installed
+    if _installed or not enabled():
+        return
+    _installed = True
+    DnsCache().install()
+    try:
+        TlsSessionCache().install()
+    except ImportError:
+        pass
+
+    atexit.register(write_stats, name)
+
+
+def run_streamlink(args):
+    """Run the streamlink command line in this process, with install() done."""
+    try:
+        from streamlink_cli.main import main as streamlink_main
+    except ImportError:
+        os.execvp("streamlink", ["streamlink", *args])
+    install("streamlink")
+
+    sys.argv = ["streamlink", *args]
+    return streamlink_main()
+
+
+def report(days):
+    first = (date.today() - timedelta(days=days - 1)).isoformat()
+    totals = PoolStats()
+    processes = 0
+    try:
+        with open(STATS_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if datetime.fromtimestamp(record["time"]).date().isoformat() < first:
+                    continue
+                processes += 1
+                for field in totals.as_dict():
+                    if field != "latency_gained":
+                        setattr(totals, field, getattr(totals, field) + record[field])
+    except FileNotFoundError:
+        pass
+    return processes, totals
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["streamlink"]:
+        return run_streamlink(argv[1:])
+
+    parser = argparse.ArgumentParser(description="Shared DNS and TLS session caches.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("streamlink", help="run streamlink with the caches installed")
+    summary = sub.add_parser("report", help="what the caches saved")
+    summary.add_argument("--days", type=int, default=7)
+    args = parser.parse_args(argv)
+
+    processes, totals = report(args.days)
+    lookups = totals.dns_lookups + totals.dns_hits
+    handshakes = totals.full_handshakes + totals.resumed_handshakes
+    print(f"{processes} processes over {args.days} days")
+    print(f"DNS: {totals.dns_hits}/{lookups} lookups served from the cache")
+    print(f"TLS: {totals.resumed_handshakes}/{handshakes} handshakes resumed")
+    if totals.full_handshakes:
+        print(f"  full handshake   {totals.full_handshake_time / totals.full_handshakes * 1000:7.1f} ms")
+    if totals.resumed_handshakes:
+        print(f"  resumed          {totals.resumed_handshake_time / totals.resumed_handshakes * 1000:7.1f} ms")
+    print(f"Connection setup time gained: {totals.latency_gained():.2f}s "
+          f"({totals.latency_gained() / max(processes, 1) * 1000:.0f} ms per process)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
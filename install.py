@@ -520,6 +520,13 @@ cron_launch = (
     "bash cron_launch_record.sh\n".format(user=user, minute_2=minute_2, heure=heure)
 )
 
+cron_recover = (
+    "@reboot export USER='{user}' TZ='Europe/Paris'; "
+    "$HOME/.local/share/tvselect-fr-live-stream/.venv/bin/python3 "
+    "$HOME/tvselect-fr-live-stream/capture_journal.py recover >> $HOME/.local/share"
+    "/tvselect-fr-live-stream/logs/capture_journal.log 2>&1\n".format(user=user)
+)
+
 cron_auto_update = (
     '{minute_auto_update} {heure_auto_update} * * * /bin/bash -c "$HOME'
     "/tvselect-fr-live-stream/auto_update.sh >> $HOME/.local/share"
@@ -531,14 +538,17 @@ cron_auto_update = (
 if hdmi_screen != "non":
     cron_lines = [
         curl if "tvselect-fr-live-stream/curl_tvselect.sh" in cron else
+        cron_recover if "capture_journal.py recover" in cron else
         cron_launch if "tvselect-fr-live-stream &&" in cron else cron
         for cron in cron_lines
     ]
 else:
+    # The scheduler daemon replays the capture journal when it starts.
     cron_lines = [
         cron for cron in cron_lines
         if "tvselect-fr-live-stream/curl_tvselect.sh" not in cron and
-        "tvselect-fr-live-stream &&" not in cron
+        "tvselect-fr-live-stream &&" not in cron and
+        "capture_journal.py recover" not in cron
     ]
 
 
@@ -558,6 +568,8 @@ if hdmi_screen != "non" and "tvselect-fr-live-stream/curl_tvselect.sh" not in cr
     cron_lines.append(curl)
 if hdmi_screen != "non" and "tvselect-fr-live-stream &&" not in cron_lines_join:
     cron_lines.append(cron_launch)
+if hdmi_screen != "non" and "capture_journal.py recover" not in cron_lines_join:
+    cron_lines.append(cron_recover)
 
 if auto_update.lower() == "oui" and "tvselect-fr-live-stream/auto_update" not in cron_lines_join:
     cron_lines.append(cron_auto_update)
@@ -2,17 +2,19 @@ import json
 import logging
 import os
 import re
-import sentry_sdk
-import shlex
-import subprocess
 import sys
 
 from pathlib import Path
-from datetime import datetime, timedelta
 from logging.handlers import RotatingFileHandler
 
 from channels_url import CHANNELS_URL
-from security_sanitizer import global_sanitizer, scrub_event
+from planner import build_jobs, submit_jobs
+from profiling import install as install_profiling
+from programme import load_programmes, log_invalid
+from rendition_policy import PolicySet
+from security_sanitizer import global_sanitizer
+from sentry_spool import init_sentry
+from tracing import span
 
 def get_validated_user():
     """Securely get and validate the USER environment variable."""
@@ -48,6 +50,16 @@ from config import (
     TF1_PASSWORD,
 )
 
+try:
+    from config import RENDITION_POLICIES
+except ImportError:
+    RENDITION_POLICIES = {}
+
+try:
+    from config import ROLL_MINUTES
+except ImportError:
+    ROLL_MINUTES = 0
+
 
 def get_tf1_credentials_from_ev():
     """Retrieve TF1 credentials from environment variables if CRYPTED_CREDENTIALS is enabled."""
@@ -80,42 +92,8 @@ def can_process_tf1_video(TF1_EMAIL, TF1_PASSWORD, channel):
     else:
         return False
 
-def subtract_one_minute(time_str: str) -> str:
-    dt = datetime.strptime(time_str, "%H:%M")
-    dt -= timedelta(minutes=1)
-    return dt.strftime("%H:%M")
-
-def sanitize_filename(name):
-    """
-    Sanitize filename while preserving accents and international characters.
-    Only removes shell metacharacters and dangerous characters.
-    """
-
-    dangerous_chars = [
-        ';', '|', '`', '\\', '\n', '\r',
-        '>', '<', '&', '$', '*', '?',
-        '(', ')', '[', ']', '{', '}',
-        '"', "'", '!', '#', '%', '^', '~',
-        '\x00'  # Null byte
-    ]
-
-    result = name
-    for char in dangerous_chars:
-        result = result.replace(char, '_')
-
-    return result
-
 if SENTRY_MONITORING_SDK:
-    sentry_sdk.init(
-        dsn="https://0b40b1a24c605fd77fddb9219a45e594@o4508778574381056.ingest.de.sentry.io/4509938023268432",
-        send_default_pii=False,
-        include_local_variables=False,
-        before_send=scrub_event,
-        traces_sample_rate=0,
-    )
-    client = sentry_sdk.get_client()
-    if client and client.options.get("traces_sample_rate", 0) > 0:
-        sentry_sdk.profiler.start_profiler()
+    init_sentry()
 
 
 log_file = f"/home/{user}/.local/share/tvselect-fr-live-stream/logs/stream_record.log"
@@ -147,12 +125,13 @@ logging.basicConfig(
 
 
 try:
-    with open(
-        f"/home/{user}/.local/share/tvselect-fr-live-stream/info_progs.json",
-        "r",
-        encoding="utf-8",
-    ) as jsonfile:
-        data = json.load(jsonfile)
+    programmes, invalid_programmes = load_programmes(
+        os.environ.get(
+            "TVSELECT_INFO_PROGS",
+            f"/home/{user}/.local/share/tvselect-fr-live-stream/info_progs.json",
+        ),
+        CHANNELS_URL,
+    )
 except FileNotFoundError:
     logger.error(
         "No info_progs.json file. Need to check curl command or "
@@ -195,102 +174,18 @@ secure_env_with_creds = {
     "STREAMLINK_TF1_PASSWORD": TF1_PASSWORD,
 }
 
-TF1_CHANNELS = ["TF1", "TMC", "TFX", "TF1 Séries Films", "L'Equipe"]
+install_profiling("planner")
 
-for video in data:
+log_invalid(invalid_programmes)
 
-    try:
-        channel_url = CHANNELS_URL[video["channel"]]
-    except KeyError:
-        logger.error(
-            "La chaine " + video["channel"] + " n'est pas "
-            "présente dans le fichier channels_urls.py"
-        )
-        continue
-
-    raw_title = sanitize_filename(video['title'])
-    title_short = raw_title[:-3] if len(raw_title) > 3 else raw_title
-    raw_channel = video["channel"].replace("'", "-").replace(" ", "_")
-
-    safe_channel_param = shlex.quote(raw_channel)
-    safe_duration = shlex.quote(str(video['duration']))
-    safe_url = shlex.quote(channel_url)
-
-    cmd = ["at", video["start"]]
-
-    if (
-        video["channel"] in TF1_CHANNELS
-        and can_process_tf1_video(TF1_EMAIL, TF1_PASSWORD, video["channel"])
-    ):
-        cmd_purge = ["at", subtract_one_minute(video["start"])]
-
-        purge_script = (
-            ". $HOME/.local/share/tvselect-fr-live-stream/.venv/bin/activate "
-            "&& streamlink --tf1-purge-credentials "
-            "--tf1-email \"$STREAMLINK_TF1_EMAIL\" "
-            "--tf1-password \"$STREAMLINK_TF1_PASSWORD\" "
-            "https://www.tf1.fr/tf1/direct"
-        )
-        with open(log_file, "a", encoding="utf-8") as log:
-            launch = subprocess.Popen(
-                cmd_purge,
-                stdin=subprocess.PIPE,
-                stdout=log,
-                stderr=log,
-                env=secure_env_with_creds,
-            )
-            _, _ = launch.communicate(input=purge_script.encode())
-
-        if launch.returncode != 0:
-            logger.error("TF1 purge command failed for channel %s", video["channel"])
-            continue
-
-        record_script = (
-            ". $HOME/.local/share/tvselect-fr-live-stream/.venv/bin/activate "
-            f"&& timeout {safe_duration} streamlink "
-            "--hls-live-edge 5 "
-            f"-o $HOME/videos_select/{title_short}_{safe_channel_param}.ts "
-            "--tf1-email \"$STREAMLINK_TF1_EMAIL\" "
-            "--tf1-password \"$STREAMLINK_TF1_PASSWORD\" "
-            f"{safe_url} best >> ~/.local/share/tvselect-fr-live-stream/logs/"
-            f"record_{title_short}.log 2>&1"
-        )
-
-    elif (
-        video["channel"] in TF1_CHANNELS
-        and not can_process_tf1_video(TF1_EMAIL, TF1_PASSWORD, video["channel"])
-    ):
-        logger.error(
-            f"The video {title_short}_{safe_channel_param}.ts cannot be "
-            "recorded because of TF1 missing credentials."
-        )
-        continue
+with span("planner.run"):
+    jobs = build_jobs(
+        programmes,
+        lambda channel: can_process_tf1_video(TF1_EMAIL, TF1_PASSWORD, channel),
+        safe_env_base,
+        secure_env_with_creds,
+        policies=PolicySet(RENDITION_POLICIES),
+        roll_minutes=ROLL_MINUTES,
+    )
 
-    else:
-        record_script = (
-            ". $HOME/.local/share/tvselect-fr-live-stream/.venv/bin/activate "
-            f"&& timeout {safe_duration} streamlink "
-            "--hls-live-edge 5 "
-            f"-o $HOME/videos_select/{title_short}_{safe_channel_param}.ts "
-            f"{safe_url} best >> ~/.local/share/tvselect-fr-live-stream/logs/"
-            f"record_{title_short}.log 2>&1"
-        )
-
-    with open(log_file, "a", encoding="utf-8") as log:
-        launch = subprocess.Popen(
-            cmd,
-            stdin=subprocess.PIPE,
-            stdout=log,
-            stderr=log,
-            env=secure_env_with_creds
-            if video["channel"] in TF1_CHANNELS
-            else safe_env_base,
-        )
-        _, _ = launch.communicate(input=record_script.encode())
-
-    if launch.returncode != 0:
-        logger.error(
-            "Recording command failed for video %s on channel %s",
-            video["title"],
-            video["channel"],
-        )
+    submit_jobs(jobs, log_file)
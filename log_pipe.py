@@ -0,0 +1,174 @@
+import codecs
+import gzip
+import logging
+import os
+import re
+import shutil
+import sys
+
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+from security_sanitizer import global_sanitizer
+
+LOGS_DIR = Path.home() / ".local/share/tvselect-fr-live-stream/logs"
+
+READ_SIZE = 64 * 1024
+MAX_PENDING = 256 * 1024
+LOG_MAX_BYTES = 5 * 1024 * 1024  # 5 MB
+LOG_BACKUP_COUNT = 3
+
+# Room kept for the generic "password=..." scrub when a line must be cut.
+GENERIC_OVERLAP = 256
+
+# The generic scrub of security_sanitizer, and a keyword still waiting for
+# its value at the end of a cut.
+GENERIC_RE = re.compile(
+    r"(?i)(?:" + "|".join(map(re.escape, global_sanitizer.GENERIC_SENSITIVE_WORDS))
+    + r")\s*[:=]\s*[^\s,]+"
+)
+DANGLING_RE = re.compile(
+    r"(?i)(?:" + "|".join(map(re.escape, global_sanitizer.GENERIC_SENSITIVE_WORDS))
+    + r")\s*[:=]?\s*$"
+)
+TOKEN_RE = re.compile(r"[^\s,]*")
+
+
+class StreamScrubber:
+    """
+    Incremental scrubber for the raw output of a child process.
+
+    Output is decoded incrementally and only complete lines are scrubbed,
+    so a secret split across two reads is still redacted. A line longer
+    than max_pending is cut outside of any match, keeping back enough
+    characters to match the longest known secret on the next read. When
+    no such cut exists (a value longer than max_pending), the value is
+    redacted up to its end, whatever the reads it spans. Memory stays
+    bounded by max_pending plus one read.
+    """
+
+    def __init__(self, sanitizer=global_sanitizer, max_pending=MAX_PENDING):
+        self.sanitizer = sanitizer
+        self.max_pending = max_pending
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._pending = ""
+        # Dropping the rest of a value already written as [REDACTED].
+        self._redacting = False
+
+    def _overlap(self):
+        longest = max(
+            (len(pattern.pattern) for pattern in self.sanitizer.secret_patterns),
+            default=0,
+        )
+        return longest + GENERIC_OVERLAP
+
+    def _safe_cut(self, text):
+        """Return where text can be cut without splitting a match, or 0."""
+        cut = len(text) - self._overlap()
+        spans = [m.span() for m in GENERIC_RE.finditer(text)]
+        for pattern in self.sanitizer.secret_patterns:
+            spans.extend(m.span() for m in pattern.finditer(text))
+        moved = True
+        while moved and cut > 0:
+            moved = False
+            for start, end in spans:
+                if start < cut < end:
+                    cut, moved = start, True
+            dangling = DANGLING_RE.search(text, 0, cut)
+            if dangling is not None and dangling.start() < cut:
+                cut, moved = dangling.start(), True
+        return max(cut, 0)
+
+    def feed(self, data: bytes) -> str:
+        """Consume raw bytes and return the scrubbed text that is safe to write."""
+        text = self._decoder.decode(data)
+        if self._redacting:
+            skipped = TOKEN_RE.match(text).end()
+            self._redacting = skipped == len(text)
+            text = text[skipped:]
+        self._pending += text
+
+        cut = self._pending.rfind("\n") + 1
+        if not cut and len(self._pending) > self.max_pending:
+            cut = self._safe_cut(self._pending)
+            if not cut:
+                # One value fills the buffer: write it redacted and drop
+                # the rest of it as it comes.
+                ready, self._pending = self._pending, ""
+                self._redacting = True
+                return self.sanitizer._scrub_string(ready)
+
+        if cut <= 0:
+            return ""
+
+        ready, self._pending = self._pending[:cut], self._pending[cut:]
+        return self.sanitizer._scrub_string(ready)
+
+    def flush(self) -> str:
+        """Return whatever is still buffered, scrubbed."""
+        self._pending += self._decoder.decode(b"", final=True)
+        ready, self._pending = self._pending, ""
+        return self.sanitizer._scrub_string(ready)
+
+
+def _gzip_namer(name):
+    return name + ".gz"
+
+
+def _gzip_rotator(source, dest):
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def open_rotating_log(log_path, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+    """Return a size-rotated handler whose backups are gzip-compressed."""
+    handler = RotatingFileHandler(
+        log_path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    handler.terminator = ""
+    handler.namer = _gzip_namer
+    handler.rotator = _gzip_rotator
+    return handler
+
+
+def _write(handler, text):
+    if text:
+        handler.handle(logging.makeLogRecord({"msg": text, "levelno": logging.INFO}))
+
+
+def pump(fd, handler, scrubber=None, read_size=READ_SIZE):
+    """Copy fd to handler until EOF, scrubbing everything on the way."""
+    scrubber = scrubber or StreamScrubber()
+
+    while True:
+        data = os.read(fd, read_size)
+        if not data:
+            break
+        _write(handler, scrubber.feed(data))
+
+    _write(handler, scrubber.flush())
+
+
+def main(argv):
+    if len(argv) != 2 or not re.match(r"^[^/\x00]+$", argv[1]):
+        print("usage: log_pipe.py LOG_NAME", file=sys.stderr)
+        return 2
+
+    global_sanitizer.update_patterns({
+        "TF1_EMAIL": os.environ.get("STREAMLINK_TF1_EMAIL", ""),
+        "TF1_PASSWORD": os.environ.get("STREAMLINK_TF1_PASSWORD", ""),
+    })
+
+    handler = open_rotating_log(LOGS_DIR / f"{argv[1]}.log")
+    try:
+        pump(sys.stdin.fileno(), handler)
+    finally:
+        handler.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
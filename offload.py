@@ -0,0 +1,447 @@
+"""
+Move finished recordings from ~/videos_select to a NAS.
+
+recorder.py feeds every capture to a ChecksumTap, which hashes the bytes
+as they are written and leaves a sha256sum-style sidecar (.sha256) next
+to the recording when the capture ends. A recording is ready to move
+once its sidecar exists and nothing holds the capture flock on it.
+Transcoded recordings (transcode.py) get their sidecar the same way and
+are moved too; the recording they come from waits for its transcode.
+The directories of the accounts (accounts.py) are kept on the target.
+
+The Offloader copies ready recordings to a target directory (a mounted
+share, or any local directory) with a bounded number of transfers at a
+time and a shared rate limit. A transfer goes to a hidden .partial file
+and picks up where it stopped after a crash. The bytes are hashed on the
+way and must match the sidecar. The copy is then renamed, read back from
+the target and checked again before the local files are removed.
+
+With OFFLOAD_TARGET set in config.py the scheduler daemon runs the
+offloader (OFFLOAD_RATE_KBPS and OFFLOAD_CONCURRENCY are optional). It
+can also run on its own:
+
+    offload.py run --target DIR [--rate-kbps N] [--concurrency N] [--once]
+    offload.py status
+"""
+import argparse
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from rolling_output import load_manifest, manifest_path, programme_of_part
+from seek_index import index_path
+
+logger = logging.getLogger("__name__")
+
+RECORDINGS_DIR = Path.home() / "videos_select"
+DATA_DIR = Path.home() / ".local/share/tvselect-fr-live-stream"
+
+CHECKSUM_SUFFIX = ".sha256"
+PARTIAL_PREFIX = "."
+PARTIAL_SUFFIX = ".partial"
+
+RECORDING_PATTERNS = ("*.ts", "*.mkv", "*.mp4")
+
+COPY_CHUNK = 1024 * 1024
+DEFAULT_CONCURRENCY = 2
+SCAN_INTERVAL = 60.0
+
+
+class OffloadError(Exception):
+    pass
+
+
+def checksum_path(recording_path):
+    return str(recording_path) + CHECKSUM_SUFFIX
+
+
+def read_checksum(recording_path):
+    """Return the hex digest recorded for recording_path, or None."""
+    try:
+        with open(checksum_path(recording_path), "r", encoding="utf-8") as f:
+            return f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+
+def write_checksum(recording_path, digest):
+    path = Path(recording_path)
+    tmp = path.with_name(path.name + CHECKSUM_SUFFIX + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(f"{digest}  {path.name}\n")
+    os.replace(tmp, checksum_path(path))
+
+
+class ChecksumTap:
+    """
+    CaptureWriter tap hashing the recording and writing its .sha256 sidecar.
+
+    With resume_from, the first bytes of the recording were written by
+    another process: they are hashed back from disk in a thread, and what
+    is fed meanwhile waits for it.
+    """
+
+    def __init__(self, path, resume_from=0):
+        self.path = Path(path)
+        self._hash = hashlib.sha256()
+        self._prefix = None
+        self._waiting = []
+        if resume_from:
+            self._prefix = threading.Thread(
+                target=self._hash_prefix, args=(resume_from,), name="checksum", daemon=True
+            )
+            self._prefix.start()
+
+    def _hash_prefix(self, length):
+        with open(self.path, "rb") as f:
+            while length:
+                data = f.read(min(COPY_CHUNK, length))
+                if not data:
+                    break
+                self._hash.update(data)
+                length -= len(data)
+
+    def _join_prefix(self):
+        self._prefix.join()
+        self._prefix = None
+        for data in self._waiting:
+            self._hash.update(data)
+        self._waiting = []
+
+    def feed(self, data):
+        if self._prefix is not None:
+            if self._prefix.is_alive():
+                self._waiting.append(data)
+                return
+            self._join_prefix()
+        self._hash.update(data)
+
+    def close(self):
+        if self._prefix is not None:
+            self._join_prefix()
+        write_checksum(self.path, self._hash.hexdigest())
+
+
+class RateLimiter:
+    """Token bucket shared by the transfers; rate in bytes per second, 0 for none."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._allowance = 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # Up to one second of burst.
+            self._allowance = min(self._allowance + (now - self._last) * self.rate, self.rate)
+            self._last = now
+            self._allowance -= amount
+            wait = -self._allowance / self.rate if self._allowance < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+
+def is_finished(path):
+    """A recording is finished when no capture holds its flock."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+
+def _recordings(recordings_dir):
+    # The recordings, and those of the account directories.
+    directory = Path(recordings_dir)
+    paths = []
+    for pattern in RECORDING_PATTERNS:
+        paths += directory.glob(pattern)
+        paths += (
+            path for path in directory.glob("*/" + pattern) if not path.parent.name.startswith(".")
+        )
+    return sorted(paths)
+
+
+def ready_recordings(recordings_dir=RECORDINGS_DIR, hold=None):
+    """Yield the finished recordings; hold(path) keeps a recording back."""
+    for path in _recordings(recordings_dir):
+        if hold is not None and hold(path):
+            continue
+        if os.path.exists(checksum_path(path)) and is_finished(path):
+            yield path
+
+
+def hash_file(path, limiter=None, uncached=False):
+    """
+    Return the sha256 of path. With uncached, the page cache of the file is
+    dropped first, so a network share is read back from the server.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        if uncached:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        while True:
+            data = f.read(COPY_CHUNK)
+            if not data:
+                return digest.hexdigest()
+            if limiter:
+                limiter.consume(len(data))
+            digest.update(data)
+
+
+class Offloader:
+    def __init__(self, target, rate_kbps=0, concurrency=DEFAULT_CONCURRENCY,
+                 recordings_dir=RECORDINGS_DIR, verify=True, hold=None):
+        self.target = Path(target)
+        self.recordings_dir = Path(recordings_dir)
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate_kbps * 1000 / 8)
+        self.verify = verify
+        self.hold = hold
+        # Path -> inode of the recordings being moved.
+        self._in_flight = {}
+        # Inode -> copy on the target of a recording with other links
+        # (accounts.share), which are linked to that copy.
+        self._copies = {}
+        self._lock = threading.Lock()
+
+    def target_dir(self, path):
+        return self.target / path.parent.relative_to(self.recordings_dir)
+
+    def partial_path(self, path):
+        return self.target_dir(path) / f"{PARTIAL_PREFIX}{path.name}{PARTIAL_SUFFIX}"
+
+    def copy(self, path, expected):
+        """Copy path to its .partial file, resuming it, and check the bytes read."""
+        partial = self.partial_path(path)
+        size = path.stat().st_size
+        offset = partial.stat().st_size if partial.exists() else 0
+        if offset > size:
+            partial.unlink()
+            offset = 0
+        elif offset:
+            logger.info("Resuming the offload of %s at byte %d", path.name, offset)
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as src, open(partial, "ab") as dst:
+            # The bytes already copied still count in the checksum.
+            remaining = offset
+            while remaining:
+                data = src.read(min(COPY_CHUNK, remaining))
+                if not data:
+                    break
+                digest.update(data)
+                remaining -= len(data)
+
+            while True:
+                data = src.read(COPY_CHUNK)
+                if not data:
+                    break
+                self.limiter.consume(len(data))
+                dst.write(data)
+                digest.update(data)
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        if digest.hexdigest() != expected:
+            partial.unlink(missing_ok=True)
+            raise OffloadError(f"{path.name} does not match its checksum, kept locally")
+        return partial
+
+    def offload(self, path):
+        """Move one finished recording to the target; return True once it is gone locally."""
+        expected = read_checksum(path)
+        if expected is None:
+            raise OffloadError(f"{path.name} has no checksum")
+        target = self.target_dir(path)
+        target.mkdir(parents=True, exist_ok=True)
+        dest = target / path.name
+        stat = path.stat()
+        inode = (stat.st_dev, stat.st_ino)
+
+        if dest.exists():
+            if hash_file(dest) != expected:
+                raise OffloadError(f"{dest} already exists with other content")
+            logger.info("%s is already on the target", path.name)
+        elif self._link_copy(inode, dest):
+            logger.info("Offloaded %s as a link to its copy for another account", path.name)
+        else:
+            start = time.monotonic()
+            partial = self.copy(path, expected)
+            os.replace(partial, dest)
+            if self.verify and hash_file(dest, self.limiter, uncached=True) != expected:
+                dest.unlink(missing_ok=True)
+                raise OffloadError(f"The copy of {path.name} on the target is corrupt")
+            elapsed = time.monotonic() - start
+            logger.info(
+                "Offloaded %s (%d bytes in %.0fs, %.1f MB/s)",
+                path.name,
+                dest.stat().st_size,
+                elapsed,
+                dest.stat().st_size / max(elapsed, 1e-3) / 1e6,
+            )
+
+        for sidecar in (index_path(path), checksum_path(path)):
+            if os.path.exists(sidecar):
+                shutil.copyfile(sidecar, target / Path(sidecar).name)
+        with self._lock:
+            if stat.st_nlink > 1:
+                self._copies[inode] = dest
+            else:
+                self._copies.pop(inode, None)
+        for local in (path, index_path(path), checksum_path(path)):
+            Path(local).unlink(missing_ok=True)
+        self._move_manifest(path)
+        return True
+
+    def _link_copy(self, inode, dest):
+        with self._lock:
+            copy = self._copies.get(inode)
+        if copy is None:
+            return False
+        try:
+            os.link(copy, dest)
+        except OSError:
+            # Gone from the target, or no hard links there: copy again.
+            return False
+        return True
+
+    def _move_manifest(self, part):
+        # The manifest of a rolled recording follows its parts; the local
+        # copy goes once the capture is over and every part has moved.
+        output = programme_of_part(part)
+        if output is None:
+            return
+        manifest = manifest_path(output)
+        with self._lock:
+            if not manifest.exists():
+                # Another part finished last and took it away.
+                return
+            shutil.copyfile(manifest, self.target_dir(part) / manifest.name)
+            content = load_manifest(output)
+            if content and content["complete"] and not any(
+                output.with_name(entry["file"]).exists() for entry in content["parts"]
+            ):
+                manifest.unlink(missing_ok=True)
+
+    def _offload(self, path):
+        try:
+            return self.offload(path)
+        except (OSError, OffloadError) as e:
+            logger.error("Offload of %s failed: %s", path.name, e)
+            return False
+        finally:
+            with self._lock:
+                self._in_flight.pop(path, None)
+
+    def run_once(self, pool):
+        """Queue every ready recording not being moved yet; return the futures."""
+        futures = []
+        for path in ready_recordings(self.recordings_dir, self.hold):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            inode = (stat.st_dev, stat.st_ino)
+            with self._lock:
+                # Links of one recording go one after the other, so
+                # the later ones are linked to the first copy.
+                if path in self._in_flight or inode in self._in_flight.values():
+                    continue
+                self._in_flight[path] = inode
+            futures.append(pool.submit(self._offload, path))
+        return futures
+
+    def run(self, stop, interval=SCAN_INTERVAL):
+        DATA_DIR.mkdir(parents=True, exist_ok=True)
+        lock = open(DATA_DIR / ".offload.lock", "w")
+        try:
+            # A single offloader per box, whichever process started first.
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return
+        try:
+            self.target.mkdir(parents=True, exist_ok=True)
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                while not stop.is_set():
+                    try:
+                        self.run_once(pool)
+                    except OSError:
+                        logger.warning("Cannot scan %s", self.recordings_dir, exc_info=True)
+                    stop.wait(interval)
+        finally:
+            lock.close()
+
+
+def start_offloader(target, rate_kbps=0, concurrency=DEFAULT_CONCURRENCY, stop=None, hold=None):
+    """Run an Offloader in a daemon thread; return the event stopping it."""
+    stop = stop or threading.Event()
+    offloader = Offloader(target, rate_kbps, concurrency, hold=hold)
+    thread = threading.Thread(target=offloader.run, args=(stop,), name="offload", daemon=True)
+    thread.start()
+    return stop
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move finished recordings to a NAS.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="offload the finished recordings")
+    run.add_argument("--target", required=True, help="directory or mount point on the NAS")
+    run.add_argument("--rate-kbps", type=int, default=0, help="0 for no limit")
+    run.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    run.add_argument("--no-verify", action="store_true", help="do not read the copy back")
+    run.add_argument("--once", action="store_true", help="move what is ready and exit")
+    sub.add_parser("status", help="list the recordings waiting to be moved")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.command == "status":
+        for path in _recordings(RECORDINGS_DIR):
+            if not os.path.exists(checksum_path(path)):
+                state = "no checksum"
+            elif is_finished(path):
+                state = "ready"
+            else:
+                state = "recording"
+            print(f"{path.relative_to(RECORDINGS_DIR)}: {path.stat().st_size} bytes, {state}")
+        return 0
+
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    offloader = Offloader(args.target, args.rate_kbps, args.concurrency, verify=not args.no_verify)
+    if not args.once:
+        try:
+            offloader.run(threading.Event())
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    offloader.target.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = [future.result() for future in offloader.run_once(pool)]
+    print(f"{sum(results)}/{len(results)} recordings offloaded")
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,334 @@
+import json
+import logging
+import requests
+import shlex
+import subprocess
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from tracing import SCHEDULED_ENV, span, start_span
+
+logger = logging.getLogger("__name__")
+
+VENV_ACTIVATE = ". $HOME/.local/share/tvselect-fr-live-stream/.venv/bin/activate "
+
+RECORDER = "$HOME/tvselect-fr-live-stream/recorder.py"
+LOG_PIPE = "$HOME/tvselect-fr-live-stream/log_pipe.py"
+
+TF1_PURGE_URL = "https://www.tf1.fr/tf1/direct"
+
+MAX_SUBMIT_WORKERS = 4
+
+
+def subtract_one_minute(time_str: str) -> str:
+    dt = datetime.strptime(time_str, "%H:%M")
+    dt -= timedelta(minutes=1)
+    return dt.strftime("%H:%M")
+
+
+def fetch_schedule(api_url, email, password, dest, session=None):
+    """
+    Fetch the selected programmes from TV-Select and write them to dest.
+
+    session is a requests.Session whose connections are reused.
+    """
+
+    try:
+        response = (session or requests).get(api_url,
+                                auth=(email, password),
+                                headers={"Accept": "application/json; indent=4"},
+                                timeout=5
+                            )
+        response.raise_for_status()
+    except Exception:
+        logger.exception("API request failed")
+        return False
+
+    try:
+        data = response.json()
+    except Exception:
+        logger.exception("Invalid JSON received from API")
+        return False
+
+    try:
+        with open(dest, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+    except Exception:
+        logger.exception("Failed to write info_progs.json")
+        return False
+
+    return True
+
+
+class AtStep:
+    """One script handed to `at` for execution at a given time."""
+
+    def __init__(self, kind, when, script, env):
+        self.kind = kind
+        self.when = when
+        self.script = script
+        self.env = env
+
+
+class AtJob:
+    """
+    All the `at` submissions needed to record one programme.
+
+    Steps are submitted in order and a failed step cancels the remaining
+    ones, so a TF1 recording is never queued without its credential purge.
+    """
+
+    def __init__(self, title, channel, steps):
+        self.title = title
+        self.channel = channel
+        self.steps = steps
+        self.failed_step = None
+        self.returncode = 0
+        self.output = b""
+        self.elapsed = 0.0
+
+
+class AtBackend:
+    """Submit steps with the `at` command."""
+
+    def submit(self, step):
+        result = subprocess.run(
+            ["at", step.when],
+            input=step.script.encode(),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=step.env,
+        )
+        return result.returncode, result.stdout
+
+
+class ImmediateBackend:
+    """
+    Run the steps now instead of handing them to `at`, for recordings asked
+    for on the spot. A TF1 purge runs to completion before the recording,
+    which is started detached from the caller.
+    """
+
+    def submit(self, step):
+        env = {**step.env, SCHEDULED_ENV: str(time.time())}
+        command = ["/bin/sh", "-c", step.script]
+        try:
+            if step.kind != "record":
+                result = subprocess.run(
+                    command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=60
+                )
+                return result.returncode, result.stdout
+            subprocess.Popen(
+                command,
+                env=env,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            return 1, f"{step.kind} could not run: {e}\n".encode()
+        return 0, b""
+
+
+def build_record_script(programme, extra_streamlink_args="", policy=None, roll_minutes=0):
+    """Return the shell script recording one programme with recorder.py."""
+    safe_output = shlex.quote(programme.filename)
+    # Programmes of the merged schedule of several accounts (accounts.py).
+    accounts = programme.get("accounts") or []
+    output_dir = "\"$HOME\"/videos_select" + "".join(f"/{shlex.quote(name)}" for name in accounts[:1])
+    share_flags = "".join(
+        f"--share-with \"$HOME\"/videos_select/{shlex.quote(name)} " for name in accounts[1:]
+    )
+    safe_duration = shlex.quote(programme.duration)
+    safe_url = shlex.quote(programme.channel_url)
+
+    tf1_flag = "--tf1 " if programme.tf1 else ""
+    roll_flag = f"--roll-minutes {shlex.quote(str(roll_minutes))} " if roll_minutes else ""
+    policy_flags = "".join(
+        shlex.quote(arg) + " " for arg in (policy.to_args() if policy else [])
+    )
+
+    return (
+        VENV_ACTIVATE +
+        f"&& python3 {RECORDER} --duration {safe_duration} "
+        f"--output {output_dir}/{safe_output} "
+        f"{tf1_flag}{roll_flag}{share_flags}{policy_flags}{safe_url} best "
+        "--hls-live-edge 5 "
+        f"{extra_streamlink_args}"
+        f"2>&1 | python3 {LOG_PIPE} "
+        f"{shlex.quote('record_' + programme.title_short)}"
+    )
+
+
+def build_purge_script():
+    """Return the shell script purging the cached TF1 session."""
+    return (
+        VENV_ACTIVATE +
+        "&& streamlink --tf1-purge-credentials "
+        "--tf1-email \"$STREAMLINK_TF1_EMAIL\" "
+        "--tf1-password \"$STREAMLINK_TF1_PASSWORD\" "
+        f"{TF1_PURGE_URL}"
+    )
+
+
+def build_jobs(programmes, can_process_tf1, safe_env, tf1_env,
+               extra_streamlink_args="", policies=None, roll_minutes=0):
+    """
+    Turn the Programme records of info_progs.json into a list of AtJob.
+
+    policies is a rendition_policy.PolicySet choosing the rendition of
+    each programme; without it every programme is recorded at "best".
+    With roll_minutes, recordings are split in parts of that length.
+
+    TF1 programmes that cannot be recorded are logged and left out.
+    """
+    with span("planner.build", programmes=len(programmes)) as build_span:
+        jobs = _build_jobs(
+            programmes, can_process_tf1, safe_env, tf1_env,
+            extra_streamlink_args, policies, roll_minutes,
+        )
+        build_span.set(jobs=len(jobs))
+    return jobs
+
+
+def _build_jobs(programmes, can_process_tf1, safe_env, tf1_env,
+                extra_streamlink_args, policies, roll_minutes):
+    jobs = []
+
+    for programme in programmes:
+        steps = []
+
+        if programme.tf1:
+            if not can_process_tf1(programme.channel):
+                logger.error(
+                    f"The video {programme.title_short}_{shlex.quote(programme.channel_slug)}.ts "
+                    "cannot be recorded because of TF1 missing credentials."
+                )
+                continue
+
+            steps.append(
+                AtStep(
+                    "purge",
+                    subtract_one_minute(programme.start),
+                    build_purge_script(),
+                    tf1_env,
+                )
+            )
+            record_env = tf1_env
+        else:
+            record_env = safe_env
+
+        steps.append(
+            AtStep(
+                "record",
+                programme.start,
+                build_record_script(
+                    programme,
+                    extra_streamlink_args,
+                    policies.resolve(programme) if policies else None,
+                    roll_minutes,
+                ),
+                record_env,
+            )
+        )
+
+        jobs.append(AtJob(programme.title, programme.channel, steps))
+
+    return jobs
+
+
+def scheduled_at(when, now=None):
+    """Return the epoch at which `at` runs a job given as HH:MM."""
+    now = now or datetime.now()
+    hour, minute = map(int, when.split(":"))
+    due = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if due <= now:
+        due += timedelta(days=1)
+    return due.timestamp()
+
+
+def _submit_job(job, backend, parent=None):
+    start = time.monotonic()
+    outputs = []
+    job_span = start_span("planner.at_job", parent, channel=job.channel, steps=len(job.steps))
+
+    for step in job.steps:
+        # at exports the submission environment into the job, so the
+        # recorder joins this trace when it runs.
+        traced = AtStep(step.kind, step.when, step.script, {
+            **step.env,
+            **job_span.env(),
+            SCHEDULED_ENV: str(scheduled_at(step.when)),
+        })
+        returncode, output = backend.submit(traced)
+        if output:
+            outputs.append(output)
+        if returncode != 0:
+            job.failed_step = step.kind
+            job.returncode = returncode
+            job_span.error = f"{step.kind} failed"
+            break
+
+    job.output = b"".join(outputs)
+    job.elapsed = time.monotonic() - start
+    job_span.end(job.elapsed)
+    return job
+
+
+class SubmissionReport:
+    """Aggregate timing and failures of one planner run."""
+
+    def __init__(self, jobs, elapsed):
+        self.jobs = jobs
+        self.elapsed = elapsed
+        self.failed = [job for job in jobs if job.failed_step]
+
+    def log(self):
+        for job in self.failed:
+            if job.failed_step == "purge":
+                logger.error("TF1 purge command failed for channel %s", job.channel)
+            else:
+                logger.error(
+                    "Recording command failed for video %s on channel %s",
+                    job.title,
+                    job.channel,
+                )
+
+        slowest = max((job.elapsed for job in self.jobs), default=0.0)
+        logger.info(
+            "Submitted %d/%d recordings in %.2fs (slowest job %.2fs, %d failed).",
+            len(self.jobs) - len(self.failed),
+            len(self.jobs),
+            self.elapsed,
+            slowest,
+            len(self.failed),
+        )
+
+
+def submit_jobs(jobs, log_file, backend=None, max_workers=MAX_SUBMIT_WORKERS):
+    """
+    Submit every job through a bounded worker pool.
+
+    The output of `at` is collected per job and appended to log_file in a
+    single write once all submissions are done.
+    """
+    backend = backend or AtBackend()
+    start = time.monotonic()
+
+    with span("planner.submit", jobs=len(jobs)) as submit_span:
+        if jobs:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                list(pool.map(lambda job: _submit_job(job, backend, submit_span), jobs))
+
+    report = SubmissionReport(jobs, time.monotonic() - start)
+
+    outputs = [job.output for job in jobs if job.output]
+    if outputs and log_file:
+        with open(log_file, "ab") as log:
+            log.write(b"".join(outputs))
+
+    report.log()
+    return report
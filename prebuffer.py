@@ -0,0 +1,430 @@
+"""
+Rolling pre-buffer of the channels about to be recorded.
+
+Programmes often start a minute or two before their published time.
+With PREBUFFER_MINUTES set in config.py, the scheduler daemon starts
+watching a channel shortly before each of its recordings, runs streamlink
+at the rendition the recorder will ask for, and keeps the last
+PREBUFFER_MINUTES of the stream in memory. When the recorder starts it
+connects to ~/.local/share/tvselect-fr-live-stream/prebuffer.sock. It
+gets the buffered stream from its oldest keyframe, then the live stream,
+so the recording begins before the scheduled time with no gap and no
+repeat. A channel is dropped once no recording is due and nobody reads it.
+A hot upgrade of the scheduler waits until no recorder reads the
+pre-buffer, then stops it; the new scheduler starts it again.
+
+Memory is bounded by PREBUFFER_MAX_MB (default 256) for all the channels
+together. At most PREBUFFER_MAX_CHANNELS (default 2) channels are watched
+at a time, each with an equal share of the budget. Readers are sent the
+buffered chunks themselves, never copies: a reader falling a whole buffer
+behind is dropped. The budget and its use are in the control API status,
+and in
+
+    prebuffer.py status
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import sys
+import time
+
+from collections import deque
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from seek_index import TS_PACKET_SIZE, KeyframeScanner
+
+logger = logging.getLogger("__name__")
+
+DATA_DIR = Path.home() / ".local/share/tvselect-fr-live-stream"
+PREBUFFER_SOCKET = DATA_DIR / "prebuffer.sock"
+
+DEFAULT_MAX_MB = 256
+DEFAULT_MAX_CHANNELS = 2
+# Watching starts this long before the buffer must be full.
+LEAD_MARGIN = 60.0
+# A recorder starts at most this long after its programme.
+START_GRACE = 120.0
+PLAN_INTERVAL = 20.0
+RETRY_DELAY = 10.0
+READ_SIZE = 256 * 1024
+CONNECT_TIMEOUT = 5.0
+
+
+def prebuffer_socket_path():
+    return Path(os.environ.get("TVSELECT_PREBUFFER_SOCKET", PREBUFFER_SOCKET))
+
+
+def next_start(start, now=None):
+    """Return the epoch of a programme starting at HH:MM, today unless long gone."""
+    now = now or datetime.now()
+    hour, minute = map(int, start.split(":"))
+    due = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if due.timestamp() < now.timestamp() - START_GRACE:
+        due += timedelta(days=1)
+    return due.timestamp()
+
+
+class Evicted(Exception):
+    """The chunk a reader wants is no longer buffered."""
+
+
+class StreamRing:
+    """
+    The last seconds of a stream, at most max_bytes, as a deque of the
+    chunks read from streamlink. Keyframes are located as chunks come in,
+    so a reader can start on one.
+    """
+
+    def __init__(self, seconds, max_bytes):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.next_seq = 0
+        self.offset = 0
+        self._chunks = deque()
+        self._keyframes = deque()
+        self._scanner = KeyframeScanner()
+        self._carry = b""
+
+    def append(self, data, now):
+        buffer = self._carry + data if self._carry else data
+        base = self.offset - len(self._carry)
+        end = len(buffer) - len(buffer) % TS_PACKET_SIZE
+        for _, offset in self._scanner.scan(buffer[:end], base):
+            self._keyframes.append(offset)
+        self._carry = buffer[end:]
+
+        self._chunks.append((self.next_seq, self.offset, now, data))
+        self.next_seq += 1
+        self.offset += len(data)
+        self.size += len(data)
+
+        while self._chunks and (
+            self.size > self.max_bytes or now - self._chunks[0][2] > self.seconds
+        ):
+            self.size -= len(self._chunks.popleft()[3])
+        first = self._chunks[0][1] if self._chunks else self.offset
+        while self._keyframes and self._keyframes[0] < first:
+            self._keyframes.popleft()
+
+    def buffered_seconds(self, now):
+        try:
+            return now - self._chunks[0][2]
+        except IndexError:
+            return 0.0
+
+    def start(self):
+        """
+        Return (seq, skip, header) where a new reader starts: the oldest
+        keyframe, or None while none is buffered (chunks are not packet
+        aligned, a reader must start on a packet).
+        """
+        if not self._keyframes:
+            return None
+        keyframe = self._keyframes[0]
+        for seq, offset, _, data in self._chunks:
+            if offset <= keyframe < offset + len(data):
+                return seq, keyframe - offset, self._scanner.tables()
+        return None
+
+    def get(self, seq):
+        """Return the chunk seq, None if it is still to come."""
+        if not self._chunks:
+            if seq < self.next_seq:
+                raise Evicted(seq)
+            return None
+        index = seq - self._chunks[0][0]
+        if index < 0:
+            raise Evicted(seq)
+        if index >= len(self._chunks):
+            return None
+        return self._chunks[index][3]
+
+
+class ChannelBuffer:
+    """streamlink feeding a StreamRing, and the readers of that ring."""
+
+    def __init__(self, url, quality, streamlink_args, command, env, seconds, max_bytes):
+        self.url = url
+        self.quality = quality
+        self.streamlink_args = streamlink_args
+        self.command = command
+        self.env = env
+        self.ring = StreamRing(seconds, max_bytes)
+        self.readers = 0
+        self.stopped = False
+        self.process = None
+        self.task = None
+        self.wanted_until = 0.0
+        self._more = asyncio.get_running_loop().create_future()
+
+    def _notify(self):
+        more, self._more = self._more, asyncio.get_running_loop().create_future()
+        more.set_result(None)
+
+    async def run(self):
+        while not self.stopped:
+            try:
+                self.process = await asyncio.create_subprocess_exec(
+                    *self.command,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL,
+                    env=self.env,
+                )
+            except OSError:
+                logger.exception("Cannot pre-buffer %s", self.url)
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+            while True:
+                data = await self.process.stdout.read(READ_SIZE)
+                if not data:
+                    break
+                self.ring.append(data, time.monotonic())
+                self._notify()
+            await self.process.wait()
+            if not self.stopped:
+                logger.warning("Pre-buffering of %s stopped, restarting it", self.url)
+                await asyncio.sleep(RETRY_DELAY)
+        self._notify()
+
+    def stop(self):
+        self.stopped = True
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+
+    async def serve_reader(self, writer, start):
+        """Send the ring from start (given by StreamRing.start()), then the live stream."""
+        seq, skip, header = start
+        self.readers += 1
+        try:
+            if header:
+                writer.write(header)
+            while not writer.is_closing():
+                try:
+                    data = self.ring.get(seq)
+                except Evicted:
+                    logger.warning("A reader of %s fell behind the pre-buffer, dropped", self.url)
+                    return
+                if data is None:
+                    if self.stopped:
+                        return
+                    await self._more
+                    continue
+                writer.write(data[skip:] if skip else data)
+                skip = 0
+                seq += 1
+                await writer.drain()
+        finally:
+            self.readers -= 1
+
+    def status(self, now):
+        return {
+            "url": self.url,
+            "quality": self.quality,
+            "bytes": self.ring.size,
+            "max_bytes": self.ring.max_bytes,
+            "seconds": round(self.ring.buffered_seconds(now), 1),
+            "readers": self.readers,
+        }
+
+
+class PreBuffer:
+    """
+    Watch the channels of the recordings about to start.
+
+    targets() returns (channel_url, policy, tf1, start epoch) for the
+    recordings to come; select(url, policy, tf1) returns the quality and
+    streamlink arguments the recorder will use, and command(url, quality,
+    args, tf1) the streamlink command line.
+    """
+
+    def __init__(self, minutes, targets, select, command, env,
+                 max_mb=DEFAULT_MAX_MB, max_channels=DEFAULT_MAX_CHANNELS):
+        self.seconds = minutes * 60
+        self.targets = targets
+        self.select = select
+        self.command = command
+        self.env = env
+        self.max_bytes = max_mb * 1024 * 1024
+        self.max_channels = max_channels
+        self.channels = {}
+        self.closed = False
+
+    @property
+    def channel_bytes(self):
+        return self.max_bytes // self.max_channels
+
+    async def plan(self):
+        if self.closed:
+            return
+        now = time.time()
+        due = {}
+        for url, policy, tf1, start in await asyncio.to_thread(self.targets):
+            if start - self.seconds - LEAD_MARGIN <= now <= start + START_GRACE:
+                due.setdefault(url, (start, policy, tf1))
+
+        for key, channel in list(self.channels.items()):
+            if channel.url in due:
+                channel.wanted_until = due.pop(channel.url)[0] + START_GRACE
+            elif channel.readers == 0 and now > channel.wanted_until:
+                logger.info("Stopping the pre-buffer of %s", channel.url)
+                channel.stop()
+                del self.channels[key]
+
+        for url, (start, policy, tf1) in sorted(due.items(), key=lambda item: item[1][0]):
+            if len(self.channels) >= self.max_channels:
+                logger.warning("Not pre-buffering %s, %d channels already are", url, len(self.channels))
+                break
+            quality, args = await asyncio.to_thread(self.select, url, policy, tf1)
+            channel = ChannelBuffer(
+                url, quality, args, self.command(url, quality, args, tf1), self.env,
+                self.seconds, self.channel_bytes,
+            )
+            channel.wanted_until = start + START_GRACE
+            channel.task = asyncio.create_task(channel.run())
+            self.channels[(url, quality)] = channel
+            logger.info("Pre-buffering %s at %s for the recording at %s",
+                        url, quality, time.strftime("%H:%M", time.localtime(start)))
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    await self.plan()
+                except Exception:
+                    logger.exception("Pre-buffer planning failed")
+                await asyncio.sleep(PLAN_INTERVAL)
+        finally:
+            for channel in self.channels.values():
+                channel.stop()
+
+    def reading(self):
+        """Whether a recorder reads one of the channels."""
+        return any(channel.readers for channel in self.channels.values())
+
+    async def close(self):
+        """
+        Stop every channel and reap its streamlink; no recorder must be
+        reading (see reading()). New readers are refused from then on.
+        """
+        self.closed = True
+        channels = list(self.channels.values())
+        self.channels.clear()
+        for channel in channels:
+            channel.stop()
+        await asyncio.gather(
+            *(channel.task for channel in channels if channel.task is not None),
+            return_exceptions=True,
+        )
+
+    def status(self):
+        now = time.monotonic()
+        channels = [channel.status(now) for channel in list(self.channels.values())]
+        return {
+            "max_bytes": self.max_bytes,
+            "bytes": sum(channel["bytes"] for channel in channels),
+            "channels": channels,
+        }
+
+    async def _serve_client(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+            if request.get("command") == "status":
+                writer.write((json.dumps(self.status()) + "\n").encode())
+                return
+            channel = self.channels.get((request.get("url"), request.get("quality")))
+            start = channel.ring.start() if channel is not None and not self.closed else None
+            if start is None:
+                writer.write(b'{"ok": false}\n')
+                return
+            answer = {"ok": True, "seconds": round(channel.ring.buffered_seconds(time.monotonic()), 1)}
+            writer.write((json.dumps(answer) + "\n").encode())
+            await channel.serve_reader(writer, start)
+        except (ValueError, AttributeError):
+            writer.write(b'{"ok": false}\n')
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, path=None):
+        """Serve the readers on the Unix socket path while planning."""
+        path = Path(path or prebuffer_socket_path())
+        path.unlink(missing_ok=True)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        old_umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self._serve_client, path=str(path))
+        finally:
+            os.umask(old_umask)
+        logger.info("Pre-buffering %d minutes in at most %d MB",
+                    self.seconds // 60, self.max_bytes // (1024 * 1024))
+        try:
+            await self.run()
+        finally:
+            server.close()
+            path.unlink(missing_ok=True)
+
+
+def open_prebuffer(url, quality, path=None, timeout=CONNECT_TIMEOUT):
+    """
+    Return a socket streaming the pre-buffered url at quality, and the
+    seconds buffered, or None when that channel is not pre-buffered.
+    """
+    path = Path(path or prebuffer_socket_path())
+    if not path.exists():
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(timeout)
+        client.connect(str(path))
+        client.sendall((json.dumps({"url": url, "quality": quality}) + "\n").encode())
+        line = b""
+        # Byte by byte: the stream follows the answer.
+        while not line.endswith(b"\n"):
+            byte = client.recv(1)
+            if not byte:
+                raise ConnectionError("no answer")
+            line += byte
+        answer = json.loads(line)
+    except (OSError, ValueError):
+        client.close()
+        return None
+    if not answer.get("ok"):
+        client.close()
+        return None
+    client.settimeout(None)
+    return client, answer["seconds"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-buffer of the channels to record.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status", help="memory use of the pre-buffer")
+    parser.parse_args(argv)
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(CONNECT_TIMEOUT)
+            client.connect(str(prebuffer_socket_path()))
+            client.sendall(b'{"command": "status"}\n')
+            with client.makefile("r", encoding="utf-8") as answer:
+                status = json.loads(answer.readline())
+    except (OSError, ValueError) as e:
+        print(f"The pre-buffer is not running: {e}")
+        return 1
+
+    print(f"{status['bytes'] / 1e6:.1f} MB used of {status['max_bytes'] / 1e6:.1f} MB")
+    for channel in status["channels"]:
+        print(f"  {channel['url']} ({channel['quality']}): {channel['seconds']:.0f}s, "
+              f"{channel['bytes'] / 1e6:.1f}/{channel['max_bytes'] / 1e6:.1f} MB, "
+              f"{channel['readers']} readers")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""
+Opt-in local profiling, nothing leaves the box.
+
+A Profiler samples the Python stacks of every thread at a fixed rate and
+takes tracemalloc snapshots at intervals. Stacks are dumped in the
+collapsed format flamegraph tools read; each memory snapshot appends the
+allocation sites that grew most since profiling started. Everything goes
+to logs/profiles.
+
+install() starts profiling at once when PROFILING = True is set in
+config.py (or TVSELECT_PROFILE=1 is in the environment), and lets SIGUSR1
+toggle it on a running process:
+
+    kill -USR1 <pid>    # start; send again to stop and write the stacks
+"""
+import atexit
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+from app_logging import LOGS_DIR
+
+logger = logging.getLogger("__name__")
+
+PROFILE_DIR = LOGS_DIR / "profiles"
+CONFIG_DIR = Path.home() / ".config/tvselect-fr-live-stream"
+
+SAMPLE_INTERVAL = 0.02
+SNAPSHOT_INTERVAL = 300.0
+TRACEMALLOC_FRAMES = 10
+TOP_ALLOCATIONS = 25
+
+
+def enabled_in_config():
+    if os.environ.get("TVSELECT_PROFILE") == "1":
+        return True
+    if str(CONFIG_DIR) not in sys.path:
+        sys.path.append(str(CONFIG_DIR))
+    try:
+        from config import PROFILING
+    except ImportError:
+        return False
+    return bool(PROFILING)
+
+
+def _collapse(frame):
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{Path(code.co_filename).name}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+
+class Profiler:
+    def __init__(self, name, sample_interval=SAMPLE_INTERVAL,
+                 snapshot_interval=SNAPSHOT_INTERVAL, directory=PROFILE_DIR):
+        self.name = name
+        self.sample_interval = sample_interval
+        self.snapshot_interval = snapshot_interval
+        self.directory = Path(directory)
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._baseline = None
+        self._started_tracemalloc = False
+        self._prefix = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self.running:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        self._prefix = self.directory / f"{self.name}-{os.getpid()}-{stamp}"
+        self.stacks.clear()
+        self.samples = 0
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._started_tracemalloc = True
+        self._baseline = tracemalloc.take_snapshot()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        logger.info("Profiling started, writing to %s.*", self._prefix)
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.snapshot()
+        self.dump_stacks()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        logger.info("Profiling stopped after %d samples", self.samples)
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def _run(self):
+        me = threading.get_ident()
+        next_snapshot = time.monotonic() + self.snapshot_interval
+        while not self._stop.wait(self.sample_interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self.stacks[_collapse(frame)] += 1
+            self.samples += 1
+            if time.monotonic() >= next_snapshot:
+                self.snapshot()
+                next_snapshot += self.snapshot_interval
+
+    def snapshot(self):
+        """Append the allocation sites that grew most since start."""
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        current, peak = tracemalloc.get_traced_memory()
+        top = snapshot.compare_to(self._baseline, "lineno")[:TOP_ALLOCATIONS]
+        with open(str(self._prefix) + ".memory.txt", "a", encoding="utf-8") as f:
+            f.write(
+                f"== {datetime.now().isoformat(timespec='seconds')} "
+                f"traced={current / 1024:.0f}KiB peak={peak / 1024:.0f}KiB\n"
+            )
+            for stat in top:
+                f.write(f"{stat}\n")
+            f.write("\n")
+
+    def dump_json(self, suffix, data):
+        path = f"{self._prefix}.{suffix}.json"
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+        return path
+
+    def dump_stacks(self):
+        path = str(self._prefix) + ".stacks"
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+def install(name, enabled=None):
+    """
+    Set up profiling for this process: start it if enabled (by default,
+    from the config) and toggle it on SIGUSR1. Must run in the main thread.
+    """
+    profiler = Profiler(name)
+    signal.signal(signal.SIGUSR1, lambda *_: profiler.toggle())
+    atexit.register(profiler.stop)
+    if enabled_in_config() if enabled is None else enabled:
+        profiler.start()
+    return profiler
+
+
+class CaptureTiming:
+    """
+    Where a capture spends its time: waiting for data, on disk, in taps,
+    and how full its buffer got while the disk was slow.
+    """
+
+    def __init__(self):
+        self.read_wait = 0.0
+        self.disk_write = 0.0
+        # Longest block write (with its fsync), and the buffer in front.
+        self.max_write = 0.0
+        self.buffer_size = 0
+        self.buffer_peak = 0
+        self.backpressure_wait = 0.0
+        self.backpressure_events = 0
+        self.taps = Counter()
+        self.reads = 0
+        self.blocks = 0
+        self.started = time.monotonic()
+
+    def as_dict(self):
+        return {
+            "elapsed": round(time.monotonic() - self.started, 3),
+            "read_wait": round(self.read_wait, 3),
+            "disk_write": round(self.disk_write, 3),
+            "taps": {name: round(t, 3) for name, t in self.taps.items()},
+            "reads": self.reads,
+            "blocks": self.blocks,
+            "max_write": round(self.max_write, 3),
+            "buffer_size": self.buffer_size,
+            "buffer_peak": self.buffer_peak,
+            "backpressure_wait": round(self.backpressure_wait, 3),
+            "backpressure_events": self.backpressure_events,
+        }
+
+    def describe(self):
+        d = self.as_dict()
+        taps = " ".join(f"{name}={t:.2f}s" for name, t in d["taps"].items())
+        return (
+            f"elapsed={d['elapsed']:.1f}s read_wait={d['read_wait']:.1f}s "
+            f"disk_write={d['disk_write']:.2f}s over {d['blocks']} blocks "
+            f"max_write={d['max_write']:.2f}s "
+            f"buffer_peak={d['buffer_peak'] // 1024}/{d['buffer_size'] // 1024}KiB "
+            f"backpressure={d['backpressure_wait']:.2f}s in {d['backpressure_events']} {taps}"
+        )
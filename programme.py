@@ -0,0 +1,226 @@
+"""
+Programme records loaded from info_progs.json.
+
+Every entry is validated once when the file is loaded. The file name,
+channel slug and stream URL are computed at that point, so the planner
+never touches the raw dicts again. The file is parsed one entry at a
+time, and every invalid entry is reported in a single log message.
+"""
+import json
+import logging
+import re
+
+logger = logging.getLogger("__name__")
+
+TF1_CHANNELS = ["TF1", "TMC", "TFX", "TF1 Séries Films", "L'Equipe"]
+
+# Shell metacharacters and other dangerous characters; accents and
+# international characters are kept.
+DANGEROUS_CHARS = ";|`\\\n\r><&$*?()[]{}\"'!#%^~\x00"
+FILENAME_TABLE = str.maketrans({char: "_" for char in DANGEROUS_CHARS})
+CHANNEL_TABLE = str.maketrans({"'": "-", " ": "_"})
+
+START_RE = re.compile(r"([01]\d|2[0-3]):[0-5]\d")
+DURATION_RE = re.compile(r"\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*")
+DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+READ_CHUNK = 64 * 1024
+BLANK_RE = re.compile(r"\s*")
+
+
+def parse_duration(value):
+    """Parse a duration the way timeout(1) does: a number with an optional s/m/h/d suffix."""
+    match = DURATION_RE.fullmatch(str(value))
+    if not match:
+        raise ValueError(f"Invalid duration: {value!r}")
+    return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def sanitize_filename(name):
+    """
+    Sanitize filename while preserving accents and international characters.
+    Only removes shell metacharacters and dangerous characters.
+    """
+    return name.translate(FILENAME_TABLE)
+
+
+def short_title(title):
+    raw_title = sanitize_filename(title)
+    return raw_title[:-3] if len(raw_title) > 3 else raw_title
+
+
+def channel_slug(channel):
+    return channel.translate(CHANNEL_TABLE)
+
+
+def output_name(video):
+    """Return the file name, in ~/videos_select, of a programme's recording."""
+    return f"{short_title(video['title'])}_{channel_slug(video['channel'])}.ts"
+
+
+def programme_id(video):
+    """Return a key identifying a programme across schedule reloads."""
+    return f"{video['channel']}|{video['start']}|{video['title']}"
+
+
+class InvalidProgramme(ValueError):
+    pass
+
+
+class Programme:
+    """One validated entry of info_progs.json."""
+
+    __slots__ = (
+        "channel", "title", "start", "duration", "seconds", "channel_url", "tf1",
+        "title_short", "channel_slug", "filename", "id", "fields",
+    )
+
+    def __init__(self, channel: str, title: str, start: str, duration: str,
+                 channel_url: str, fields: dict = None, seconds: float = None):
+        self.channel = channel
+        self.title = title
+        self.start = start
+        self.duration = duration
+        self.seconds = parse_duration(duration) if seconds is None else seconds
+        self.channel_url = channel_url
+        self.tf1 = channel in TF1_CHANNELS
+        self.title_short = short_title(title)
+        self.channel_slug = channel_slug(channel)
+        self.filename = f"{self.title_short}_{self.channel_slug}.ts"
+        self.id = f"{channel}|{start}|{title}"
+        self.fields = fields or {}
+
+    @classmethod
+    def from_dict(cls, entry, channels_url):
+        """Validate one raw entry; raise InvalidProgramme with every problem found."""
+        if not isinstance(entry, dict):
+            raise InvalidProgramme("not an object")
+
+        problems = []
+        for key in ("channel", "title", "start"):
+            if not isinstance(entry.get(key), str) or not entry.get(key):
+                problems.append(f"missing or invalid '{key}'")
+        if isinstance(entry.get("start"), str) and not START_RE.fullmatch(entry["start"]):
+            problems.append(f"invalid start {entry['start']!r}")
+
+        duration = entry.get("duration")
+        match = None
+        if isinstance(duration, bool) or not isinstance(duration, (str, int, float)):
+            problems.append("missing or invalid 'duration'")
+        else:
+            duration = str(duration)
+            match = DURATION_RE.fullmatch(duration)
+            if not match:
+                problems.append(f"invalid duration {duration!r}")
+
+        channel = entry.get("channel")
+        if isinstance(channel, str) and channel and channel not in channels_url:
+            problems.append(
+                f"La chaine {channel} n'est pas présente dans le fichier channels_urls.py"
+            )
+
+        if problems:
+            raise InvalidProgramme(", ".join(problems))
+
+        return cls(
+            channel, entry["title"], entry["start"], duration, channels_url[channel], entry,
+            float(match.group(1)) * DURATION_UNITS[match.group(2)],
+        )
+
+    def get(self, field, default=None):
+        """Look a field of the original entry up, like the raw dict did."""
+        return self.fields.get(field, default)
+
+    def __getitem__(self, field):
+        return self.fields[field]
+
+    def __repr__(self):
+        return f"Programme({self.channel!r}, {self.title!r}, {self.start!r}, {self.duration!r})"
+
+
+def iter_json_array(f, chunk_size=READ_CHUNK):
+    """
+    Yield the items of the top-level JSON array in the text file f
+    without holding the whole document in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = f.read(chunk_size)
+    eof = not buffer
+    pos = 0
+
+    def fill():
+        nonlocal buffer, pos, eof
+        more = f.read(chunk_size)
+        eof = not more
+        buffer = buffer[pos:] + more
+        pos = 0
+
+    def skip_blank():
+        nonlocal pos
+        while True:
+            pos = BLANK_RE.match(buffer, pos).end()
+            if pos < len(buffer) or eof:
+                return
+            fill()
+
+    skip_blank()
+    if pos >= len(buffer) or buffer[pos] != "[":
+        raise json.JSONDecodeError("Expecting '['", buffer, pos)
+    pos += 1
+
+    first = True
+    while True:
+        skip_blank()
+        if pos >= len(buffer):
+            raise json.JSONDecodeError("Unterminated array", buffer, pos)
+        if buffer[pos] == "]":
+            return
+        if not first:
+            if buffer[pos] != ",":
+                raise json.JSONDecodeError("Expecting ',' delimiter", buffer, pos)
+            pos += 1
+            skip_blank()
+        first = False
+
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+                continue
+            if end == len(buffer) and not eof:
+                # A number may go on in the next chunk.
+                fill()
+                continue
+            break
+        pos = end
+        yield item
+
+
+def load_programmes(path, channels_url):
+    """
+    Load and validate the programmes of path.
+
+    Returns the valid programmes and the list of problems, one string per
+    rejected entry. json.JSONDecodeError and OSError propagate.
+    """
+    programmes = []
+    errors = []
+    with open(path, "r", encoding="utf-8") as f:
+        for index, entry in enumerate(iter_json_array(f)):
+            try:
+                programmes.append(Programme.from_dict(entry, channels_url))
+            except InvalidProgramme as e:
+                title = entry.get("title") if isinstance(entry, dict) else None
+                errors.append(f"entry {index} ({title!r}): {e}" if title else f"entry {index}: {e}")
+    return programmes, errors
+
+
+def log_invalid(errors, source="info_progs.json"):
+    if errors:
+        logger.error(
+            "%d programmes of %s cannot be recorded:\n%s",
+            len(errors), source, "\n".join(f"  - {e}" for e in errors),
+        )
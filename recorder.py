@@ -0,0 +1,780 @@
+"""
+Record one programme: run streamlink with its output on a pipe and write
+the stream to disk ourselves, so the bytes can be indexed on the way.
+
+Usage (from the at job built by planner.py):
+
+    recorder.py --duration SECONDS --output PATH [--tf1] [--priority P]
+                [--max-height H] [--max-bitrate KBPS] [--audio-only] [--codec C]
+                [--part N --continues PATH] [--roll-minutes N]
+                [--share-with DIR ...] [--buffer-mb N] URL QUALITY [STREAMLINK_ARGS...]
+
+The rendition options come from rendition_policy.py and narrow QUALITY
+down to one variant of the stream. Every capture is kept in the journal
+of capture_journal.py while it runs; --part and --continues are set when
+it resumes an interrupted one. With --roll-minutes the programme is
+written as a series of parts, see rolling_output.py. --share-with links
+every finished file into the directory of another account, see
+accounts.py.
+
+The stream is read into a bounded buffer ahead of the disk writes, so a
+stalled SD card does not stall the download; its size follows the write
+latency measured by the previous captures, see capture_buffer.py.
+
+On SIGHUP the recorder re-execs itself from the installed release and
+goes on with the same capture, see hot_upgrade.py.
+
+When the scheduler pre-buffers the channel (prebuffer.py), the capture
+starts with the buffered minutes and reads the live stream from the
+pre-buffer; the recorder runs streamlink itself if the pre-buffer goes
+away.
+
+Everything printed by streamlink and the recorder goes to stderr, which the
+at job pipes into log_pipe.py.
+"""
+import signal
+
+if __name__ == "__main__":
+    # SIGHUP kills by default: an upgrade while the imports run must not
+    # end the capture before it starts.
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+import argparse
+import ctypes
+import ctypes.util
+import fcntl
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from pathlib import Path
+
+from accounts import ShareTap
+from capture_buffer import CaptureBuffer, buffer_size, record_stall, worst_stall
+from capture_journal import CaptureJournal
+from hot_upgrade import advertise_handover, reexec, take_handover
+from http_pool import enabled as http_pool_enabled, install as install_http_pool
+from offload import ChecksumTap
+from prebuffer import open_prebuffer
+from profiling import CaptureTiming, install as install_profiling
+from programme import parse_duration
+from rendition_policy import CODEC_PREFIXES, RenditionPolicy, choose_variant, list_variants
+from resource_governor import PRIORITIES, Governor, lower_quality
+from rolling_output import RollingWriter
+from seek_index import SeekIndexBuilder, index_path
+from tracing import SCHEDULED_ENV, span, start_span
+
+logger = logging.getLogger("__name__")
+
+READ_SIZE = 256 * 1024
+
+ALIGNMENT = 4096
+BLOCK_SIZE = 4 * 1024 * 1024
+FSYNC_INTERVAL = 30.0
+FLUSH_INTERVAL = 10.0
+FALLOC_FL_KEEP_SIZE = 0x01
+PREALLOCATE_MARGIN = 1.1
+DEFAULT_BITRATE_KBPS = 6000
+AUDIO_BITRATE_KBPS = 192
+
+HTTP_POOL_SCRIPT = str(Path(__file__).with_name("http_pool.py"))
+
+CANCELLED_DIR = Path.home() / ".local/share/tvselect-fr-live-stream/cancelled"
+
+
+def _load_fallocate():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fallocate = libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    return fallocate
+
+
+_fallocate = _load_fallocate()
+
+
+def preallocate(fd, length):
+    """
+    Reserve length bytes for fd without changing its size, so readers of
+    an in-progress recording still see its real length. Returns False
+    when the filesystem cannot do it (vfat on many SD cards, tmpfs...).
+    """
+    if _fallocate is None or length <= 0:
+        return False
+    return _fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, length) == 0
+
+
+def expected_size(duration, bitrate_kbps):
+    return int(duration * bitrate_kbps * 1000 / 8 * PREALLOCATE_MARGIN)
+
+
+class CaptureWriter:
+    """
+    Write the captured stream to its output file and feed every chunk to
+    the taps (objects with feed(data) and close()) listening to it.
+
+    The output is opened exclusively, like streamlink does without --force,
+    and stays flock()ed while the capture runs so readers can tell an
+    in-progress recording from a finished one.
+
+    Small reads from streamlink are coalesced into blocks of block_size
+    bytes written at block-aligned offsets, which SD cards and USB sticks
+    handle far better than a stream of small writes. The file is
+    preallocated to expected_size bytes, fsync()ed every fsync_interval
+    seconds and truncated to what was written on close. Taps only see
+    bytes once they are on disk, so offsets they record are always
+    readable; a block still filling after flush_interval seconds (a low
+    bitrate stream) is written up to its last full page so they do not
+    wait for it.
+
+    fd and bytes_written adopt an output already open, and locked, by the
+    recorder that handed the capture over.
+    """
+
+    def __init__(self, path, taps=(), expected_size=0, block_size=BLOCK_SIZE,
+                 fsync_interval=FSYNC_INTERVAL, fd=None, bytes_written=0,
+                 flush_interval=FLUSH_INTERVAL):
+        if block_size <= 0 or block_size % ALIGNMENT:
+            raise ValueError(f"block_size must be a multiple of {ALIGNMENT}")
+        self.path = path
+        self.taps = list(taps)
+        self.bytes_written = bytes_written
+        self.fsync_interval = fsync_interval
+        self.flush_interval = flush_interval
+        self.timing = CaptureTiming()
+        self._block = bytearray(block_size)
+        self._view = memoryview(self._block)
+        self._filled = 0
+        self._last_sync = time.monotonic()
+        self._last_flush = self._last_sync
+        if fd is not None:
+            self._fd = fd
+            os.set_inheritable(fd, False)
+            return
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        if expected_size and not preallocate(self._fd, expected_size):
+            logger.info("Could not preallocate %d bytes for %s", expected_size, path)
+
+    def write(self, data):
+        data = memoryview(data)
+        while data:
+            room = len(self._block) - self._filled
+            chunk = data[:room]
+            self._view[self._filled:self._filled + len(chunk)] = chunk
+            self._filled += len(chunk)
+            data = data[len(chunk):]
+            if self._filled == len(self._block):
+                self._flush_block()
+        if (self.flush_interval and self._filled >= ALIGNMENT
+                and time.monotonic() - self._last_flush >= self.flush_interval):
+            self._flush_block(self._filled - self._filled % ALIGNMENT)
+
+    def _flush_block(self, length=None):
+        # A partial block is written up to length, a multiple of
+        # ALIGNMENT; the rest moves to the front of the block.
+        length = self._filled if length is None else length
+        block = self._view[:length]
+        start = time.monotonic()
+        done = 0
+        while done < len(block):
+            done += os.write(self._fd, block[done:])
+        write_time = time.monotonic() - start
+        self.timing.disk_write += write_time
+        self.timing.blocks += 1
+        self.bytes_written += length
+        self._last_flush = time.monotonic()
+        for tap in self.taps:
+            start = time.monotonic()
+            tap.feed(bytes(block))
+            self.timing.taps[type(tap).__name__] += time.monotonic() - start
+        rest = self._filled - length
+        self._view[:rest] = self._view[length:self._filled]
+        self._filled = rest
+
+        if self.fsync_interval and time.monotonic() - self._last_sync >= self.fsync_interval:
+            start = time.monotonic()
+            os.fsync(self._fd)
+            self._last_sync = time.monotonic()
+            write_time += self._last_sync - start
+        self.timing.max_write = max(self.timing.max_write, write_time)
+
+    def handover(self):
+        """
+        Put everything written on disk and return what the next recorder
+        needs to adopt the output; the file stays open and locked.
+        """
+        if self._filled:
+            self._flush_block()
+        os.fsync(self._fd)
+        for tap in self.taps:
+            flush = getattr(tap, "flush", None)
+            if flush is not None:
+                flush()
+        return {"path": self.path, "fd": self._fd, "bytes_written": self.bytes_written}
+
+    def close(self):
+        try:
+            if self._filled:
+                self._flush_block()
+            # Give back the preallocated space the capture did not use.
+            os.ftruncate(self._fd, self.bytes_written)
+            os.fsync(self._fd)
+        finally:
+            for tap in self.taps:
+                try:
+                    tap.close()
+                except Exception:
+                    logger.exception("Failed to close capture tap %s", type(tap).__name__)
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._view.release()
+
+
+def cancel_recording(output_name):
+    """Mark a queued recording as cancelled; its at job will exit at once."""
+    CANCELLED_DIR.mkdir(parents=True, exist_ok=True)
+    (CANCELLED_DIR / output_name).touch()
+
+
+def take_cancellation(output):
+    """Return True, consuming the marker, if the recording was cancelled."""
+    marker = CANCELLED_DIR / Path(output).name
+    try:
+        marker.unlink()
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def build_streamlink_command(url, quality, streamlink_args=(), tf1=False, env=None):
+    env = os.environ if env is None else env
+    if http_pool_enabled():
+        # Same command line, run with the shared DNS and TLS session caches.
+        command = [sys.executable, HTTP_POOL_SCRIPT, "streamlink", *streamlink_args]
+    else:
+        command = ["streamlink", *streamlink_args]
+    if tf1:
+        command += [
+            "--tf1-email", env.get("STREAMLINK_TF1_EMAIL", ""),
+            "--tf1-password", env.get("STREAMLINK_TF1_PASSWORD", ""),
+        ]
+    return command + ["-O", url, quality]
+
+
+class AdoptedProcess:
+    """
+    The streamlink process of a capture handed over by the previous
+    recorder. exec() kept it our child, so it is waited for like a Popen.
+    """
+
+    def __init__(self, pid, stdout_fd):
+        self.pid = pid
+        self.stdout = open(stdout_fd, "rb", buffering=0)
+        self.returncode = None
+        os.set_inheritable(stdout_fd, False)
+
+    def _reap(self, options):
+        try:
+            pid, status = os.waitpid(self.pid, options)
+        except ChildProcessError:
+            self.returncode = -1
+            return
+        if pid:
+            self.returncode = os.waitstatus_to_exitcode(status)
+
+    def poll(self):
+        if self.returncode is None:
+            self._reap(os.WNOHANG)
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            self._reap(0)
+        return self.returncode
+
+    def terminate(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+class PrebufferedStream:
+    """The stream read from the scheduler's pre-buffer, standing in for streamlink."""
+
+    pid = None
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.stdout = sock
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self.returncode = 0
+        return self.returncode
+
+    def terminate(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def pump(stream_fd, writer, read_size=READ_SIZE, on_first_data=None, stop_when=None,
+         buffer=None):
+    """
+    Move the stream from stream_fd to writer until it ends or stop_when()
+    is true. With a CaptureBuffer the writes happen in a thread behind
+    the buffer; everything read is written when pump returns.
+    """
+    timing = writer.timing
+    if buffer is None:
+        while True:
+            start = time.monotonic()
+            data = os.read(stream_fd, read_size)
+            timing.read_wait += time.monotonic() - start
+            timing.reads += 1
+            if not data:
+                break
+            if on_first_data is not None:
+                on_first_data()
+                on_first_data = None
+            writer.write(data)
+            if stop_when is not None and stop_when():
+                break
+        return
+
+    buffer.open()
+    drain = threading.Thread(target=buffer.drain_into, args=(writer,), name="capture-writer",
+                             daemon=True)
+    drain.start()
+    try:
+        while True:
+            start = time.monotonic()
+            waited = buffer.backpressure_wait
+            count = buffer.read_from(stream_fd, read_size)
+            timing.read_wait += time.monotonic() - start - (buffer.backpressure_wait - waited)
+            timing.reads += 1
+            if not count:
+                break
+            if on_first_data is not None:
+                on_first_data()
+                on_first_data = None
+            if stop_when is not None and stop_when():
+                break
+    finally:
+        buffer.close()
+        drain.join()
+        timing.buffer_size = buffer.size
+        timing.buffer_peak = buffer.peak
+        timing.backpressure_wait = buffer.backpressure_wait
+        timing.backpressure_events = buffer.backpressure_events
+    buffer.raise_error()
+
+
+def _terminate(process):
+    if process is not None and process.poll() is None:
+        process.terminate()
+
+
+def select_rendition(url, quality, policy, tf1=False):
+    """
+    Return the quality to ask streamlink for and the extra arguments
+    enforcing policy.
+
+    The variant is picked from the HLS playlist when it can be listed;
+    TF1 streams need a login, so they only get the streamlink filters.
+    """
+    if policy.is_default():
+        return quality, []
+
+    variant = None if tf1 else choose_variant(policy, list_variants(url))
+    if variant:
+        logger.info("Rendition policy selected the variant %s of %s", variant, url)
+        return variant, policy.streamlink_args()
+
+    quality = policy.fallback_quality(quality)
+    logger.info("Rendition policy falls back to %s with streamlink filters", quality)
+    return quality, policy.streamlink_args()
+
+
+def record(url, quality, output, duration, streamlink_args=(), tf1=False,
+           can_downgrade=True, writer_options=None, profiler=None, journal=None,
+           roll_seconds=0, handover=None, prebuffered=None, share_with=(), buffer_bytes=0):
+    """
+    Run the capture until duration elapses.
+
+    On SIGUSR2 (sent by the resource governor) streamlink is restarted one
+    step down the quality ladder and keeps writing to the same file, unless
+    can_downgrade is False. writer_options are passed to CaptureWriter.
+    The capture timing is logged, and written next to the profile when
+    profiler is running.
+
+    journal (a CaptureJournal) is fed like a tap and removed when the
+    capture ends, unless a signal stopped it first.
+
+    With roll_seconds, the capture goes to a RollingWriter starting a new
+    part of output every roll_seconds.
+
+    On SIGHUP the capture is handed over to the installed recorder.py,
+    which this process becomes; handover is what such a previous recorder
+    passed on.
+
+    prebuffered is a socket streaming the channel from the pre-buffer;
+    streamlink takes over when it ends before the capture does.
+
+    Every file closed is linked into the share_with directories.
+
+    With buffer_bytes, a CaptureBuffer of that many bytes decouples the
+    reads of the stream from the disk writes; the worst write latency of
+    the capture is recorded to size the next ones.
+    """
+    handover = handover or {}
+
+    def open_writer(path, resume=None):
+        offset = resume["bytes_written"] if resume else 0
+        taps = [
+            SeekIndexBuilder(index_path(path), resume_from=offset),
+            ChecksumTap(path, resume_from=offset),
+        ]
+        if journal is not None:
+            taps.append(journal)
+        if share_with:
+            taps.append(ShareTap(path, share_with))
+        if resume:
+            options = {k: v for k, v in (writer_options or {}).items() if k != "expected_size"}
+            return CaptureWriter(path, taps=taps, fd=resume["fd"], bytes_written=offset, **options)
+        return CaptureWriter(path, taps=taps, **(writer_options or {}))
+
+    if roll_seconds:
+        writer = RollingWriter(output, roll_seconds, open_writer, handover.get("rolling"))
+    else:
+        writer = open_writer(output, handover.get("writer"))
+    state = {
+        "process": None,
+        "quality": quality,
+        "stopping": False,
+        "interrupted": False,
+        "downgrade": False,
+        "handover": False,
+        "first_byte": bool(handover),
+    }
+    buffer = CaptureBuffer(buffer_bytes) if buffer_bytes else None
+
+    def stop(*_):
+        state["stopping"] = True
+        _terminate(state["process"])
+
+    def interrupt(*_):
+        # Stopped before the end of the programme, by a shutdown or a
+        # kill: the journal entry stays so the capture can be resumed.
+        state["interrupted"] = True
+        stop()
+
+    def downgrade(*_):
+        if can_downgrade and lower_quality(state["quality"]) != state["quality"]:
+            state["downgrade"] = True
+            _terminate(state["process"])
+
+    def hand_over(*_):
+        state["handover"] = True
+
+    # Time from streamlink's start to the first byte of the stream, and how
+    # late that was compared to when the at job was due.
+    first_byte = start_span("recorder.first_byte", quality=quality)
+
+    def on_first_data():
+        if state["first_byte"]:
+            return
+        state["first_byte"] = True
+        scheduled = os.environ.get(SCHEDULED_ENV)
+        if scheduled:
+            first_byte.set(late_by=round(time.time() - float(scheduled), 3))
+        first_byte.end()
+
+    planned_end = time.time() + duration
+    timer = threading.Timer(duration, stop)
+    timer.daemon = True
+    timer.start()
+    signal.signal(signal.SIGTERM, interrupt)
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGUSR2, downgrade)
+    signal.signal(signal.SIGHUP, hand_over)
+    advertise_handover("recorder.py")
+
+    process = None
+    if handover.get("streamlink_pid"):
+        process = AdoptedProcess(handover["streamlink_pid"], handover["stream_fd"])
+    elif "stream_fd" in handover:
+        process = PrebufferedStream(socket.socket(fileno=handover["stream_fd"]))
+    elif prebuffered is not None:
+        process = PrebufferedStream(prebuffered)
+    try:
+        if journal is not None:
+            journal.write()
+        while True:
+            if process is None:
+                process = subprocess.Popen(
+                    build_streamlink_command(url, state["quality"], streamlink_args, tf1),
+                    stdout=subprocess.PIPE,
+                )
+            state["process"] = process
+            handing_over = False
+            try:
+                pump(
+                    process.stdout.fileno(),
+                    writer,
+                    on_first_data=on_first_data,
+                    stop_when=lambda: state["handover"],
+                    buffer=buffer,
+                )
+                handing_over = state["handover"] and not state["stopping"]
+            finally:
+                if not handing_over:
+                    process.stdout.close()
+                    returncode = process.wait()
+
+            if handing_over:
+                try:
+                    _hand_over(writer, process, state["quality"], streamlink_args,
+                               planned_end, journal, roll_seconds)
+                except OSError:
+                    logger.exception("Could not hand %s over, this recorder goes on", output)
+                state["handover"] = False
+                continue
+
+            prebuffer_ended = isinstance(process, PrebufferedStream)
+            process = None
+            if state["stopping"]:
+                break
+            if prebuffer_ended and not state["downgrade"]:
+                logger.warning("The pre-buffer of %s ended, streamlink takes over", output)
+                continue
+            if not state["downgrade"]:
+                break
+            state["downgrade"] = False
+            state["quality"] = lower_quality(state["quality"])
+            logger.warning("Restarting the capture of %s at quality %s", output, state["quality"])
+    finally:
+        timer.cancel()
+        writer.close()
+        if buffer is not None:
+            record_stall(Path(output).parent, writer.timing.max_write)
+        if journal is not None and not state["interrupted"]:
+            journal.remove()
+        if not state["first_byte"]:
+            first_byte.error = "no data"
+            first_byte.end()
+
+    logger.info(
+        "Capture of %s finished: %d bytes written, streamlink exit code %d.",
+        output,
+        writer.bytes_written,
+        returncode,
+    )
+    logger.info("Capture timing of %s: %s", output, writer.timing.describe())
+    if profiler is not None and profiler.running:
+        profiler.dump_json("capture", {"output": output, **writer.timing.as_dict()})
+    return returncode
+
+
+def _hand_over(writer, process, quality, streamlink_args, planned_end, journal, roll_seconds):
+    """Re-exec the installed recorder.py with this capture; only returns on failure."""
+    state = {
+        "streamlink_pid": process.pid,
+        "stream_fd": process.stdout.fileno(),
+        "quality": quality,
+        "streamlink_args": list(streamlink_args),
+        "planned_end": planned_end,
+        "journal_started": journal.started if journal is not None else time.time(),
+        "journal_bytes": journal.bytes_written if journal is not None else 0,
+    }
+    if roll_seconds:
+        state["rolling"] = writer.handover()
+        fd = state["rolling"]["writer"]["fd"]
+    else:
+        state["writer"] = writer.handover()
+        fd = state["writer"]["fd"]
+    logger.info("Handing the capture of %s over to the installed recorder", writer.path)
+    reexec("recorder.py", state, fds=(fd, process.stdout.fileno()))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Record one live stream.")
+    parser.add_argument("--duration", required=True, help="seconds, or timeout(1) syntax")
+    parser.add_argument("--output", required=True, help="path of the .ts file to write")
+    parser.add_argument("--tf1", action="store_true", help="log in to TF1 from the environment")
+    parser.add_argument("--priority", choices=PRIORITIES, default="normal")
+    parser.add_argument("--max-height", type=int, default=None)
+    parser.add_argument("--max-bitrate", type=int, default=None, help="kbps")
+    parser.add_argument("--audio-only", action="store_true")
+    parser.add_argument("--codec", choices=sorted(CODEC_PREFIXES), default=None)
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE // 1024, help="KiB")
+    parser.add_argument(
+        "--fsync-interval", type=float, default=FSYNC_INTERVAL, help="seconds, 0 to disable"
+    )
+    parser.add_argument(
+        "--buffer-mb", type=int, default=None,
+        help="read-ahead buffer in MiB, 0 to disable (default: sized from the disk write latency)",
+    )
+    parser.add_argument("--part", type=int, default=1, help="part number of a resumed capture")
+    parser.add_argument("--continues", default=None, help="first part of a resumed capture")
+    parser.add_argument(
+        "--roll-minutes", type=float, default=0, help="start a new file every N minutes"
+    )
+    parser.add_argument(
+        "--share-with", action="append", default=None, metavar="DIR",
+        help="link the recording into DIR too (repeatable)",
+    )
+    parser.add_argument("url")
+    parser.add_argument("quality")
+    parser.add_argument("streamlink_args", nargs=argparse.REMAINDER)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+        datefmt="%d-%m-%Y %H:%M:%S",
+    )
+    # An upgrade before the capture starts leaves this recorder on its release.
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    handover = take_handover()
+
+    try:
+        duration = parse_duration(args.duration)
+    except ValueError:
+        logger.error("Invalid recording duration %s", args.duration)
+        return 2
+    if handover:
+        duration = max(handover["planned_end"] - time.time(), 0)
+
+    if args.block_size <= 0 or args.block_size * 1024 % ALIGNMENT:
+        logger.error("The block size must be a multiple of %d KiB", ALIGNMENT // 1024)
+        return 2
+
+    if args.roll_minutes < 0:
+        logger.error("--roll-minutes cannot be negative")
+        return 2
+
+    if handover:
+        logger.info("Taking the capture of %s over", args.output)
+    elif take_cancellation(args.output) or (args.continues and take_cancellation(args.continues)):
+        logger.info("The recording %s was cancelled.", args.output)
+        return 0
+
+    journal = CaptureJournal(
+        args.output,
+        args.url,
+        args.quality,
+        args.streamlink_args,
+        {
+            name: getattr(args, name)
+            for name in ("tf1", "priority", "max_height", "max_bitrate", "audio_only",
+                         "codec", "block_size", "fsync_interval", "roll_minutes", "share_with")
+        },
+        planned_end=time.time() + duration,
+        part=args.part,
+        programme=args.continues,
+    )
+    if handover:
+        journal.started = handover["journal_started"]
+        journal.bytes_written = handover["journal_bytes"]
+
+    profiler = install_profiling("recorder")
+    install_http_pool("recorder")
+
+    with span("recorder.run", output=Path(args.output).name, priority=args.priority):
+        policy = RenditionPolicy(
+            max_height=args.max_height,
+            max_bitrate_kbps=args.max_bitrate,
+            audio_only=args.audio_only,
+            codec=args.codec,
+            priority=args.priority,
+        )
+        if handover:
+            # Resolved and admitted by the recorder that started the capture.
+            quality = handover["quality"]
+            streamlink_args = handover["streamlink_args"]
+        else:
+            with span("recorder.resolve"):
+                quality, policy_args = select_rendition(args.url, args.quality, policy, args.tf1)
+            streamlink_args = [*policy_args, *args.streamlink_args]
+
+            with span("recorder.admission"):
+                admitted = Governor().admit(args.priority, quality)
+            # A rendition capped by the policy (or audio only) is kept.
+            if not (policy.max_height or policy.max_bitrate_kbps or policy.audio_only):
+                quality = admitted
+
+        prebuffered = None
+        # A resumed capture already holds the minutes before its part.
+        if not handover and not args.continues:
+            prebuffered = open_prebuffer(args.url, quality)
+        if prebuffered is not None:
+            prebuffered, seconds = prebuffered
+            logger.info("The capture of %s starts with %.0fs from the pre-buffer",
+                        args.output, seconds)
+
+        if policy.max_bitrate_kbps:
+            bitrate_kbps = policy.max_bitrate_kbps
+        elif policy.audio_only:
+            bitrate_kbps = AUDIO_BITRATE_KBPS
+        else:
+            bitrate_kbps = DEFAULT_BITRATE_KBPS
+
+        if args.buffer_mb is not None:
+            capture_buffer = args.buffer_mb * 1024 * 1024
+        else:
+            stall = worst_stall(Path(args.output).parent)
+            capture_buffer = buffer_size(bitrate_kbps, stall, ALIGNMENT)
+            logger.info("Capture buffer of %d MiB for a worst write stall of %.2fs",
+                        capture_buffer // 1024 // 1024, stall)
+
+        roll_seconds = args.roll_minutes * 60
+        part_duration = min(duration, roll_seconds) if roll_seconds else duration
+        try:
+            returncode = record(
+                args.url,
+                quality,
+                args.output,
+                duration,
+                streamlink_args,
+                args.tf1,
+                can_downgrade=not policy.audio_only,
+                writer_options={
+                    "expected_size": expected_size(part_duration, bitrate_kbps),
+                    "block_size": args.block_size * 1024,
+                    "fsync_interval": args.fsync_interval,
+                },
+                profiler=profiler,
+                journal=journal,
+                roll_seconds=roll_seconds,
+                handover=handover,
+                prebuffered=prebuffered,
+                share_with=args.share_with or (),
+                buffer_bytes=capture_buffer,
+            )
+        except FileExistsError:
+            logger.error("The recording %s already exists.", args.output)
+            return 1
+
+    # Being stopped at the end of the programme is the expected outcome.
+    return 0 if returncode in (0, -signal.SIGTERM) else returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+"""
+Per-channel and per-programme rendition policies.
+
+Policies come from the optional RENDITION_POLICIES of config.py:
+
+    RENDITION_POLICIES = {
+        "default": {"max_height": 720},
+        "channels": {
+            "franceinfo": {"audio_only": True},
+            "LCP": {"max_height": 360, "priority": "low"},
+        },
+        "programmes": [
+            {"match": {"title": "journal|JT"}, "max_bitrate_kbps": 1500},
+            {"match": {"channel": "Arte", "title": "opéra"}, "codec": "hevc"},
+        ],
+    }
+
+"match" holds regular expressions searched (case-insensitively) in the
+fields of the programme from info_progs.json. Settings are merged in
+order: default, channel, then every matching programme rule.
+
+A policy caps the variant of the HLS playlist the recorder asks for:
+max_height, max_bitrate_kbps, audio_only and a preferred codec (avc,
+hevc); priority is handed to the resource governor.
+"""
+import logging
+import re
+
+logger = logging.getLogger("__name__")
+
+POLICY_KEYS = {
+    "max_height": int,
+    "max_bitrate_kbps": int,
+    "audio_only": bool,
+    "codec": str,
+    "priority": str,
+}
+
+CODEC_PREFIXES = {
+    "avc": ("avc1", "avc3"),
+    "hevc": ("hvc1", "hev1"),
+}
+VIDEO_CODEC_PREFIXES = ("avc", "hvc", "hev", "vp09", "av01")
+
+
+class RenditionPolicy:
+    def __init__(self, max_height=None, max_bitrate_kbps=None, audio_only=False,
+                 codec=None, priority="normal"):
+        self.max_height = max_height
+        self.max_bitrate_kbps = max_bitrate_kbps
+        self.audio_only = audio_only
+        self.codec = codec
+        self.priority = priority
+
+    def merged(self, settings):
+        values = {key: getattr(self, key) for key in POLICY_KEYS}
+        values.update(settings)
+        return RenditionPolicy(**values)
+
+    def is_default(self):
+        return not (self.max_height or self.max_bitrate_kbps or self.audio_only or self.codec)
+
+    def to_args(self):
+        """Return the recorder.py options applying this policy."""
+        args = []
+        if self.max_height:
+            args += ["--max-height", str(self.max_height)]
+        if self.max_bitrate_kbps:
+            args += ["--max-bitrate", str(self.max_bitrate_kbps)]
+        if self.audio_only:
+            args.append("--audio-only")
+        if self.codec:
+            args += ["--codec", self.codec]
+        if self.priority != "normal":
+            args += ["--priority", self.priority]
+        return args
+
+    def streamlink_args(self):
+        """
+        Fallback when the variant list cannot be inspected: let streamlink
+        drop the variants above the caps before picking "best".
+        """
+        excludes = []
+        if self.max_height:
+            excludes.append(f">{self.max_height}p")
+        if self.max_bitrate_kbps:
+            excludes.append(f">{self.max_bitrate_kbps}k")
+        return ["--stream-sorting-excludes", ",".join(excludes)] if excludes else []
+
+    def fallback_quality(self, quality):
+        return "audio_only,audio,worst" if self.audio_only else quality
+
+
+def _check_settings(settings, where):
+    clean = {}
+    for key, value in settings.items():
+        if key == "match":
+            continue
+        if key not in POLICY_KEYS or not isinstance(value, POLICY_KEYS[key]):
+            logger.error("Ignoring invalid rendition setting %s=%r in %s", key, value, where)
+            continue
+        if key == "codec" and value not in CODEC_PREFIXES:
+            logger.error("Unknown codec %r in %s", value, where)
+            continue
+        if key == "priority" and value not in ("low", "normal", "high"):
+            logger.error("Unknown priority %r in %s", value, where)
+            continue
+        clean[key] = value
+    return clean
+
+
+class PolicySet:
+    """Validated RENDITION_POLICIES, resolved per programme."""
+
+    def __init__(self, raw=None):
+        raw = raw or {}
+        self.default = RenditionPolicy().merged(_check_settings(raw.get("default", {}), "default"))
+        self.channels = {
+            channel: _check_settings(settings, f"channel {channel}")
+            for channel, settings in raw.get("channels", {}).items()
+        }
+        self.programmes = []
+        for i, rule in enumerate(raw.get("programmes", [])):
+            try:
+                match = {
+                    field: re.compile(pattern, re.IGNORECASE)
+                    for field, pattern in rule.get("match", {}).items()
+                }
+            except re.error:
+                logger.error("Invalid regular expression in programme rule %d", i)
+                continue
+            self.programmes.append((match, _check_settings(rule, f"programme rule {i}")))
+
+    def resolve(self, video):
+        policy = self.default.merged(self.channels.get(video.get("channel"), {}))
+        for match, settings in self.programmes:
+            if all(
+                pattern.search(str(video.get(field, ""))) for field, pattern in match.items()
+            ):
+                policy = policy.merged(settings)
+        return policy
+
+
+class Variant:
+    def __init__(self, name, height=None, bandwidth=None, codecs=""):
+        self.name = name
+        self.height = height
+        self.bandwidth = bandwidth
+        self.codecs = codecs or ""
+
+    @property
+    def has_video(self):
+        if self.height:
+            return True
+        return any(c.strip().startswith(VIDEO_CODEC_PREFIXES) for c in self.codecs.split(","))
+
+    def uses(self, codec):
+        return any(c.strip().startswith(CODEC_PREFIXES[codec]) for c in self.codecs.split(","))
+
+
+def choose_variant(policy, variants):
+    """Return the name of the variant best matching policy, or None."""
+    if not variants:
+        return None
+
+    if policy.audio_only:
+        audio = [v for v in variants if not v.has_video]
+        pool = audio or variants
+        return min(pool, key=lambda v: v.bandwidth or 0).name
+
+    candidates = [
+        v for v in variants
+        if v.has_video
+        and (not policy.max_height or (v.height or 0) <= policy.max_height)
+        and (not policy.max_bitrate_kbps or (v.bandwidth or 0) <= policy.max_bitrate_kbps * 1000)
+    ]
+    if not candidates:
+        # Nothing fits the caps: take the cheapest video variant.
+        video = [v for v in variants if v.has_video] or variants
+        return min(video, key=lambda v: v.bandwidth or 0).name
+
+    return max(
+        candidates,
+        key=lambda v: (
+            bool(policy.codec and v.uses(policy.codec)),
+            v.height or 0,
+            v.bandwidth or 0,
+        ),
+    ).name
+
+
+def list_variants(url):
+    """
+    Ask streamlink for the variants of url with their HLS attributes.
+
+    Returns an empty list when the streams cannot be resolved this way
+    (plugin needing credentials, non-HLS streams, older streamlink).
+    """
+    try:
+        from streamlink import Streamlink
+
+        streams = Streamlink().streams(url)
+    except Exception:
+        logger.warning("Could not list the variants of %s", url, exc_info=True)
+        return []
+
+    variants = []
+    for name, stream in streams.items():
+        if name in ("best", "worst"):
+            continue
+        multivariant = getattr(stream, "multivariant", None)
+        info = None
+        for playlist in getattr(multivariant, "playlists", None) or []:
+            if getattr(playlist, "uri", None) == getattr(stream, "url", None):
+                info = playlist.stream_info
+                break
+        if info is None:
+            variants.append(Variant(name))
+            continue
+        resolution = getattr(info, "resolution", None)
+        variants.append(
+            Variant(
+                name,
+                height=getattr(resolution, "height", None),
+                bandwidth=getattr(info, "bandwidth", None),
+                codecs=",".join(getattr(info, "codecs", None) or []),
+            )
+        )
+    return variants
@@ -0,0 +1,362 @@
+"""
+Pressure-aware governor for concurrent captures.
+
+The governor samples pressure stall information (/proc/pressure), the
+RSS and CPU time of every running recorder.py (with its streamlink
+child) and the write latency of the disk holding ~/videos_select, and
+turns them into one of three levels: ok, pressure or critical.
+
+* recorder.py asks admit() before starting: low priority captures are
+  delayed and start at a lower quality under pressure, normal ones only
+  wait under critical pressure, high priority ones never wait.
+* `resource_governor.py watch` runs the loop: it pauses the background
+  jobs registered with register_background() (SIGSTOP to their process
+  group) while the box is under pressure and resumes them afterwards, and
+  asks low priority recorders to step their quality down (SIGUSR2) when
+  critical pressure lasts.
+
+Every decision is logged.
+"""
+import atexit
+import logging
+import os
+import re
+import signal
+import sys
+import time
+
+from pathlib import Path
+
+from app_logging import setup_logging
+
+logger = logging.getLogger("__name__")
+
+PSI_DIR = Path("/proc/pressure")
+BACKGROUND_DIR = Path.home() / ".local/share/tvselect-fr-live-stream/background"
+RECORDINGS_DIR = Path.home() / "videos_select"
+
+LEVEL_OK = "ok"
+LEVEL_PRESSURE = "pressure"
+LEVEL_CRITICAL = "critical"
+
+# "some avg10" percentages and write latency (ms) at which each level starts.
+THRESHOLDS = {
+    LEVEL_PRESSURE: {"cpu": 40.0, "memory": 5.0, "io": 20.0, "write_latency": 50.0},
+    LEVEL_CRITICAL: {"cpu": 80.0, "memory": 20.0, "io": 50.0, "write_latency": 200.0},
+}
+
+PRIORITIES = ("low", "normal", "high")
+ADMIT_MAX_WAIT = {"low": 60.0, "normal": 15.0, "high": 0.0}
+ADMIT_POLL = 3.0
+
+# Quality specs handed to streamlink, from best to cheapest.
+QUALITY_LADDER = ["best", "720p,540p,480p,best", "480p,360p,worst", "worst"]
+# Steps below a variant picked by the rendition policy ("720p", "540p_alt").
+VARIANT_HEIGHTS = [1080, 720, 540, 480, 360, 240, 144]
+VARIANT_RE = re.compile(r"(\d+)p\w*")
+
+WATCH_INTERVAL = 5.0
+DOWNGRADE_AFTER = 6  # consecutive critical samples
+
+
+def read_psi(resource, psi_dir=PSI_DIR):
+    """Return the 'some avg10' percentage of a PSI file, 0.0 when unavailable."""
+    try:
+        with open(psi_dir / resource, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("some "):
+                    fields = dict(item.split("=") for item in line.split()[1:])
+                    return float(fields["avg10"])
+    except (OSError, ValueError, KeyError):
+        pass
+    return 0.0
+
+
+def _device_of(path):
+    st = os.stat(path)
+    return os.major(st.st_dev), os.minor(st.st_dev)
+
+
+def read_disk_writes(path=RECORDINGS_DIR):
+    """Return (writes completed, ms spent writing) of the device holding path."""
+    try:
+        major, minor = _device_of(path)
+        with open("/proc/diskstats", "r", encoding="utf-8") as f:
+            for line in f:
+                fields = line.split()
+                if int(fields[0]) == major and int(fields[1]) == minor:
+                    return int(fields[7]), int(fields[10])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _children(pid):
+    children = []
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+        except OSError:
+            continue
+        if int(stat.rsplit(")", 1)[1].split()[1]) == pid:
+            children.append(int(entry.name))
+    return children
+
+
+def read_process(pid):
+    """Return (rss bytes, cpu seconds) of pid and its direct children."""
+    rss, cpu = 0, 0.0
+    ticks = os.sysconf("SC_CLK_TCK")
+    for p in [pid, *_children(pid)]:
+        try:
+            fields = Path(f"/proc/{p}/stat").read_text().rsplit(")", 1)[1].split()
+            status = Path(f"/proc/{p}/status").read_text()
+        except OSError:
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / ticks
+        for line in status.splitlines():
+            if line.startswith("VmRSS:"):
+                rss += int(line.split()[1]) * 1024
+    return rss, cpu
+
+
+def find_capture_processes():
+    """Return {pid: {"output": path, "priority": priority}} for every running recorder.py."""
+    captures = {}
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            argv = (entry / "cmdline").read_bytes().split(b"\x00")
+        except OSError:
+            continue
+        if not any(arg.endswith(b"recorder.py") for arg in argv[:2]):
+            continue
+        argv = [arg.decode(errors="replace") for arg in argv]
+        captures[int(entry.name)] = {
+            "output": argv[argv.index("--output") + 1] if "--output" in argv[:-1] else None,
+            "priority": argv[argv.index("--priority") + 1] if "--priority" in argv[:-1] else "normal",
+        }
+    return captures
+
+
+def register_background(name, pgid=None):
+    """
+    Let the governor pause a process group under pressure, by default the
+    one of this process; return the registration.
+
+    The registration of this process group is removed when the process
+    exits, that of another one by unregister_background().
+    """
+    BACKGROUND_DIR.mkdir(parents=True, exist_ok=True)
+    if pgid is None:
+        pidfile = BACKGROUND_DIR / f"{name}.{os.getpid()}.pgid"
+        pidfile.write_text(str(os.getpgid(0)))
+        atexit.register(lambda: pidfile.unlink(missing_ok=True))
+    else:
+        pidfile = BACKGROUND_DIR / f"{name}.{pgid}.pgid"
+        pidfile.write_text(str(pgid))
+    return pidfile
+
+
+def unregister_background(registration):
+    registration.unlink(missing_ok=True)
+
+
+def lower_quality(quality):
+    """
+    Return the next cheaper quality spec: the next step of the ladder, or
+    the heights below a variant; any other quality is returned unchanged.
+    """
+    if quality in QUALITY_LADDER:
+        return QUALITY_LADDER[min(QUALITY_LADDER.index(quality) + 1, len(QUALITY_LADDER) - 1)]
+    match = VARIANT_RE.fullmatch(quality.split(",")[0])
+    if match is None:
+        return quality
+    lower = [f"{height}p" for height in VARIANT_HEIGHTS if height < int(match.group(1))]
+    return ",".join([*lower[:2], "worst"])
+
+
+class Sample:
+    def __init__(self, psi, write_latency, captures):
+        self.psi = psi
+        self.write_latency = write_latency
+        self.captures = captures
+
+    def describe(self):
+        rss = sum(c["rss"] for c in self.captures.values())
+        return (
+            f"cpu={self.psi['cpu']:.1f}% memory={self.psi['memory']:.1f}% "
+            f"io={self.psi['io']:.1f}% write_latency={self.write_latency:.1f}ms "
+            f"captures={len(self.captures)} captures_rss={rss // (1024 * 1024)}MB"
+        )
+
+
+class Governor:
+    def __init__(self, thresholds=THRESHOLDS, recordings_dir=RECORDINGS_DIR):
+        self.thresholds = thresholds
+        self.recordings_dir = recordings_dir
+        self.level = LEVEL_OK
+        self._disk = read_disk_writes(recordings_dir)
+        self._disk_time = time.monotonic()
+        self._cpu = {}
+        self._critical_samples = 0
+        self._paused = set()
+
+    def _write_latency(self):
+        disk = read_disk_writes(self.recordings_dir)
+        latency = 0.0
+        if disk and self._disk:
+            writes = disk[0] - self._disk[0]
+            if writes > 0:
+                latency = (disk[1] - self._disk[1]) / writes
+        self._disk = disk
+        return latency
+
+    def sample(self):
+        psi = {resource: read_psi(resource) for resource in ("cpu", "memory", "io")}
+
+        now = time.monotonic()
+        elapsed = max(now - self._disk_time, 1e-6)
+        self._disk_time = now
+
+        captures = {}
+        for pid, capture in find_capture_processes().items():
+            rss, cpu = read_process(pid)
+            cpu_share = (cpu - self._cpu.get(pid, cpu)) / elapsed * 100
+            self._cpu[pid] = cpu
+            captures[pid] = {**capture, "rss": rss, "cpu": cpu_share}
+        self._cpu = {pid: self._cpu[pid] for pid in captures}
+
+        return Sample(psi, self._write_latency(), captures)
+
+    def classify(self, sample):
+        metrics = {**sample.psi, "write_latency": sample.write_latency}
+        for level in (LEVEL_CRITICAL, LEVEL_PRESSURE):
+            limits = self.thresholds[level]
+            if any(metrics[name] >= limit for name, limit in limits.items()):
+                return level
+        return LEVEL_OK
+
+    def admit(self, priority, quality, sleep=time.sleep):
+        """
+        Decide how a new capture may start; return the quality to request.
+
+        Waits while the box is critical, for at most ADMIT_MAX_WAIT of the
+        priority, then lets the capture in anyway: a late recording beats
+        a missing one.
+        """
+        waited = 0.0
+        sample = self.sample()
+        level = self.classify(sample)
+        while level == LEVEL_CRITICAL and waited < ADMIT_MAX_WAIT.get(priority, 0.0):
+            sleep(ADMIT_POLL)
+            waited += ADMIT_POLL
+            sample = self.sample()
+            level = self.classify(sample)
+
+        if priority == "low" and level != LEVEL_OK:
+            quality = lower_quality(quality)
+        logger.info(
+            "Admission of a %s priority capture: level=%s, waited %.0fs, quality %s (%s)",
+            priority, level, waited, quality, sample.describe(),
+        )
+        return quality
+
+    def _signal_background(self, sig):
+        for pidfile in BACKGROUND_DIR.glob("*.pgid"):
+            try:
+                pgid = int(pidfile.read_text())
+                if (pgid in self._paused) == (sig == signal.SIGSTOP):
+                    continue
+                os.killpg(pgid, sig)
+            except ProcessLookupError:
+                pidfile.unlink(missing_ok=True)
+                continue
+            except (OSError, ValueError):
+                continue
+            if sig == signal.SIGSTOP:
+                self._paused.add(pgid)
+            else:
+                self._paused.discard(pgid)
+            logger.info(
+                "%s background job %s",
+                "Paused" if sig == signal.SIGSTOP else "Resumed",
+                pidfile.name,
+            )
+
+    def step(self):
+        """Take one sample and apply the resulting decisions."""
+        sample = self.sample()
+        level = self.classify(sample)
+
+        if level != self.level:
+            logger.warning(
+                "Resource level %s -> %s (%s)", self.level, level, sample.describe()
+            )
+            self.level = level
+
+        if level != LEVEL_CRITICAL:
+            self._critical_samples = 0
+        if level == LEVEL_OK:
+            if self._paused:
+                self._signal_background(signal.SIGCONT)
+            return sample
+
+        self._signal_background(signal.SIGSTOP)
+
+        if level == LEVEL_CRITICAL:
+            self._critical_samples += 1
+        if self._critical_samples >= DOWNGRADE_AFTER:
+            self._critical_samples = 0
+            for pid, capture in sample.captures.items():
+                if capture["priority"] != "low":
+                    continue
+                logger.warning(
+                    "Asking low priority capture %s (pid %d) to lower its quality",
+                    capture["output"], pid,
+                )
+                try:
+                    os.kill(pid, signal.SIGUSR2)
+                except ProcessLookupError:
+                    pass
+        return sample
+
+    def resume_all(self):
+        if self._paused:
+            self._signal_background(signal.SIGCONT)
+
+
+def watch(interval=WATCH_INTERVAL):
+    governor = Governor()
+    logger.info("Resource governor started")
+    try:
+        while True:
+            try:
+                governor.step()
+            except Exception:
+                logger.exception("Resource governor step failed")
+            time.sleep(interval)
+    finally:
+        governor.resume_all()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv != ["watch"]:
+        print("usage: resource_governor.py watch", file=sys.stderr)
+        return 2
+
+    setup_logging("resource_governor.log")
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        watch()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+"""
+Rolling output for long captures.
+
+With --roll-minutes N (ROLL_MINUTES in config.py) recorder.py writes a
+programme as a series of parts instead of one file:
+
+    Title_Chan.001.ts, Title_Chan.002.ts, ...
+
+A new part starts at the first keyframe after N minutes, with the last
+PAT and PMT in front, so every part plays on its own. Each part is a
+complete recording with its seek index and checksum as soon as it is
+closed: the offloader, or anything else, can take it while the rest of
+the programme is still being captured.
+
+Title_Chan.manifest.json lists the parts in order and is rewritten
+atomically whenever one starts or ends:
+
+    {"programme": "Title_Chan.ts", "roll_seconds": 600, "complete": false,
+     "parts": [{"file": "Title_Chan.001.ts", "start": 1760810283.2,
+                "end": 1760810885.9, "offset": 0.0, "duration": 602.7,
+                "bytes": 451362816, "complete": true}, ...]}
+
+start and end are wall-clock times, offset is the start of the part in
+seconds from the start of the capture.
+
+    rolling_output.py status PATH
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+from pathlib import Path
+
+from profiling import CaptureTiming
+from seek_index import TS_PACKET_SIZE, KeyframeScanner
+
+MANIFEST_SUFFIX = ".manifest.json"
+PART_RE = re.compile(r"(.+)\.\d{3}(\.ts)")
+
+
+def part_path(output, number):
+    path = Path(output)
+    return path.with_name(f"{path.stem}.{number:03d}{path.suffix}")
+
+
+def manifest_path(output):
+    path = Path(output)
+    return path.with_name(path.stem + MANIFEST_SUFFIX)
+
+
+def programme_of_part(path):
+    """Return the recording a part file belongs to, or None for a single recording."""
+    path = Path(path)
+    match = PART_RE.fullmatch(path.name)
+    if not match:
+        return None
+    output = path.with_name(match.group(1) + match.group(2))
+    return output if manifest_path(output).exists() else None
+
+
+def load_manifest(output):
+    """Return the manifest of a rolled recording, or None."""
+    try:
+        with open(manifest_path(output), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def completed_parts(output):
+    """Return the paths of the parts of output that are closed, in order."""
+    manifest = load_manifest(output)
+    if manifest is None:
+        return []
+    return [
+        Path(output).with_name(part["file"]) for part in manifest["parts"] if part["complete"]
+    ]
+
+
+class RollingWriter:
+    """
+    Stand-in for CaptureWriter writing the capture as a series of parts.
+
+    open_part(path, resume=None) returns the CaptureWriter of one part,
+    with its taps; parts are opened exclusively like single recordings, so
+    the first one raises FileExistsError when the programme was already
+    recorded. resume is what handover() returned in the previous recorder
+    process, the current part is then adopted with open_part(path, resume).
+    """
+
+    def __init__(self, output, roll_seconds, open_part, resume=None):
+        self.path = output
+        self.roll_seconds = roll_seconds
+        self.open_part = open_part
+        self.timing = CaptureTiming()
+        self.parts = []
+        self._closed_bytes = 0
+        self._scanner = KeyframeScanner()
+        self._carry = b""
+        self._offset = 0
+        self._started = time.time()
+        self._writer = None
+        if resume:
+            self._resume(resume)
+        else:
+            self._open_next()
+
+    @property
+    def bytes_written(self):
+        current = self._writer.bytes_written if self._writer else 0
+        return self._closed_bytes + current
+
+    def _open_next(self, header=b""):
+        number = len(self.parts) + 1
+        path = part_path(self.path, number)
+        self._writer = self.open_part(str(path))
+        self._writer.timing = self.timing
+        now = time.time()
+        self.parts.append({
+            "file": path.name,
+            "start": now,
+            "end": None,
+            "offset": round(now - self._started, 3),
+            "duration": None,
+            "bytes": 0,
+            "complete": False,
+        })
+        self._part_started = time.monotonic()
+        if header:
+            self._writer.write(header)
+        self.write_manifest()
+
+    def _close_current(self):
+        writer, self._writer = self._writer, None
+        writer.close()
+        part = self.parts[-1]
+        part["end"] = time.time()
+        part["duration"] = round(part["end"] - part["start"], 3)
+        part["bytes"] = writer.bytes_written
+        part["complete"] = True
+        self._closed_bytes += writer.bytes_written
+
+    def handover(self):
+        """Return the state of the capture for the next recorder process."""
+        return {
+            "parts": self.parts,
+            "started": self._started,
+            "offset": self._offset,
+            "carry": self._carry.hex(),
+            "part_elapsed": time.monotonic() - self._part_started,
+            "writer": self._writer.handover(),
+        }
+
+    def _resume(self, state):
+        self.parts = state["parts"]
+        self._started = state["started"]
+        self._offset = state["offset"]
+        self._carry = bytes.fromhex(state["carry"])
+        self._part_started = time.monotonic() - state["part_elapsed"]
+        self._closed_bytes = sum(part["bytes"] for part in self.parts[:-1])
+        self._writer = self.open_part(state["writer"]["path"], state["writer"])
+        self._writer.timing = self.timing
+
+    def write(self, data):
+        # Only whole packets are written, so a keyframe packet is never
+        # split between two parts.
+        buffer = self._carry + data if self._carry else bytes(data)
+        end = len(buffer) - len(buffer) % TS_PACKET_SIZE
+        self._carry = buffer[end:]
+        done = 0
+
+        if time.monotonic() - self._part_started >= self.roll_seconds:
+            for _, offset in self._scanner.scan(buffer[:end], self._offset):
+                cut = offset - self._offset
+                self._writer.write(buffer[done:cut])
+                done = cut
+                if time.monotonic() - self._part_started >= self.roll_seconds:
+                    header = self._scanner.tables()
+                    self._close_current()
+                    self._open_next(header)
+        else:
+            # Keeps the PAT and PMT seen up to date.
+            for _ in self._scanner.scan(buffer[:end], self._offset):
+                pass
+
+        self._writer.write(buffer[done:end])
+        self._offset += end
+
+    def write_manifest(self, complete=False):
+        manifest = {
+            "programme": Path(self.path).name,
+            "roll_seconds": self.roll_seconds,
+            "complete": complete,
+            "parts": self.parts,
+        }
+        path = manifest_path(self.path)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, path)
+
+    def close(self):
+        try:
+            if self._writer is not None:
+                if self._carry:
+                    self._writer.write(self._carry)
+                    self._carry = b""
+                self._close_current()
+        finally:
+            self.write_manifest(complete=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parts of a rolled recording.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    status = sub.add_parser("status", help="list the parts of a recording")
+    status.add_argument("output", help="the recording, as given to recorder.py --output")
+    args = parser.parse_args(argv)
+
+    manifest = load_manifest(args.output)
+    if manifest is None:
+        print(f"{args.output} has no manifest")
+        return 1
+    for part in manifest["parts"]:
+        state = "complete" if part["complete"] else "recording"
+        print(f"{part['file']}: +{part['offset']:.0f}s, {part['bytes']} bytes, {state}")
+    print("capture finished" if manifest["complete"] else "capture running")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,15 @@
-import json
+import signal
+
+if __name__ == "__main__":
+    # SIGHUP kills by default: an upgrade while the imports run must not
+    # end the scheduler.
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+import asyncio
 import logging
 import os
 import re
-import requests
-import sentry_sdk
+import socket
 import subprocess
 import sys
 import time
@@ -13,7 +19,20 @@ from datetime import datetime, timedelta
 from shlex import quote
 from logging.handlers import RotatingFileHandler
 
-from security_sanitizer import global_sanitizer, scrub_event
+from accounts import fetch_all, load_accounts, merge
+from capture_journal import recover
+from control_socket import SchedulerControl, SchedulerState, control_socket_path, start_server
+from hot_upgrade import advertise_handover, reexec, take_handover
+from offload import DEFAULT_CONCURRENCY, start_offloader
+from planner import fetch_schedule
+from prebuffer import DEFAULT_MAX_CHANNELS, DEFAULT_MAX_MB, PreBuffer, next_start
+from profiling import install as install_profiling
+from recorder import build_streamlink_command, select_rendition
+from rendition_policy import PolicySet
+from security_sanitizer import global_sanitizer
+from sentry_spool import init_sentry, start_sender
+from tracing import child_env, prune, span
+from transcode import CAPTURE_WORKERS, DEFAULT_FORMAT, pending, start_transcoder
 
 def get_validated_user():
     """Securely get and validate the USER environment variable."""
@@ -45,8 +64,80 @@ sys.path.append(f"/home/{user}/.config/tvselect-fr-live-stream")
 from config import (
     CRYPTED_CREDENTIALS,
     SENTRY_MONITORING_SDK,
+    TF1_EMAIL,
+    TF1_PASSWORD,
 )
 
+try:
+    from config import RENDITION_POLICIES
+except ImportError:
+    RENDITION_POLICIES = {}
+
+try:
+    from config import ACCOUNTS
+except ImportError:
+    ACCOUNTS = []
+
+try:
+    from config import ROLL_MINUTES
+except ImportError:
+    ROLL_MINUTES = 0
+
+try:
+    from config import PREBUFFER_MINUTES
+except ImportError:
+    PREBUFFER_MINUTES = 0
+
+try:
+    from config import PREBUFFER_MAX_MB
+except ImportError:
+    PREBUFFER_MAX_MB = DEFAULT_MAX_MB
+
+try:
+    from config import PREBUFFER_MAX_CHANNELS
+except ImportError:
+    PREBUFFER_MAX_CHANNELS = DEFAULT_MAX_CHANNELS
+
+try:
+    from config import OFFLOAD_TARGET
+except ImportError:
+    OFFLOAD_TARGET = None
+
+try:
+    from config import OFFLOAD_RATE_KBPS
+except ImportError:
+    OFFLOAD_RATE_KBPS = 0
+
+try:
+    from config import OFFLOAD_CONCURRENCY
+except ImportError:
+    OFFLOAD_CONCURRENCY = DEFAULT_CONCURRENCY
+
+try:
+    from config import TRANSCODE_ARGS
+except ImportError:
+    TRANSCODE_ARGS = None
+
+try:
+    from config import TRANSCODE_FORMAT
+except ImportError:
+    TRANSCODE_FORMAT = DEFAULT_FORMAT
+
+try:
+    from config import TRANSCODE_WORKERS
+except ImportError:
+    TRANSCODE_WORKERS = None
+
+try:
+    from config import TRANSCODE_CAPTURE_WORKERS
+except ImportError:
+    TRANSCODE_CAPTURE_WORKERS = CAPTURE_WORKERS
+
+try:
+    from config import TRANSCODE_KEEP_SOURCE
+except ImportError:
+    TRANSCODE_KEEP_SOURCE = True
+
 def get_tf1_credentials():
     """Retrieve TF1 credentials and return environment dict."""
     env = os.environ.copy()
@@ -89,14 +180,15 @@ def get_pass_entry(entry):
     - Validates output for control characters
     """
     try:
-        result = subprocess.run(
-            ["pass", entry],
-            capture_output=True,
-            text=True,
-            env=SAFE_PASS_ENV,
-            timeout=5,
-            check=False,
-        )
+        with span("scheduler.pass", entry=entry):
+            result = subprocess.run(
+                ["pass", entry],
+                capture_output=True,
+                text=True,
+                env=SAFE_PASS_ENV,
+                timeout=5,
+                check=False,
+            )
     except Exception:
         logger.exception(f"Error executing pass for entry '{entry}'")
         return None
@@ -117,6 +209,19 @@ def get_pass_entry(entry):
     return value
 
 
+def unlock_accounts(entries):
+    """Return the ACCOUNTS whose TV-Select credentials pass gives."""
+    accounts = []
+    for account in load_accounts(entries):
+        account.email = get_pass_entry(account.email_entry)
+        account.password = get_pass_entry(account.password_entry)
+        if account.email and account.password:
+            accounts.append(account)
+        else:
+            logger.error(f"Missing credentials for the account {account.name}, it is left out.")
+    return accounts
+
+
 def get_time_from_config():
     """Extracts CURL_HOUR and CURL_MINUTE from config.py."""
     if not os.path.isfile(CONFIG_PY_FILE):
@@ -135,48 +240,168 @@ def get_time_from_config():
     logger.error("Error: Could not extract CURL_HOUR or CURL_MINUTE from config.")
     return None, None
 
-def update_info_json(tv_email, tv_password):
-    """Fetch program data and update info_progs.json securely."""
-
+def get_recorder_env(env_with_creds):
+    """Environment of the recorders resumed from the capture journal."""
+    env = {
+        "PATH": "/usr/bin:/bin",
+        "HOME": os.environ["HOME"],
+        "TZ": "Europe/Paris",
+    }
+    email = env_with_creds.get("TF1_EMAIL", TF1_EMAIL)
+    password = env_with_creds.get("TF1_PASSWORD", TF1_PASSWORD)
+    if email and email != "XXXXXXXXXX" and password and password != "XXXXXXXXXX":
+        env["STREAMLINK_TF1_EMAIL"] = email
+        env["STREAMLINK_TF1_PASSWORD"] = password
+    return env
+
+
+async def launch_pass(env_with_creds):
+    process = await asyncio.create_subprocess_exec(
+        f"/home/{user}/.local/share/tvselect-fr-live-stream/.venv/bin/python3",
+        f"/home/{user}/tvselect-fr-live-stream/launch_stream_pass.py",
+        env=child_env(env_with_creds),
+    )
     try:
-        response = requests.get(API_URL,
-                                auth=(tv_email, tv_password),
-                                headers={"Accept": "application/json; indent=4"},
-                                timeout=5
-                            )
-        response.raise_for_status()
-    except Exception:
-        logger.exception("API request failed")
-        return False
+        await asyncio.wait_for(process.wait(), timeout=300)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        logger.error("launch_stream_pass.py timed out after 5 minutes")
 
-    try:
-        data = response.json()
-    except Exception:
-        logger.exception("Invalid JSON received from API")
-        return False
 
-    dest = f"/home/{user}/.local/share/tvselect-fr-live-stream/info_progs.json"
+async def daily_loop(tv_email, tv_password, env_with_creds, can_upgrade=lambda: True):
+    """
+    Fetch the schedule and hand it to the planner at CURL_HOUR:CURL_MINUTE;
+    return when an upgrade is pending and can_upgrade() allows it.
+    """
+    last_config_check = time.time()
+    curl_hour, curl_minute = get_time_from_config()
+
+    while True:
+        if state.upgrade_pending and can_upgrade():
+            return
+        if time.time() - last_config_check >= 3600:
+            curl_hour, curl_minute = get_time_from_config()
+            last_config_check = time.time()
+        state.next_run = f"{curl_hour}:{curl_minute}"
+
+        current_time = time.strftime("%H:%M")
+        if current_time == f"{curl_hour}:{curl_minute}":
+            state.busy = True
+            state.last_run = datetime.now().isoformat(timespec="seconds")
+            try:
+                with span("scheduler.run"):
+                    with span("scheduler.fetch"):
+                        update_json = await asyncio.to_thread(
+                            update_info_json, tv_email, tv_password
+                        )
+
+                    await asyncio.sleep(61)
+
+                    if update_json:
+                        with span("scheduler.launch"):
+                            await launch_pass(env_with_creds)
+                state.last_result = "planned" if update_json else "fetch failed"
+            except Exception:
+                state.last_result = "failed"
+                logger.exception("The daily scheduling run failed")
+            finally:
+                state.busy = False
+            await asyncio.to_thread(prune)
+
+        await asyncio.sleep(30)
+
+
+def request_upgrade():
+    # Taken at the top of the daily loop, never during a scheduling run.
+    logger.info("Upgrade requested, the scheduler will move to the installed release")
+    state.upgrade_pending = True
+
+
+def hand_over(server):
+    """Re-exec the installed scheduler_launch.py, keeping the control socket listening."""
+    handover = {"state": state.as_dict()}
+    fds = []
+    if server is not None and server.sockets:
+        handover["control_fd"] = server.sockets[0].fileno()
+        fds.append(handover["control_fd"])
+    reexec("scheduler_launch.py", handover, fds)
+
+
+def build_prebuffer(control, recorder_env):
+    """The pre-buffer of the channels about to be recorded, with the recorders' renditions."""
+    def targets():
+        return [
+            (programme.channel_url, control.policies.resolve(programme), programme.tf1,
+             next_start(programme.start))
+            for programme in control.upcoming()
+            if not programme.tf1 or control.can_process_tf1(programme.channel)
+        ]
+
+    return PreBuffer(
+        PREBUFFER_MINUTES,
+        targets,
+        lambda url, policy, tf1: select_rendition(url, "best", policy, tf1),
+        lambda url, quality, args, tf1: build_streamlink_command(
+            url, quality, args, tf1, recorder_env
+        ),
+        child_env(recorder_env),
+        max_mb=PREBUFFER_MAX_MB,
+        max_channels=PREBUFFER_MAX_CHANNELS,
+    )
+
+
+async def serve(control, tv_email, tv_password, env_with_creds, sock=None):
+    server = await start_server(control, sock=sock)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, request_upgrade)
+    if control.prebuffer is not None:
+        asyncio.create_task(control.prebuffer.serve())
+    postponed = False
+
+    def can_upgrade():
+        # The recorders reading the pre-buffer would lose their stream.
+        nonlocal postponed
+        if control.prebuffer is not None and control.prebuffer.reading():
+            if not postponed:
+                logger.info("Upgrade postponed while recorders read the pre-buffer")
+            postponed = True
+            return False
+        postponed = False
+        return True
 
     try:
-        with open(dest, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-    except Exception:
-        logger.exception("Failed to write info_progs.json")
-        return False
+        while True:
+            await daily_loop(tv_email, tv_password, env_with_creds, can_upgrade)
+            if control.prebuffer is not None:
+                # No reader can come in between can_upgrade() and close().
+                await control.prebuffer.close()
+            try:
+                hand_over(server)
+            except OSError:
+                logger.exception("Could not re-exec the scheduler, this one goes on")
+                state.upgrade_pending = False
+                if control.prebuffer is not None:
+                    control.prebuffer.closed = False
+    finally:
+        if server is not None:
+            server.close()
+            control_socket_path().unlink(missing_ok=True)
 
-    return True
+
+def update_info_json(tv_email, tv_password):
+    """Fetch program data and update info_progs.json securely."""
+    dest = f"/home/{user}/.local/share/tvselect-fr-live-stream/info_progs.json"
+    if accounts:
+        # One plan for all the accounts, from the schedules fetched.
+        fetched = fetch_all(accounts, API_URL)
+        if not fetched:
+            return False
+        merge(fetched, dest)
+        return True
+    return fetch_schedule(API_URL, tv_email, tv_password, dest)
 
 if SENTRY_MONITORING_SDK:
-    sentry_sdk.init(
-        dsn="https://0b40b1a24c605fd77fddb9219a45e594@o4508778574381056.ingest.de.sentry.io/4509938023268432",
-        send_default_pii=False,
-        include_local_variables=False,
-        traces_sample_rate=0,
-        before_send=scrub_event,
-    )
-    client = sentry_sdk.get_client()
-    if client and client.options.get("traces_sample_rate", 0) > 0:
-        sentry_sdk.profiler.start_profiler()
+    init_sentry()
 
 
 log_file = f"/home/{user}/.local/share/tvselect-fr-live-stream/logs/stream_record.log"
@@ -208,8 +433,15 @@ OUTPUT_FILE = os.path.expanduser("~/.local/share/tvselect-fr-live-stream/info_pr
 API_URL = "https://www.tv-select.fr/api/v1/prog"
 CONFIG_PY_FILE = os.path.expanduser("~/.config/tvselect-fr-live-stream/config.py")
 
+handover = take_handover() or {}
+state = SchedulerState.from_dict(handover.get("state", {}))
+accounts = []
+
 
 if __name__ == "__main__":
+    # An upgrade while starting up is taken once the daily loop runs.
+    signal.signal(signal.SIGHUP, lambda *_: request_upgrade())
+    advertise_handover("scheduler_launch.py")
 
     sensitive_filter = global_sanitizer
 
@@ -217,53 +449,84 @@ if __name__ == "__main__":
     sentry_handler.addFilter(sensitive_filter)
     logger.addFilter(sensitive_filter)
 
-    tv_email = get_pass_entry("tv-select/email")
-    tv_password = get_pass_entry("tv-select/password")
-    env_with_creds = get_tf1_credentials()
-
-    sensitive_filter.update_patterns(
-        {
-            "TV_SELECT_EMAIL": tv_email or "",
-            "TV_SELECT_PASSWORD": tv_password or "",
-            "TF1_EMAIL": env_with_creds.get("TF1_EMAIL", ""),
-            "TF1_PASSWORD": env_with_creds.get("TF1_PASSWORD", ""),
-        }
+    install_profiling("scheduler")
+
+    if SENTRY_MONITORING_SDK:
+        # Spooled events are sent from here, when no capture needs the link.
+        start_sender()
+
+    transcoding = TRANSCODE_ARGS and start_transcoder(
+        TRANSCODE_ARGS,
+        TRANSCODE_FORMAT,
+        TRANSCODE_WORKERS,
+        TRANSCODE_CAPTURE_WORKERS,
+        TRANSCODE_KEEP_SOURCE,
     )
 
-    if not tv_email or not tv_password:
+    if OFFLOAD_TARGET:
+        # Recordings are moved once transcoded, when they are.
+        hold = (lambda path: pending(path, TRANSCODE_FORMAT)) if transcoding else None
+        start_offloader(OFFLOAD_TARGET, OFFLOAD_RATE_KBPS, OFFLOAD_CONCURRENCY, hold=hold)
+
+    with span("scheduler.startup"):
+        if ACCOUNTS:
+            try:
+                accounts = unlock_accounts(ACCOUNTS)
+            except ValueError as e:
+                logger.error(f"Error: {e} in ACCOUNTS.")
+                exit(1)
+            tv_email = tv_password = None
+        else:
+            tv_email = get_pass_entry("tv-select/email")
+            tv_password = get_pass_entry("tv-select/password")
+        env_with_creds = get_tf1_credentials()
+
+    secrets = {
+        "TV_SELECT_EMAIL": tv_email or "",
+        "TV_SELECT_PASSWORD": tv_password or "",
+        "TF1_EMAIL": env_with_creds.get("TF1_EMAIL", ""),
+        "TF1_PASSWORD": env_with_creds.get("TF1_PASSWORD", ""),
+    }
+    for account in accounts:
+        secrets[f"TV_SELECT_EMAIL_{account.name}"] = account.email
+        secrets[f"TV_SELECT_PASSWORD_{account.name}"] = account.password
+    sensitive_filter.update_patterns(secrets)
+
+    # Programmes cut by a reboot or a crash are resumed before anything else.
+    with span("scheduler.recover") as recover_span:
+        try:
+            resumed = recover(child_env(get_recorder_env(env_with_creds)))
+            recover_span.set(resumed=len(resumed))
+        except Exception:
+            logger.exception("Could not replay the capture journal")
+
+    if not accounts and (not tv_email or not tv_password):
         logger.error("Error: Missing credentials.")
         exit(1)
 
-    last_config_check = time.time()
-    curl_hour, curl_minute = get_time_from_config()
+    recorder_env = get_recorder_env(env_with_creds)
+    safe_env = {
+        key: value for key, value in recorder_env.items()
+        if not key.startswith("STREAMLINK_TF1_")
+    }
+    control = SchedulerControl(
+        state,
+        safe_env,
+        recorder_env,
+        lambda channel: "STREAMLINK_TF1_EMAIL" in recorder_env,
+        policies=PolicySet(RENDITION_POLICIES),
+        roll_minutes=ROLL_MINUTES,
+        log_file=log_file,
+    )
+    if PREBUFFER_MINUTES:
+        control.prebuffer = build_prebuffer(control, recorder_env)
 
-    while True:
-        if time.time() - last_config_check >= 3600:
-            curl_hour, curl_minute = get_time_from_config()
-            last_config_check = time.time()
+    control_sock = None
+    if "control_fd" in handover:
+        control_sock = socket.socket(fileno=handover["control_fd"])
+        control_sock.set_inheritable(False)
 
-        current_time = time.strftime("%H:%M")
-        if current_time == f"{curl_hour}:{curl_minute}":
-            update_json = update_info_json(tv_email, tv_password)
-
-            time.sleep(61)
-
-            if update_json:
-                try:
-                    result = subprocess.run(
-                        [
-                            f"/home/{user}/.local/share/tvselect-fr-live-stream/"
-                            ".venv/bin/python3",
-                            f"/home/{user}/tvselect-fr-live-stream/"
-                            "launch_stream_pass.py"
-                        ],
-                        env=env_with_creds,
-                        timeout=300
-                    )
-                except subprocess.TimeoutExpired:
-                    logger.error(
-                        "launch_stream_pass.py timed out after 5 minutes"
-                    )
-
-
-        time.sleep(30)
+    try:
+        asyncio.run(serve(control, tv_email, tv_password, env_with_creds, control_sock))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,286 @@
+"""
+Keyframe seek index for MPEG-TS recordings.
+
+The recorder feeds every chunk it writes to a SeekIndexBuilder, which
+picks the random access points of the video stream and appends
+(pts, byte offset) pairs to a binary sidecar next to the recording:
+
+    header: b"TSIDX\\x00\\x01\\x00" + first PTS (uint64, 90 kHz)
+    entry:  PTS since the first keyframe (uint64, 90 kHz) + byte offset (uint64)
+
+SeekIndex loads a sidecar and answers time to offset lookups with bisect.
+"""
+import bisect
+import struct
+
+TS_PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"TSIDX\x00\x01\x00"
+HEADER = struct.Struct("<8sQ")
+ENTRY = struct.Struct("<QQ")
+
+PTS_CLOCK = 90_000
+PTS_WRAP = 1 << 33
+FLUSH_EVERY = 8
+
+H264_IDR = 5
+HEVC_IRAP = range(16, 22)
+HEVC_AUD = 35
+
+
+def index_path(recording_path):
+    return str(recording_path) + INDEX_SUFFIX
+
+
+def _parse_pes_pts(payload):
+    """Return (stream_id, pts) of a PES header, pts being None when absent."""
+    if len(payload) < 9 or payload[:3] != b"\x00\x00\x01":
+        return None, None
+
+    stream_id = payload[3]
+    if not payload[7] & 0x80 or len(payload) < 14:
+        return stream_id, None
+
+    p = payload[9:14]
+    pts = (
+        ((p[0] >> 1) & 0x07) << 30
+        | p[1] << 22
+        | (p[2] >> 1) << 15
+        | p[3] << 7
+        | p[4] >> 1
+    )
+    return stream_id, pts
+
+
+def _nal_headers(payload):
+    """Yield the first header byte of every NAL unit in a PES payload."""
+    start = payload.find(b"\x00\x00\x01", 9 + payload[8])
+    while start != -1 and start + 3 < len(payload):
+        yield payload[start + 3]
+        start = payload.find(b"\x00\x00\x01", start + 3)
+
+
+def _has_keyframe_nal(payload):
+    """
+    Look for an H.264 IDR or HEVC IRAP NAL unit in the first payload.
+
+    The codec is told apart by the access unit delimiter opening the
+    payload, H.264 being assumed when there is none.
+    """
+    hevc = None
+    for header in _nal_headers(payload):
+        if hevc is None:
+            hevc = (header >> 1) & 0x3F == HEVC_AUD
+        if hevc and (header >> 1) & 0x3F in HEVC_IRAP:
+            return True
+        if not hevc and header & 0x1F == H264_IDR:
+            return True
+    return False
+
+
+def _pmt_pids(packet, start):
+    """Return the PMT PIDs listed by a PAT packet."""
+    payload = packet[start:]
+    if not payload:
+        return set()
+    section = payload[1 + payload[0]:]
+    if len(section) < 8:
+        return set()
+    end = min(3 + (((section[1] & 0x0F) << 8) | section[2]) - 4, len(section))
+    pids = set()
+    for pos in range(8, end - 3, 4):
+        if section[pos] or section[pos + 1]:  # program 0 is the network PID
+            pids.add(((section[pos + 2] & 0x1F) << 8) | section[pos + 3])
+    return pids
+
+
+class KeyframeScanner:
+    """
+    Find the keyframes of the video stream in whole TS packets.
+
+    Only packets starting a PES or a table are inspected; a packet is a
+    keyframe when its adaptation field sets random_access_indicator or
+    when its payload holds an IDR/IRAP NAL unit. The last PAT and PMT
+    packets seen are kept, as a file starting at a keyframe needs them
+    in front to be playable.
+    """
+
+    def __init__(self):
+        self._video_pids = set()
+        self._pmt_pids = set()
+        self._pat = b""
+        self._pmts = {}
+
+    def scan(self, buffer, base):
+        """Yield (pts, offset) for the keyframes of buffer, which starts at offset base."""
+        for pos in range(0, len(buffer) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+            if buffer[pos] != SYNC_BYTE or not buffer[pos + 1] & 0x40:
+                continue
+            pts = self._inspect(buffer[pos:pos + TS_PACKET_SIZE])
+            if pts is not None:
+                yield pts, base + pos
+
+    def tables(self):
+        """The last PAT and PMT packets, as bytes."""
+        return bytes(self._pat) + b"".join(bytes(pmt) for pmt in self._pmts.values())
+
+    def _inspect(self, packet):
+        pid = ((packet[1] & 0x1F) << 8) | packet[2]
+        control = (packet[3] >> 4) & 0x03
+        if not control & 0x01:
+            return None
+
+        start = 4
+        random_access = False
+        if control & 0x02:
+            length = packet[4]
+            random_access = length > 0 and bool(packet[5] & 0x40)
+            start = 5 + length
+
+        if pid == 0:
+            self._pat = packet
+            self._pmt_pids = _pmt_pids(packet, start)
+            return None
+        if pid in self._pmt_pids:
+            self._pmts[pid] = packet
+            return None
+
+        stream_id, pts = _parse_pes_pts(packet[start:])
+        if stream_id is None:
+            return None
+        if 0xE0 <= stream_id <= 0xEF:
+            self._video_pids.add(pid)
+        if pid not in self._video_pids or pts is None:
+            return None
+
+        if random_access or _has_keyframe_nal(packet[start:]):
+            return pts
+        return None
+
+
+class SeekIndexBuilder:
+    """
+    Build the sidecar index incrementally from the bytes being recorded.
+
+    With resume_from, the recording already holds that many bytes (the
+    capture was handed over by another recorder process): the index is
+    appended to, and the end of the last packet is read back from the
+    recording.
+    """
+
+    def __init__(self, path, flush_every=FLUSH_EVERY, resume_from=0):
+        self.path = path
+        self.flush_every = flush_every
+        self.entries = 0
+        self._file = None
+        self._carry = b""
+        self._offset = 0
+        self._scanner = KeyframeScanner()
+        self._first_pts = None
+        self._last_pts = None
+        self._wraps = 0
+        self._pending = []
+        if resume_from:
+            self._resume(resume_from)
+
+    def _resume(self, offset):
+        recording = self.path[:-len(INDEX_SUFFIX)]
+        with open(recording, "rb") as f:
+            f.seek(offset - offset % TS_PACKET_SIZE)
+            self._carry = f.read(offset % TS_PACKET_SIZE)
+        self._offset = offset
+
+        try:
+            index = SeekIndex(self.path)
+        except (OSError, ValueError):
+            return
+        self._first_pts = index.first_pts
+        self._last_pts = index.first_pts
+        if index.pts:
+            pts = index.first_pts + index.pts[-1]
+            self._wraps, self._last_pts = divmod(pts, PTS_WRAP)
+        self.entries = len(index)
+        self._file = open(self.path, "r+b")
+        self._file.seek(HEADER.size + self.entries * ENTRY.size)
+        self._file.truncate()
+
+    def feed(self, data):
+        """Index data, the next bytes written to the recording."""
+        buffer = self._carry + data if self._carry else data
+        base = self._offset - len(self._carry)
+        end = len(buffer) - len(buffer) % TS_PACKET_SIZE
+
+        for pts, offset in self._scanner.scan(buffer[:end], base):
+            self._add(pts, offset)
+
+        self._carry = buffer[end:]
+        self._offset += len(data)
+
+    def _add(self, pts, offset):
+        if self._first_pts is None:
+            self._first_pts = pts
+            self._file = open(self.path, "wb")
+            self._file.write(HEADER.pack(INDEX_MAGIC, pts))
+        elif pts < self._last_pts - PTS_WRAP // 2:
+            self._wraps += 1
+        self._last_pts = pts
+
+        elapsed = pts + self._wraps * PTS_WRAP - self._first_pts
+        if elapsed < 0:
+            return
+
+        self._pending.append(ENTRY.pack(elapsed, offset))
+        self.entries += 1
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self._file and self._pending:
+            self._file.write(b"".join(self._pending))
+            self._file.flush()
+            self._pending = []
+
+    def close(self):
+        self.flush()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class SeekIndex:
+    """Time to byte offset lookups over a sidecar written by SeekIndexBuilder."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+
+        if len(data) < HEADER.size:
+            raise ValueError(f"Seek index {path} is too short")
+
+        magic, self.first_pts = HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{path} is not a seek index")
+
+        # A concurrent writer may have flushed half an entry.
+        body = data[HEADER.size:]
+        body = body[:len(body) - len(body) % ENTRY.size]
+        entries = list(ENTRY.iter_unpack(body))
+        self.pts = [pts for pts, _ in entries]
+        self.offsets = [offset for _, offset in entries]
+
+    def __len__(self):
+        return len(self.pts)
+
+    def lookup(self, seconds):
+        """Return the byte offset of the last keyframe at or before seconds."""
+        if not self.pts:
+            return 0
+        i = bisect.bisect_right(self.pts, int(seconds * PTS_CLOCK)) - 1
+        return self.offsets[max(i, 0)]
+
+    def keyframes(self):
+        """Yield (seconds, offset) for every indexed keyframe."""
+        for pts, offset in zip(self.pts, self.offsets):
+            yield pts / PTS_CLOCK, offset
@@ -0,0 +1,292 @@
+"""
+Disk-backed queue for Sentry events.
+
+With SENTRY_MONITORING_SDK on, init_sentry() installs SpoolTransport:
+every envelope, already scrubbed by scrub_event (before_send), is
+appended to a bounded spool under ~/.local/share/tvselect-fr-live-stream
+instead of being sent inline. The scheduler daemon runs a SpoolSender
+that drains the spool in small, rate-limited batches while no capture is
+using the link, and keeps the events on disk while Sentry is unreachable.
+
+For testing, `sentry_spool.py ingest` runs a stand-in ingest endpoint and
+TVSELECT_SENTRY_DSN points the scripts at it, e.g.
+http://key@127.0.0.1:8797/1.
+"""
+import argparse
+import fcntl
+import logging
+import os
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import requests
+import sentry_sdk
+
+from sentry_sdk.transport import Transport
+from sentry_sdk.utils import Dsn
+
+from resource_governor import find_capture_processes
+from security_sanitizer import scrub_event
+
+logger = logging.getLogger("__name__")
+
+SENTRY_DSN = "https://0b40b1a24c605fd77fddb9219a45e594@o4508778574381056.ingest.de.sentry.io/4509938023268432"
+
+SPOOL_DIR = Path.home() / ".local/share/tvselect-fr-live-stream/sentry_spool"
+MAX_SPOOL_EVENTS = 500
+MAX_SPOOL_BYTES = 10 * 1024 * 1024
+
+BATCH_SIZE = 10
+SEND_INTERVAL = 30.0  # seconds between two batches
+MIN_SEND_GAP = 1.0  # seconds between two envelopes of a batch
+RETRY_AFTER_DEFAULT = 60.0
+SEND_TIMEOUT = 10
+
+ENVELOPE_SUFFIX = ".envelope"
+
+
+def sentry_dsn():
+    return os.environ.get("TVSELECT_SENTRY_DSN", SENTRY_DSN)
+
+
+class SentrySpool:
+    """A directory of envelope files, oldest first, bounded in count and size."""
+
+    def __init__(self, directory=SPOOL_DIR, max_events=MAX_SPOOL_EVENTS,
+                 max_bytes=MAX_SPOOL_BYTES):
+        self.directory = Path(directory)
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def append(self, payload):
+        name = f"{time.time_ns():020d}-{os.getpid()}"
+        tmp = self.directory / (name + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(payload)
+        os.replace(tmp, self.directory / (name + ENVELOPE_SUFFIX))
+        self._trim()
+
+    def pending(self):
+        return sorted(self.directory.glob("*" + ENVELOPE_SUFFIX))
+
+    def _trim(self):
+        entries = []
+        for path in self.pending():
+            try:
+                entries.append((path, path.stat().st_size))
+            except FileNotFoundError:
+                continue
+
+        total = sum(size for _, size in entries)
+        dropped = 0
+        while entries and (len(entries) > self.max_events or total > self.max_bytes):
+            path, size = entries.pop(0)
+            path.unlink(missing_ok=True)
+            total -= size
+            dropped += 1
+        if dropped:
+            logger.warning("Sentry spool full: dropped the %d oldest events", dropped)
+
+
+class SpoolTransport(Transport):
+    """Sentry transport writing envelopes to the spool instead of the network."""
+
+    def __init__(self, options=None):
+        super().__init__(options)
+        self.spool = SentrySpool()
+
+    def capture_envelope(self, envelope):
+        try:
+            self.spool.append(envelope.serialize())
+        except OSError:
+            logger.warning("Could not spool a Sentry event", exc_info=True)
+
+
+def init_sentry():
+    """Initialise sentry_sdk with the scrubber and the spooling transport."""
+    sentry_sdk.init(
+        dsn=sentry_dsn(),
+        send_default_pii=False,
+        include_local_variables=False,
+        before_send=scrub_event,
+        traces_sample_rate=0,
+        transport=SpoolTransport,
+    )
+    client = sentry_sdk.get_client()
+    if client and client.options.get("traces_sample_rate", 0) > 0:
+        sentry_sdk.profiler.start_profiler()
+
+
+def link_idle():
+    """The link is idle when no recording is running."""
+    return not find_capture_processes()
+
+
+class SpoolSender:
+    """Send the spooled envelopes to Sentry in rate-limited batches."""
+
+    def __init__(self, spool=None, dsn=None, session=None, is_idle=link_idle,
+                 batch_size=BATCH_SIZE, min_gap=MIN_SEND_GAP, sleep=time.sleep):
+        self.spool = spool or SentrySpool()
+        auth = Dsn(dsn or sentry_dsn()).to_auth(f"tvselect-fr-live-stream/{sentry_sdk.VERSION}")
+        self.url = auth.get_api_url()
+        self.headers = {
+            "Content-Type": "application/x-sentry-envelope",
+            "X-Sentry-Auth": auth.to_header(),
+        }
+        self.session = session or requests.Session()
+        self.is_idle = is_idle
+        self.batch_size = batch_size
+        self.min_gap = min_gap
+        self.sleep = sleep
+        self.blocked_until = 0.0
+
+    def send_batch(self):
+        """Send up to batch_size envelopes; return how many were delivered."""
+        if time.monotonic() < self.blocked_until or not self.is_idle():
+            return 0
+
+        sent = 0
+        for i, path in enumerate(self.spool.pending()[:self.batch_size]):
+            if i:
+                self.sleep(self.min_gap)
+            try:
+                payload = path.read_bytes()
+            except FileNotFoundError:
+                continue
+
+            try:
+                response = self.session.post(
+                    self.url, data=payload, headers=self.headers, timeout=SEND_TIMEOUT
+                )
+            except requests.RequestException:
+                # Offline: keep everything for the next batch.
+                logger.info("Sentry unreachable, %d events kept in the spool",
+                            len(self.spool.pending()))
+                break
+
+            if response.status_code == 429:
+                retry_after = response.headers.get("Retry-After")
+                try:
+                    delay = float(retry_after)
+                except (TypeError, ValueError):
+                    delay = RETRY_AFTER_DEFAULT
+                self.blocked_until = time.monotonic() + delay
+                logger.info("Sentry rate limit: sending paused for %.0fs", delay)
+                break
+            if response.status_code >= 500:
+                break
+            if response.status_code >= 400:
+                # Sentry will never accept it, do not retry forever.
+                logger.warning("Sentry rejected a spooled event (HTTP %d)", response.status_code)
+            else:
+                sent += 1
+            path.unlink(missing_ok=True)
+        return sent
+
+    def run(self, stop, interval=SEND_INTERVAL):
+        lock = open(self.spool.directory / ".sender.lock", "w")
+        try:
+            # A single sender per spool, whichever process started first.
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return
+        try:
+            while not stop.is_set():
+                try:
+                    self.send_batch()
+                except Exception:
+                    logger.warning("Sentry spool sender failed", exc_info=True)
+                stop.wait(interval)
+        finally:
+            lock.close()
+
+
+def start_sender(stop=None):
+    """Run a SpoolSender in a daemon thread; return the event stopping it."""
+    stop = stop or threading.Event()
+    thread = threading.Thread(
+        target=SpoolSender().run, args=(stop,), name="sentry-spool", daemon=True
+    )
+    thread.start()
+    return stop
+
+
+class IngestHandler(BaseHTTPRequestHandler):
+    """Stand-in for the Sentry ingest endpoint, storing what it receives."""
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        status = self.server.status
+        if status < 300:
+            self.server.received += 1
+            out = self.server.output / f"{self.server.received:06d}{ENVELOPE_SUFFIX}"
+            out.write_bytes(body)
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "5")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+        print(f"{self.path} {len(body)} bytes -> HTTP {status}", flush=True)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sentry event spool.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    drain = sub.add_parser("drain", help="send the spooled events now")
+    drain.add_argument("--force", action="store_true", help="send even while recording")
+
+    ingest = sub.add_parser("ingest", help="run a local stand-in ingest endpoint")
+    ingest.add_argument("--host", default="127.0.0.1")
+    ingest.add_argument("--port", type=int, default=8797)
+    ingest.add_argument("--status", type=int, default=200, help="HTTP status to answer")
+    ingest.add_argument("--output", default="sentry_ingest", help="where to store envelopes")
+
+    sub.add_parser("status", help="show the spooled events")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.command == "status":
+        pending = SentrySpool().pending()
+        print(f"{len(pending)} events, {sum(p.stat().st_size for p in pending)} bytes")
+        return 0
+
+    if args.command == "drain":
+        sender = SpoolSender(is_idle=(lambda: True) if args.force else link_idle)
+        total = 0
+        while True:
+            before = len(sender.spool.pending())
+            total += sender.send_batch()
+            if not before or len(sender.spool.pending()) >= before:
+                break
+        print(f"{total} events sent, {len(sender.spool.pending())} left")
+        return 0
+
+    server = ThreadingHTTPServer((args.host, args.port), IngestHandler)
+    server.status = args.status
+    server.received = 0
+    server.output = Path(args.output)
+    server.output.mkdir(parents=True, exist_ok=True)
+    print(f"Ingest on http://key@{args.host}:{args.port}/1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,510 @@
+"""
+Replay days of scheduling on a virtual clock.
+
+The daily run of the scheduler, the at jobs and the captures are events
+on a virtual clock, so a week of schedules plays in seconds. What makes
+the decisions is the real code: programme.load_programmes,
+planner.build_jobs and planner.submit_jobs (against a fake `at` queueing
+every step at planner.scheduled_at, like atd), recorder.py's own parser
+on the scripts submitted, the capture journal and
+capture_journal.recover after a crash. pass, the TV-Select API, atd and
+the streams are fakes, failing as often as --failures says:
+
+    fetch    the daily fetch of the schedule fails
+    pass     a pass lookup fails when the scheduler starts
+    submit   an `at` submission fails
+    stream   the stream of a capture drops before its end
+    crash    crashes of the box per day, each down for --reboot seconds
+
+The report gives the lateness of the captures against the programme
+times, the programmes missed and why, the share of the planned seconds
+recorded, and the peaks of concurrent captures, bandwidth, memory and
+disk. --json prints it for comparison between runs.
+
+Usage: python3 simulate.py [--days N] [--programmes N | --schedule FILE ...]
+                           [--curl HH:MM] [--failures fetch=0.05,stream=0.02,crash=0.1]
+                           [--seed N] [--json]
+"""
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import shlex
+import sys
+import tempfile
+import time
+
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+
+# Simulated runs must not fill the real trace files.
+os.environ["TVSELECT_TRACE"] = "0"
+
+from bench_planner import generate_schedule, parse_mix
+from capture_journal import CaptureJournal, recover
+from channels_url import CHANNELS_URL
+from planner import build_jobs, scheduled_at, submit_jobs
+from programme import load_programmes, parse_duration
+from recorder import DEFAULT_BITRATE_KBPS, build_parser
+
+FAILURES = ("fetch", "pass", "submit", "stream", "crash")
+
+# The daily loop sleeps this long between the fetch and the planner.
+PLAN_DELAY = 61.0
+CAPTURE_RSS_MB = 90
+SHIFTED = 12 * 3600
+
+SAFE_ENV = {"PATH": "/usr/bin:/bin", "HOME": "/home/simulated", "TZ": "Europe/Paris"}
+TF1_ENV = {**SAFE_ENV, "STREAMLINK_TF1_EMAIL": "x", "STREAMLINK_TF1_PASSWORD": "x"}
+
+
+def parse_failures(text):
+    failures = {}
+    for item in filter(None, text.split(",")):
+        kind, _, rate = item.partition("=")
+        if kind.strip() not in FAILURES:
+            raise ValueError(f"Unknown failure {kind!r}, one of {', '.join(FAILURES)}")
+        failures[kind.strip()] = float(rate)
+    return failures
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class VirtualClock:
+    """Time only moves when the next event runs."""
+
+    def __init__(self, start):
+        self.now = start
+        self._events = []
+        self._order = itertools.count()
+
+    def datetime(self):
+        return datetime.fromtimestamp(self.now)
+
+    def at(self, when, action, *args):
+        heapq.heappush(self._events, (when, next(self._order), action, args))
+
+    def run(self, until):
+        while self._events and self._events[0][0] <= until:
+            when, _, action, args = heapq.heappop(self._events)
+            self.now = max(self.now, when)
+            action(*args)
+        self.now = until
+
+
+class Peak:
+    def __init__(self):
+        self.value = 0
+        self.peak = 0
+        self.at = None
+
+    def add(self, amount, now):
+        self.value += amount
+        if self.value > self.peak:
+            self.peak = self.value
+            self.at = now
+
+
+class Occurrence:
+    """One programme of a daily plan, and what became of it."""
+
+    def __init__(self, programme, start):
+        self.title = programme.title
+        self.channel = programme.channel
+        self.start = start
+        self.seconds = programme.seconds
+        self.due = None
+        self.missed = None
+        self.first_byte = None
+        self.end = None
+        self.recorded = 0.0
+        self.parts = 0
+
+
+class FakeAt:
+    """planner backend handing the steps to the simulation instead of `at`."""
+
+    def __init__(self, simulation):
+        self.simulation = simulation
+
+    def submit(self, step):
+        return self.simulation.submit(step)
+
+
+class Simulation:
+    def __init__(self, schedules, start, days, curl, failures, workdir, rng,
+                 at_jitter=2.0, startup=4.0, reboot=120.0, bitrate_kbps=DEFAULT_BITRATE_KBPS):
+        self.clock = VirtualClock(start)
+        self.schedules = schedules
+        self.start = start
+        self.days = days
+        self.curl = curl
+        self.failures = failures
+        self.workdir = Path(workdir)
+        self.journal_dir = self.workdir / "journal"
+        self.rng = rng
+        self.at_jitter = at_jitter
+        self.startup = startup
+        self.reboot = reboot
+        self.bitrate_kbps = bitrate_kbps
+        self.parser = build_parser()
+
+        self.occurrences = []
+        self._planning = []
+        self.by_output = {}
+        self.running = {}
+        self.down_until = 0.0
+        self.tv_credentials = True
+        self.tf1_credentials = True
+        self.stats = Counter()
+        self.plan_times = []
+        self.captures = Peak()
+        self.bandwidth = Peak()
+        self.memory = Peak()
+        self.disk_per_day = Counter()
+
+    def failed(self, kind):
+        return self.rng.random() < self.failures.get(kind, 0.0)
+
+    def schedule_events(self):
+        self.clock.at(self.start, self.start_scheduler)
+        hour, minute = map(int, self.curl.split(":"))
+        first = datetime.fromtimestamp(self.start)
+        for day in range(self.days):
+            run = (first + timedelta(days=day)).replace(hour=hour, minute=minute, second=0)
+            self.clock.at(run.timestamp(), self.daily_run, day)
+        rate = self.failures.get("crash", 0.0)
+        if rate:
+            end = self.start + self.days * 86400
+            when = self.start + self.rng.expovariate(rate / 86400)
+            while when < end:
+                self.clock.at(when, self.crash)
+                when += self.rng.expovariate(rate / 86400)
+
+    def run(self):
+        self.schedule_events()
+        # One more day for the captures started on the last one.
+        self.clock.run(self.start + (self.days + 1) * 86400)
+
+    # The scheduler daemon.
+
+    def start_scheduler(self):
+        self.tv_credentials = not self.failed("pass")
+        self.tf1_credentials = not self.failed("pass")
+        if not self.tv_credentials:
+            self.stats["scheduler exits, no credentials"] += 1
+        # Programmes cut by the crash are resumed before anything else.
+        env = TF1_ENV if self.tf1_credentials else SAFE_ENV
+        resumed = recover(env, now=self.clock.now, directory=self.journal_dir, launcher=self.resume)
+        self.stats["captures resumed"] += len(resumed)
+
+    def daily_run(self, day):
+        if self.clock.now < self.down_until:
+            self.stats["daily runs missed, box down"] += 1
+            return
+        if not self.tv_credentials:
+            self.stats["daily runs missed, scheduler down"] += 1
+            return
+        entries = self.schedules(day, self.clock.datetime())
+        if self.failed("fetch"):
+            self.stats["fetches failed"] += 1
+            self._miss_all(entries, "fetch failed")
+            return
+        self.clock.at(self.clock.now + PLAN_DELAY, self.plan, entries, self.clock.datetime())
+
+    def _miss_all(self, entries, reason):
+        path = self.workdir / "info_progs.json"
+        path.write_text(json.dumps(entries), encoding="utf-8")
+        programmes, _ = load_programmes(path, CHANNELS_URL)
+        for programme in programmes:
+            occurrence = Occurrence(programme, scheduled_at(programme.start, self.clock.datetime()))
+            occurrence.missed = reason
+            self.occurrences.append(occurrence)
+
+    def plan(self, entries, fetched):
+        if self.clock.now < self.down_until:
+            self._miss_all(entries, "box down")
+            return
+        started = time.perf_counter()
+        path = self.workdir / "info_progs.json"
+        path.write_text(json.dumps(entries), encoding="utf-8")
+        programmes, invalid = load_programmes(path, CHANNELS_URL)
+        self.stats["invalid programmes"] += len(invalid)
+
+        self._planning = []
+        for programme in programmes:
+            # The programme time as it was meant when the schedule was fetched.
+            occurrence = Occurrence(programme, scheduled_at(programme.start, fetched))
+            self._planning.append((programme, occurrence))
+            self.occurrences.append(occurrence)
+
+        jobs = build_jobs(
+            programmes, lambda channel: self.tf1_credentials, SAFE_ENV, TF1_ENV,
+        )
+        # One worker: the order of the random draws stays the same.
+        submit_jobs(jobs, None, FakeAt(self), max_workers=1)
+        self.plan_times.append(time.perf_counter() - started)
+
+        for programme, occurrence in self._planning:
+            if occurrence.due is None and occurrence.missed is None:
+                no_tf1 = programme.tf1 and not self.tf1_credentials
+                occurrence.missed = "no TF1 credentials" if no_tf1 else "submission failed"
+
+    def submit(self, step):
+        if self.failed("submit"):
+            return 1, b"Can't open /var/run/atd.pid to signal atd. No atd running?\n"
+        due = scheduled_at(step.when, self.clock.datetime())
+        if step.kind == "record":
+            args = self.recorder_args(step.script)
+            occurrence = self._planned(args.output, step.when)
+            if occurrence is not None:
+                occurrence.due = due
+                if due - occurrence.start > SHIFTED:
+                    occurrence.missed = "shifted to the next day"
+            self.clock.at(due + self.rng.uniform(0, self.at_jitter), self.run_job, args, occurrence)
+        return 0, b""
+
+    def _planned(self, output, when):
+        for programme, occurrence in self._planning:
+            if programme.start == when and output.endswith("/" + programme.filename):
+                if occurrence.due is None:
+                    return occurrence
+        return None
+
+    def recorder_args(self, script):
+        words = shlex.split(script)
+        first = next(i for i, word in enumerate(words) if word.endswith("recorder.py")) + 1
+        last = words.index("2>&1") if "2>&1" in words else len(words)
+        return self.parser.parse_args(words[first:last])
+
+    # atd and the recorders.
+
+    def run_job(self, args, occurrence):
+        if self.clock.now < self.down_until:
+            # atd runs the jobs it missed once the box is up again.
+            self.clock.at(self.down_until, self.run_job, args, occurrence)
+            return
+        self.start_capture(args, occurrence)
+
+    def resume(self, recorder_args, log_name, env):
+        args = self.parser.parse_args(recorder_args)
+        self.start_capture(args, self.by_output.get(args.continues))
+
+    def start_capture(self, args, occurrence):
+        now = self.clock.now
+        if args.output in self.running:
+            self.stats["captures refused, output exists"] += 1
+            return
+        duration = parse_duration(args.duration)
+        journal = CaptureJournal(
+            args.output, args.url, args.quality, args.streamlink_args,
+            {"tf1": args.tf1, "priority": args.priority},
+            planned_end=now + duration,
+            part=args.part,
+            programme=args.continues,
+            directory=self.journal_dir,
+        )
+        journal.write()
+        capture = {
+            "output": args.output,
+            "journal": journal,
+            "occurrence": occurrence,
+            "first_byte": now + self.rng.uniform(0.5, 1.5) * self.startup,
+            "ended": False,
+        }
+        self.running[args.output] = capture
+        self.by_output[args.output] = occurrence
+        if occurrence is not None and occurrence.first_byte is None:
+            occurrence.first_byte = capture["first_byte"]
+
+        end, reason = now + duration, "end"
+        if self.failed("stream"):
+            end, reason = self.rng.uniform(capture["first_byte"], end), "stream"
+        self.clock.at(end, self.end_capture, capture, reason)
+        self._use(+1)
+
+    def _use(self, sign):
+        now = self.clock.now
+        self.captures.add(sign, now)
+        self.bandwidth.add(sign * self.bitrate_kbps, now)
+        self.memory.add(sign * CAPTURE_RSS_MB, now)
+
+    def _stop(self, capture):
+        capture["ended"] = True
+        self.running.pop(capture["output"], None)
+        self._use(-1)
+        seconds = max(self.clock.now - capture["first_byte"], 0.0)
+        written = int(seconds * self.bitrate_kbps * 1000 / 8)
+        self.disk_per_day[int((self.clock.now - self.start) // 86400)] += written
+        occurrence = capture["occurrence"]
+        if occurrence is not None:
+            occurrence.recorded += seconds
+            occurrence.parts += 1
+        return written
+
+    def end_capture(self, capture, reason):
+        if capture["ended"]:
+            return
+        self._stop(capture)
+        capture["journal"].remove()
+        if reason == "stream":
+            self.stats["streams dropped"] += 1
+        elif capture["occurrence"] is not None:
+            capture["occurrence"].end = self.clock.now
+
+    def crash(self):
+        if self.clock.now < self.down_until:
+            return
+        self.stats["crashes"] += 1
+        for capture in list(self.running.values()):
+            # Left in the journal as a killed recorder leaves it.
+            capture["journal"].bytes_written = self._stop(capture)
+            capture["journal"].write()
+        self.down_until = self.clock.now + self.reboot
+        self.clock.at(self.down_until, self.start_scheduler)
+
+    def report(self):
+        meant = [o for o in self.occurrences if o.missed != "shifted to the next day"]
+        on_time = [o for o in meant if not o.missed]
+        start_lateness = [o.first_byte - o.start for o in on_time if o.first_byte is not None]
+        end_lateness = [o.end - (o.start + o.seconds) for o in on_time if o.end is not None]
+        planned_seconds = sum(o.seconds for o in meant)
+        recorded_seconds = sum(min(o.recorded, o.seconds) for o in on_time)
+        missed = Counter(o.missed for o in self.occurrences if o.missed)
+        missed.update(
+            "no capture" for o in on_time if o.first_byte is None
+        )
+
+        def summary(values):
+            if not values:
+                return None
+            return {
+                "mean": round(sum(values) / len(values), 3),
+                "p95": round(percentile(values, 0.95), 3),
+                "max": round(max(values), 3),
+            }
+
+        def when(peak):
+            return datetime.fromtimestamp(peak.at).isoformat(timespec="seconds") if peak.at else None
+
+        return {
+            "days": self.days,
+            "programmes": len(self.occurrences),
+            "recorded": sum(1 for o in on_time if o.recorded),
+            "complete": sum(1 for o in on_time if o.end is not None),
+            "missed": dict(missed),
+            "start_lateness_s": summary(start_lateness),
+            "end_lateness_s": summary(end_lateness),
+            "coverage": round(recorded_seconds / planned_seconds, 4) if planned_seconds else None,
+            "events": dict(self.stats),
+            "peak_captures": {"value": self.captures.peak, "at": when(self.captures)},
+            "peak_bandwidth_mbps": {"value": self.bandwidth.peak / 1000, "at": when(self.bandwidth)},
+            "peak_memory_mb": {"value": self.memory.peak, "at": when(self.memory)},
+            "disk_gb_per_day": {
+                "mean": round(sum(self.disk_per_day.values()) / self.days / 1e9, 2),
+                "max": round(max(self.disk_per_day.values(), default=0) / 1e9, 2),
+            },
+            "plan_ms": summary([t * 1000 for t in self.plan_times]),
+        }
+
+
+def print_report(report, elapsed):
+    print(f"Replayed {report['days']} days in {elapsed:.1f}s")
+    print(
+        f"programmes        {report['programmes']}: {report['complete']} complete, "
+        f"{report['recorded'] - report['complete']} partial, {sum(report['missed'].values())} missed"
+    )
+    for reason, count in sorted(report["missed"].items()):
+        print(f"  missed          {count} {reason}")
+    for name in ("start_lateness_s", "end_lateness_s", "plan_ms"):
+        values = report[name]
+        if values:
+            print(f"{name:<17} mean {values['mean']:.2f}  p95 {values['p95']:.2f}  max {values['max']:.2f}")
+    if report["coverage"] is not None:
+        print(f"coverage          {report['coverage'] * 100:.2f}% of the planned seconds")
+    for event, count in sorted(report["events"].items()):
+        print(f"  {event:<40} {count}")
+    for name in ("peak_captures", "peak_bandwidth_mbps", "peak_memory_mb"):
+        print(f"{name:<17} {report[name]['value']} at {report[name]['at']}")
+    disk = report["disk_gb_per_day"]
+    print(f"disk              {disk['mean']} GB per day, {disk['max']} GB at most")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay days of scheduling on a virtual clock.")
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--start", default=None, help="first day, YYYY-MM-DD (default: tomorrow)")
+    parser.add_argument("--curl", default="06:00", help="time of the daily run, HH:MM")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--programmes", type=int, default=20, help="generated programmes per day")
+    source.add_argument("--schedule", nargs="+", type=Path,
+                        help="info_progs.json files, one per day in turn")
+    parser.add_argument("--mix", default="tf1=0.3,other=0.7",
+                        help="weights of TF1-group, other and unknown channels")
+    parser.add_argument("--failures", default="", help="kind=rate,... among " + ", ".join(FAILURES))
+    parser.add_argument("--at-jitter", type=float, default=2.0, help="seconds atd may start late")
+    parser.add_argument("--startup", type=float, default=4.0, help="seconds to the first byte")
+    parser.add_argument("--reboot", type=float, default=120.0, help="seconds down after a crash")
+    parser.add_argument("--bitrate", type=int, default=DEFAULT_BITRATE_KBPS, help="kbps per capture")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="show the planner logs")
+    args = parser.parse_args(argv)
+
+    try:
+        failures = parse_failures(args.failures)
+        mix = parse_mix(args.mix)
+        hour, minute = map(int, args.curl.split(":"))
+        first = (
+            datetime.strptime(args.start, "%Y-%m-%d") if args.start
+            else datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    if args.days < 1:
+        parser.error("--days must be at least 1")
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    if not args.verbose:
+        logging.getLogger("__name__").setLevel(logging.CRITICAL)
+
+    if args.schedule:
+        files = []
+        for path in args.schedule:
+            with open(path, "r", encoding="utf-8") as f:
+                files.append(json.load(f))
+        schedules = lambda day, now: files[day % len(files)]
+    else:
+        schedules = lambda day, now: generate_schedule(args.programmes, mix, args.seed + day, now)
+
+    started = time.monotonic()
+    with tempfile.TemporaryDirectory(prefix="simulate_") as workdir:
+        simulation = Simulation(
+            schedules, first.timestamp(), args.days, f"{hour:02d}:{minute:02d}", failures, workdir,
+            random.Random(args.seed), args.at_jitter, args.startup, args.reboot, args.bitrate,
+        )
+        simulation.run()
+        report = simulation.report()
+    elapsed = time.monotonic() - started
+    report["wall_s"] = round(elapsed, 3)
+    report["max_rss_kib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if args.json:
+        print(json.dumps(report, indent=1))
+    else:
+        print_report(report, elapsed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
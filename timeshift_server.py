@@ -0,0 +1,359 @@
+"""
+LAN timeshift server for the recordings in ~/videos_select.
+
+Every recording, finished or still being captured by recorder.py, is
+exposed as:
+
+    /recordings/<name>.ts      raw stream with byte-range support
+    /recordings/<name>.m3u8    HLS playlist of byte ranges between keyframes
+
+File regions are sent with os.sendfile, so the data goes from the page
+cache the recorder just filled straight to the socket. A request on an
+active capture without an end keeps following the growing file until the
+capture stops. One TailTracker per active file watches its size for all
+the viewers of that file.
+
+Usage: python3 timeshift_server.py [--host HOST] [--port PORT]
+"""
+import argparse
+import errno
+import fcntl
+import json
+import logging
+import math
+import os
+import re
+import sys
+import threading
+import time
+
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import quote, unquote
+
+from app_logging import setup_logging
+from seek_index import SeekIndex, index_path
+
+RECORDINGS_DIR = Path.home() / "videos_select"
+
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 8765
+
+SEGMENT_TARGET = 6.0
+TAIL_POLL_INTERVAL = 0.5
+TAIL_IDLE_TIMEOUT = 30.0
+SENDFILE_CHUNK = 1024 * 1024
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+logger = logging.getLogger("__name__")
+
+
+def is_active(path):
+    """A capture is active while recorder.py holds its exclusive flock."""
+    try:
+        with open(path, "rb") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    return False
+
+
+def resolve_recording(name, recordings_dir=RECORDINGS_DIR):
+    """Map a URL name to a .ts file of the recordings directory, or None."""
+    name = unquote(name)
+    if "/" in name or "\x00" in name or name.startswith("."):
+        return None
+    path = Path(recordings_dir) / name
+    if path.suffix != ".ts" or not path.is_file():
+        return None
+    return path
+
+
+class TailTracker:
+    """
+    Follow the size of one growing recording for every viewer at once.
+
+    A single thread stats the file and wakes the waiting viewers when it
+    grows, then exits once the capture is over and nobody is waiting.
+    """
+
+    _trackers = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.active = True
+        self.viewers = 0
+        self._changed = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def get(cls, path):
+        with cls._lock:
+            tracker = cls._trackers.get(path)
+            if tracker is None or not tracker._thread.is_alive():
+                tracker = cls._trackers[path] = cls(path)
+            with tracker._changed:
+                tracker.viewers += 1
+            return tracker
+
+    def release(self):
+        with self._changed:
+            self.viewers -= 1
+
+    def _run(self):
+        idle_since = None
+        while True:
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                # Renamed or offloaded: nothing more will come.
+                with self._changed:
+                    self.active = False
+                    self._changed.notify_all()
+                break
+            active = is_active(self.path)
+
+            with self._changed:
+                if size != self.size or active != self.active:
+                    self.size, self.active = size, active
+                    self._changed.notify_all()
+                if not active:
+                    self._changed.notify_all()
+                    break
+                if self.viewers > 0:
+                    idle_since = None
+                else:
+                    idle_since = idle_since or time.monotonic()
+            if idle_since and time.monotonic() - idle_since > TAIL_IDLE_TIMEOUT and self._retire():
+                return
+
+            time.sleep(TAIL_POLL_INTERVAL)
+
+        self._retire(force=True)
+
+    def _retire(self, force=False):
+        # Unregistered under the lock get() takes, so a new viewer never
+        # gets a tracker whose thread is leaving; one that came in since
+        # the last check keeps it running.
+        with TailTracker._lock:
+            with self._changed:
+                if self.viewers > 0 and not force:
+                    return False
+            if TailTracker._trackers.get(self.path) is self:
+                del TailTracker._trackers[self.path]
+            return True
+
+    def wait_beyond(self, offset, timeout=TAIL_IDLE_TIMEOUT):
+        """Wait until the file is larger than offset; return (size, active)."""
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self.size > offset or not self.active, timeout=timeout
+            )
+            return self.size, self.active
+
+
+def build_playlist(name, path, active, segment_target=SEGMENT_TARGET):
+    """Return an HLS playlist of byte ranges cut on indexed keyframes."""
+    try:
+        index = SeekIndex(index_path(path))
+        keyframes = list(index.keyframes())
+    except (OSError, ValueError):
+        keyframes = []
+
+    size = os.path.getsize(path)
+    uri = quote(name)
+    segments = []
+
+    start_time, start_offset = keyframes[0] if keyframes else (0.0, 0)
+    for seconds, offset in keyframes[1:]:
+        if seconds - start_time >= segment_target:
+            segments.append((seconds - start_time, start_offset, offset - start_offset))
+            start_time, start_offset = seconds, offset
+
+    if not active and size > start_offset:
+        # Estimate the duration of the tail from the average byte rate.
+        if keyframes and keyframes[-1][0] > 0:
+            rate = keyframes[-1][1] / keyframes[-1][0]
+            tail = (size - start_offset) / rate if rate else segment_target
+        else:
+            tail = segment_target
+        segments.append((tail, start_offset, size - start_offset))
+
+    target = max([math.ceil(d) for d, _, _ in segments] + [int(segment_target)])
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:4",
+        f"#EXT-X-TARGETDURATION:{target}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        f"#EXT-X-PLAYLIST-TYPE:{'EVENT' if active else 'VOD'}",
+    ]
+    for duration, offset, length in segments:
+        lines += [f"#EXTINF:{duration:.3f},", f"#EXT-X-BYTERANGE:{length}@{offset}", uri]
+    if not active:
+        lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+class TimeshiftHandler(BaseHTTPRequestHandler):
+    server_version = "tvselect-timeshift"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.info("%s %s", self.address_string(), format % args)
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def handle_request(self, send_body):
+        if self.path in ("/", "/recordings", "/recordings/"):
+            return self.send_listing(send_body)
+
+        match = re.fullmatch(r"/recordings/([^/?]+)\.(ts|m3u8)", self.path.split("?")[0])
+        path = resolve_recording(match.group(1) + ".ts") if match else None
+        if path is None:
+            return self.send_error(HTTPStatus.NOT_FOUND)
+
+        if match.group(2) == "m3u8":
+            body = build_playlist(path.name, path, is_active(path)).encode()
+            return self.send_bytes(body, "application/vnd.apple.mpegurl", send_body)
+
+        return self.send_recording(path, send_body)
+
+    def send_bytes(self, body, content_type, send_body):
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def send_listing(self, send_body):
+        recordings = []
+        for path in sorted(RECORDINGS_DIR.glob("*.ts")):
+            recordings.append({
+                "name": path.name,
+                "size": path.stat().st_size,
+                "active": is_active(path),
+                "ts": f"/recordings/{quote(path.name)}",
+                "hls": f"/recordings/{quote(path.stem)}.m3u8",
+            })
+        body = json.dumps(recordings, ensure_ascii=False).encode()
+        self.send_bytes(body, "application/json", send_body)
+
+    def send_recording(self, path, send_body):
+        active = is_active(path)
+        size = os.path.getsize(path)
+        start, end = 0, None
+
+        header = self.headers.get("Range")
+        if header:
+            match = RANGE_RE.match(header.strip())
+            if not match or not any(match.groups()):
+                return self.send_error(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            first, last = match.groups()
+            if first:
+                start = int(first)
+                end = int(last) if last else None
+            else:
+                start, end = max(size - int(last), 0), size - 1
+            if end is not None and end < start:
+                return self.send_error(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+
+        follow = active and end is None
+        if not follow:
+            end = size - 1 if end is None else min(end, size - 1)
+            if start > end:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        self.send_response(HTTPStatus.PARTIAL_CONTENT if header else HTTPStatus.OK)
+        self.send_header("Content-Type", "video/mp2t")
+        self.send_header("Accept-Ranges", "bytes")
+        if follow:
+            # The length is unknown until the capture ends.
+            self.send_header("Connection", "close")
+            self.close_connection = True
+            if header:
+                self.send_header("Content-Range", f"bytes {start}-*/*")
+        else:
+            self.send_header("Content-Length", str(end - start + 1))
+            if header:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+
+        if not send_body:
+            return
+
+        try:
+            with open(path, "rb") as f:
+                if follow:
+                    self.follow_tail(f, path, start)
+                else:
+                    self.sendfile(f, start, end + 1)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except OSError as e:
+            if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                raise
+
+    def sendfile(self, f, start, stop):
+        out = self.connection.fileno()
+        offset = start
+        while offset < stop:
+            sent = os.sendfile(out, f.fileno(), offset, min(SENDFILE_CHUNK, stop - offset))
+            if sent == 0:
+                break
+            offset += sent
+        return offset
+
+    def follow_tail(self, f, path, offset):
+        tracker = TailTracker.get(str(path))
+        try:
+            while True:
+                size, active = tracker.wait_beyond(offset)
+                if size > offset:
+                    offset = self.sendfile(f, offset, size)
+                elif not active:
+                    break
+        finally:
+            tracker.release()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve recordings on the LAN.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args(argv)
+
+    setup_logging("timeshift_server.log")
+
+    server = ThreadingHTTPServer((args.host, args.port), TimeshiftHandler)
+    server.daemon_threads = True
+    logger.info("Timeshift server listening on %s:%d", args.host, args.port)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
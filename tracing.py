@@ -0,0 +1,207 @@
+"""
+Lightweight span tracing of the recording pipeline.
+
+scheduler_launch.py (fetch, pass, launch), the planner (build, at
+submission) and recorder.py (admission, stream resolution, first byte)
+record spans. A child process joins the trace of its parent through the
+TVSELECT_TRACE_ID and TVSELECT_SPAN_ID environment variables, which `at`
+keeps in the jobs it runs later.
+
+Spans are appended as JSON lines to one file per day under
+logs/traces, unless TVSELECT_TRACE=0. `tracing.py summary` reports per-stage percentiles:
+
+    python3 tracing.py summary [--days 7] [--by-day]
+"""
+import argparse
+import contextvars
+import json
+import math
+import os
+import secrets
+import sys
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+from app_logging import LOGS_DIR
+
+TRACE_DIR = LOGS_DIR / "traces"
+TRACE_ID_ENV = "TVSELECT_TRACE_ID"
+SPAN_ID_ENV = "TVSELECT_SPAN_ID"
+SCHEDULED_ENV = "TVSELECT_SCHEDULED_AT"  # epoch an at job is due, for late_by
+KEEP_DAYS = 60
+
+_current = contextvars.ContextVar("tracing_span", default=None)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id, attrs=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attrs = dict(attrs or {})
+        self.start = time.time()
+        self._start_monotonic = time.monotonic()
+        self.error = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def env(self):
+        """Environment variables making a child process a child of this span."""
+        return {TRACE_ID_ENV: self.trace_id, SPAN_ID_ENV: self.span_id}
+
+    def end(self, duration=None):
+        if duration is None:
+            duration = time.monotonic() - self._start_monotonic
+        _write({
+            "trace": self.trace_id,
+            "span": self.span_id,
+            "parent": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "duration": round(duration, 6),
+            "pid": os.getpid(),
+            "attrs": self.attrs,
+            "error": self.error,
+        })
+
+
+def _write(record):
+    if os.environ.get("TVSELECT_TRACE") == "0":
+        return
+    TRACE_DIR.mkdir(parents=True, exist_ok=True)
+    line = (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode()
+    path = TRACE_DIR / f"{date.fromtimestamp(record['start']).isoformat()}.jsonl"
+    try:
+        # One O_APPEND write per span keeps lines whole across processes.
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def current_span():
+    return _current.get()
+
+
+def start_span(name, parent=None, **attrs):
+    """
+    Start a span under parent, the current span, or the span given by the
+    environment, in that order; a new trace is started otherwise.
+    """
+    parent = parent or _current.get()
+    if parent is not None:
+        trace_id, parent_id = parent.trace_id, parent.span_id
+    elif os.environ.get(TRACE_ID_ENV):
+        trace_id, parent_id = os.environ[TRACE_ID_ENV], os.environ.get(SPAN_ID_ENV)
+    else:
+        trace_id, parent_id = secrets.token_hex(16), None
+    return Span(name, trace_id, parent_id, attrs)
+
+
+@contextmanager
+def span(name, parent=None, **attrs):
+    """Trace the enclosed block; spans opened inside become its children."""
+    s = start_span(name, parent, **attrs)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.error = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        s.end()
+
+
+def child_env(env=None, parent=None):
+    """Return env (os.environ by default) carrying the trace to a child process."""
+    env = dict(os.environ if env is None else env)
+    parent = parent or _current.get()
+    if parent is not None:
+        env.update(parent.env())
+    return env
+
+
+def prune(keep_days=KEEP_DAYS):
+    cutoff = (date.today() - timedelta(days=keep_days)).isoformat()
+    for path in TRACE_DIR.glob("*.jsonl"):
+        if path.stem < cutoff:
+            path.unlink(missing_ok=True)
+
+
+def load_spans(days):
+    first = (date.today() - timedelta(days=days - 1)).isoformat()
+    for path in sorted(TRACE_DIR.glob("*.jsonl")):
+        if path.stem < first:
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, math.ceil(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarise(spans, by_day=False):
+    """Return rows of (day or None, stage, count, errors, p50, p90, p99, max)."""
+    groups = defaultdict(list)
+    errors = defaultdict(int)
+    for s in spans:
+        day = datetime.fromtimestamp(s["start"]).date().isoformat() if by_day else None
+        groups[(day, s["name"])].append(s["duration"])
+        if s.get("attrs", {}).get("late_by") is not None:
+            groups[(day, s["name"] + " (late by)")].append(s["attrs"]["late_by"])
+        if s.get("error"):
+            errors[(day, s["name"])] += 1
+
+    rows = []
+    for key in sorted(groups, key=lambda k: (k[0] or "", k[1])):
+        values = sorted(groups[key])
+        rows.append((
+            key[0], key[1], len(values), errors[key],
+            percentile(values, 50), percentile(values, 90), percentile(values, 99), values[-1],
+        ))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pipeline latency traces.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    summary = sub.add_parser("summary", help="per-stage percentiles")
+    summary.add_argument("--days", type=int, default=7)
+    summary.add_argument("--by-day", action="store_true")
+    args = parser.parse_args(argv)
+
+    rows = summarise(load_spans(args.days), args.by_day)
+    if not rows:
+        print("No trace recorded.")
+        return 0
+
+    day_width = 11 if args.by_day else 0
+    width = max(len(row[1]) for row in rows)
+    print(f"{'day' if args.by_day else '':<{day_width}}{'stage':<{width}} {'count':>6} {'errors':>6} "
+          f"{'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+    for day, stage, count, errs, p50, p90, p99, top in rows:
+        print(f"{(day or ''):<{day_width}}{stage:<{width}} {count:>6} {errs:>6} "
+              f"{p50:>8.3f}s {p90:>8.3f}s {p99:>8.3f}s {top:>8.3f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
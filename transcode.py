@@ -0,0 +1,471 @@
+"""
+Transcode finished recordings on all the CPUs.
+
+A recording is cut at keyframes into byte ranges of about the same size;
+the seek index gives the keyframe offsets, the recording is scanned when
+it has none. Every chunk is fed, with the PAT and PMT in front, to its
+own ffmpeg, which re-encodes the video with TRANSCODE_ARGS and copies
+the audio. The chunks keep the original timestamps (-copyts), so they
+follow each other exactly and are joined without re-encoding (-c copy)
+into Title_Chan.mkv, which gets its own .sha256 sidecar.
+
+Up to TRANSCODE_WORKERS chunks (one per CPU by default) are encoded at a
+time, at the lowest CPU and I/O priority, each ffmpeg in a process group
+of its own that the resource governor pauses under pressure. While a
+capture runs, chunks only start while fewer than
+TRANSCODE_CAPTURE_WORKERS (1 by default, 0 to wait for the end of the
+captures) are being encoded. Encoded chunks are kept in
+.Title_Chan.transcode/ until the join, so a transcode cut by a crash
+starts again from the chunks missing.
+
+With TRANSCODE_ARGS set in config.py (a list of ffmpeg output options,
+["-c:v", "libx264", "-preset", "veryfast", "-crf", "23"] for instance)
+the scheduler daemon runs the transcoder, and the offloader waits for a
+recording to be transcoded before moving it. TRANSCODE_FORMAT,
+TRANSCODE_WORKERS, TRANSCODE_CAPTURE_WORKERS and TRANSCODE_KEEP_SOURCE
+are optional. It can also run on its own:
+
+    transcode.py run [--workers N] [--chunks N] [--once]
+    transcode.py file PATH [--workers N] [--chunks N]
+    transcode.py status
+"""
+import argparse
+import bisect
+import fcntl
+import json
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from accounts import share, shared_links
+from offload import checksum_path, hash_file, is_finished, ready_recordings, write_checksum
+from resource_governor import find_capture_processes, register_background, unregister_background
+from seek_index import TS_PACKET_SIZE, KeyframeScanner, SeekIndex, index_path
+
+logger = logging.getLogger("__name__")
+
+RECORDINGS_DIR = Path.home() / "videos_select"
+DATA_DIR = Path.home() / ".local/share/tvselect-fr-live-stream"
+
+DEFAULT_ARGS = ["-c:v", "libx264", "-preset", "veryfast", "-crf", "23"]
+DEFAULT_FORMAT = "mkv"
+MUXERS = {"mkv": "matroska", "mp4": "mp4"}
+
+CAPTURE_WORKERS = 1
+CHUNKS_PER_WORKER = 2
+MIN_CHUNK = 16 * 1024 * 1024
+
+READ_SIZE = TS_PACKET_SIZE * 5577
+WORK_SUFFIX = ".transcode"
+PLAN_FILE = "plan.json"
+FAILED_FILE = "failed"
+
+THROTTLE_POLL = 5.0
+SCAN_INTERVAL = 60.0
+
+
+class TranscodeError(Exception):
+    pass
+
+
+def transcoded_path(recording, fmt=DEFAULT_FORMAT):
+    return Path(recording).with_suffix("." + fmt)
+
+
+def work_dir(recording):
+    path = Path(recording)
+    return path.with_name(f".{path.stem}{WORK_SUFFIX}")
+
+
+def failed(recording):
+    """Return why the transcode of recording failed for good, or None."""
+    try:
+        return (work_dir(recording) / FAILED_FILE).read_text(encoding="utf-8").strip()
+    except OSError:
+        return None
+
+
+def pending(recording, fmt=DEFAULT_FORMAT):
+    """True while a recording still has to be transcoded."""
+    recording = Path(recording)
+    if recording.suffix != ".ts":
+        return False
+    return not os.path.exists(checksum_path(transcoded_path(recording, fmt))) and not failed(recording)
+
+
+def keyframe_offsets(path):
+    """Return the byte offsets of the keyframes of a recording, and its PAT and PMT packets."""
+    try:
+        offsets = [offset for _, offset in SeekIndex(index_path(path)).keyframes()]
+    except (OSError, ValueError):
+        offsets = []
+    scanner = KeyframeScanner()
+    found = []
+    base = 0
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            found.extend(offset for _, offset in scanner.scan(data, base))
+            base += len(data)
+            # With a seek index only the tables are needed.
+            if offsets and len(scanner.tables()) >= 2 * TS_PACKET_SIZE:
+                break
+    return offsets or found, scanner.tables()
+
+
+def plan_chunks(offsets, size, chunks, min_chunk=MIN_CHUNK):
+    """Split [0, size) at keyframe offsets into at most chunks ranges of about the same size."""
+    chunks = max(1, min(chunks, size // max(min_chunk, 1)))
+    cuts = [0]
+    for i in range(1, chunks):
+        j = bisect.bisect_left(offsets, size * i // chunks)
+        if j < len(offsets) and cuts[-1] < offsets[j] < size:
+            cuts.append(offsets[j])
+    cuts.append(size)
+    return list(zip(cuts, cuts[1:]))
+
+
+def _ffmpeg(*args):
+    command = ["ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error", "-y", *args]
+    if shutil.which("ionice"):
+        command = ["ionice", "-c", "3", *command]
+    # Not preexec_fn: the scheduler runs threads, the child could deadlock.
+    return ["nice", "-n", "19", *command]
+
+
+def _start_ffmpeg(*args, **kwargs):
+    """
+    Start ffmpeg in a process group of its own, which the resource
+    governor may pause; return the process and its registration.
+    """
+    process = subprocess.Popen(_ffmpeg(*args), start_new_session=True, **kwargs)
+    return process, register_background("transcode", process.pid)
+
+
+def _error_tail(errors):
+    errors.seek(0)
+    return errors.read().decode(errors="replace").strip()[-500:]
+
+
+class CaptureThrottle:
+    """
+    Bounds the number of chunks encoded at a time: workers, or
+    capture_workers while a capture runs. Chunks already started finish.
+    """
+
+    def __init__(self, workers, capture_workers=CAPTURE_WORKERS, poll=THROTTLE_POLL,
+                 captures=find_capture_processes):
+        self.workers = workers
+        self.capture_workers = capture_workers
+        self.poll = poll
+        self.captures = captures
+        self._running = 0
+        self._capturing = False
+        self._checked = None
+        self._cond = threading.Condition()
+
+    def limit(self):
+        now = time.monotonic()
+        if self._checked is None or now - self._checked >= self.poll:
+            self._checked = now
+            capturing = bool(self.captures())
+            if capturing != self._capturing:
+                logger.info(
+                    "Transcoding %s while captures run",
+                    "slowed down" if capturing else "back to full speed",
+                )
+                self._capturing = capturing
+        return self.capture_workers if self._capturing else self.workers
+
+    def __enter__(self):
+        with self._cond:
+            while self._running >= self.limit():
+                self._cond.wait(self.poll)
+            self._running += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+
+
+class Transcoder:
+    def __init__(self, args=None, fmt=DEFAULT_FORMAT, workers=None, chunks=None,
+                 capture_workers=CAPTURE_WORKERS, keep_source=True, recordings_dir=RECORDINGS_DIR,
+                 min_chunk=MIN_CHUNK):
+        if fmt not in MUXERS:
+            raise ValueError(f"Unknown transcode format {fmt!r}, one of {', '.join(MUXERS)}")
+        self.args = list(args or DEFAULT_ARGS)
+        self.format = fmt
+        self.workers = workers or os.cpu_count() or 1
+        self.chunks = chunks or self.workers * CHUNKS_PER_WORKER
+        self.keep_source = keep_source
+        self.min_chunk = min_chunk
+        self.recordings_dir = Path(recordings_dir)
+        self.throttle = CaptureThrottle(self.workers, capture_workers)
+
+    def encode_chunk(self, source, start, end, header, dest):
+        """Encode bytes [start, end) of source, with header in front, to dest."""
+        tmp = dest.with_name(dest.name + ".tmp")
+        with self.throttle, open(source, "rb") as src, tempfile.TemporaryFile() as errors:
+            process, registration = _start_ffmpeg(
+                "-f", "mpegts", "-i", "pipe:0", "-copyts",
+                "-map", "0:v:0", "-map", "0:a?", "-c", "copy", *self.args,
+                "-muxdelay", "0", "-muxpreload", "0", "-f", "mpegts", str(tmp),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=errors,
+            )
+            try:
+                process.stdin.write(header)
+                src.seek(start)
+                remaining = end - start
+                while remaining:
+                    data = src.read(min(READ_SIZE, remaining))
+                    if not data:
+                        break
+                    process.stdin.write(data)
+                    remaining -= len(data)
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            except BaseException:
+                # In a session of its own, ffmpeg does not get our signals.
+                process.kill()
+                raise
+            finally:
+                returncode = process.wait()
+                unregister_background(registration)
+            if returncode:
+                tmp.unlink(missing_ok=True)
+                raise TranscodeError(
+                    f"ffmpeg failed on bytes {start}-{end} of {Path(source).name}: {_error_tail(errors)}"
+                )
+        os.replace(tmp, dest)
+
+    def join(self, chunks, dest):
+        """Concatenate the encoded chunks into dest without re-encoding."""
+        tmp = dest.with_name(f".{dest.name}.tmp")
+        with tempfile.TemporaryFile() as errors:
+            process, registration = _start_ffmpeg(
+                "-i", "concat:" + "|".join(str(chunk) for chunk in chunks),
+                "-map", "0", "-c", "copy", "-f", MUXERS[self.format], str(tmp),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=errors,
+            )
+            try:
+                returncode = process.wait()
+            except BaseException:
+                process.kill()
+                process.wait()
+                raise
+            finally:
+                unregister_background(registration)
+            if returncode:
+                tmp.unlink(missing_ok=True)
+                raise TranscodeError(f"Joining the chunks of {dest.name} failed: {_error_tail(errors)}")
+        os.replace(tmp, dest)
+
+    def _prepare(self, work, ranges):
+        # Chunks encoded before a crash are kept only for the same cuts and options.
+        plan = {"ranges": ranges, "args": self.args}
+        try:
+            with open(work / PLAN_FILE, "r", encoding="utf-8") as f:
+                if json.load(f) == json.loads(json.dumps(plan)):
+                    return
+        except (OSError, json.JSONDecodeError):
+            pass
+        shutil.rmtree(work, ignore_errors=True)
+        work.mkdir()
+        with open(work / PLAN_FILE, "w", encoding="utf-8") as f:
+            json.dump(plan, f)
+
+    def transcode(self, path):
+        """Transcode one finished recording; return the transcoded file."""
+        path = Path(path)
+        dest = transcoded_path(path, self.format)
+        work = work_dir(path)
+        started = time.monotonic()
+
+        with open(path, "rb") as source:
+            try:
+                # Also keeps the offloader away from the recording meanwhile.
+                fcntl.flock(source, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise TranscodeError(f"{path.name} is still in use") from None
+            size = os.fstat(source.fileno()).st_size
+            # The same capture linked for other accounts is encoded once.
+            links = shared_links(path, self.recordings_dir)
+            offsets, header = keyframe_offsets(path)
+            if not offsets:
+                raise TranscodeError(f"No keyframe found in {path.name}")
+
+            ranges = plan_chunks(offsets, size, self.chunks, self.min_chunk)
+            self._prepare(work, ranges)
+            chunks = [work / f"{i:04d}.ts" for i in range(len(ranges))]
+            todo = [(r, chunk) for r, chunk in zip(ranges, chunks) if not chunk.exists()]
+            if len(todo) < len(chunks):
+                logger.info(
+                    "Resuming the transcode of %s, %d/%d chunks left", path.name, len(todo), len(chunks)
+                )
+
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="transcode") as pool:
+                futures = [
+                    pool.submit(self.encode_chunk, path, start, end, header if start else b"", chunk)
+                    for (start, end), chunk in todo
+                ]
+                for future in futures:
+                    future.result()
+
+            self.join(chunks, dest)
+            write_checksum(dest, hash_file(dest))
+            shutil.rmtree(work, ignore_errors=True)
+
+        logger.info(
+            "Transcoded %s in %d chunks: %d -> %d bytes in %.0fs",
+            path.name, len(chunks), size, dest.stat().st_size, time.monotonic() - started,
+        )
+        if links:
+            share(dest, [link.parent for link in links])
+        if not self.keep_source:
+            for source in (path, *links):
+                for local in (source, index_path(source), checksum_path(source)):
+                    Path(local).unlink(missing_ok=True)
+        return dest
+
+    def _transcode(self, path):
+        try:
+            return self.transcode(path)
+        except TranscodeError as e:
+            logger.error("Transcode of %s failed: %s", path.name, e)
+            if is_finished(path):
+                work_dir(path).mkdir(exist_ok=True)
+                (work_dir(path) / FAILED_FILE).write_text(f"{e}\n", encoding="utf-8")
+        except OSError as e:
+            logger.error("Transcode of %s failed, will retry: %s", path.name, e)
+        return None
+
+    def run_once(self):
+        """Transcode the recordings waiting for it, one after the other; return how many were done."""
+        done = 0
+        for path in ready_recordings(self.recordings_dir):
+            if pending(path, self.format) and self._transcode(path):
+                done += 1
+        return done
+
+    def run(self, stop, interval=SCAN_INTERVAL):
+        DATA_DIR.mkdir(parents=True, exist_ok=True)
+        lock = open(DATA_DIR / ".transcode.lock", "w")
+        try:
+            # A single transcoder per box, whichever process started first.
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return
+        try:
+            while not stop.is_set():
+                try:
+                    self.run_once()
+                except OSError:
+                    logger.warning("Cannot scan %s", self.recordings_dir, exc_info=True)
+                stop.wait(interval)
+        finally:
+            lock.close()
+
+
+def start_transcoder(args=None, fmt=DEFAULT_FORMAT, workers=None, capture_workers=CAPTURE_WORKERS,
+                     keep_source=True, stop=None):
+    """Run a Transcoder in a daemon thread; return the event stopping it, None without ffmpeg."""
+    if shutil.which("ffmpeg") is None:
+        logger.error("Transcoding is configured but ffmpeg is not installed")
+        return None
+    stop = stop or threading.Event()
+    transcoder = Transcoder(args, fmt, workers, capture_workers=capture_workers, keep_source=keep_source)
+    thread = threading.Thread(target=transcoder.run, args=(stop,), name="transcode", daemon=True)
+    thread.start()
+    return stop
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Transcode finished recordings in parallel.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="transcode the finished recordings")
+    one = sub.add_parser("file", help="transcode one recording")
+    one.add_argument("path", type=Path)
+    for command in (run, one):
+        command.add_argument("--workers", type=int, default=None, help="default: one per CPU")
+        command.add_argument("--chunks", type=int, default=None, help="default: two per worker")
+        command.add_argument("--format", choices=sorted(MUXERS), default=DEFAULT_FORMAT)
+        command.add_argument(
+            "--ffmpeg-args", type=shlex.split, default=None,
+            help=f"ffmpeg output options, default: {shlex.join(DEFAULT_ARGS)}",
+        )
+        command.add_argument(
+            "--capture-workers", type=int, default=CAPTURE_WORKERS,
+            help="chunks encoded at a time while a capture runs",
+        )
+    run.add_argument("--once", action="store_true", help="transcode what is ready and exit")
+    sub.add_parser("status", help="list the recordings waiting to be transcoded")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.command == "status":
+        for path in sorted(RECORDINGS_DIR.glob("*.ts")):
+            reason = failed(path)
+            if reason:
+                state = f"failed: {reason}"
+            elif not pending(path):
+                state = "transcoded"
+            elif work_dir(path).exists():
+                state = "transcoding"
+            else:
+                state = "waiting"
+            print(f"{path.name}: {state}")
+        return 0
+
+    if shutil.which("ffmpeg") is None:
+        print("ffmpeg is not installed", file=sys.stderr)
+        return 1
+    for option in ("workers", "chunks"):
+        if getattr(args, option) is not None and getattr(args, option) < 1:
+            parser.error(f"--{option} must be at least 1")
+    if args.capture_workers < 0:
+        parser.error("--capture-workers cannot be negative")
+
+    transcoder = Transcoder(
+        args.ffmpeg_args, args.format, args.workers, args.chunks, args.capture_workers
+    )
+    if args.command == "file":
+        try:
+            print(transcoder.transcode(args.path))
+        except (OSError, TranscodeError) as e:
+            logger.error("Transcode of %s failed: %s", args.path, e)
+            return 1
+        return 0
+
+    if not args.once:
+        try:
+            transcoder.run(threading.Event())
+        except KeyboardInterrupt:
+            pass
+        return 0
+    print(f"{transcoder.run_once()} recordings transcoded")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,293 @@
+"""
+Integrity and bitrate analyser for the MPEG-TS recordings in ~/videos_select.
+
+Each file is memory-mapped as an array of 188-byte packets and checked
+chunk by chunk with NumPy: sync bytes, transport errors, continuity
+counters per PID, PCR gaps and discontinuities, and a bitrate timeline
+derived from the PCR clock. A JSON summary is written next to each file.
+
+Usage: python3 ts_analyser.py [--jobs N] [--output-dir DIR] [FILE ...]
+"""
+import argparse
+import json
+import os
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from resource_governor import register_background
+
+TS_PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+NULL_PID = 0x1FFF
+PID_COUNT = 0x2000
+
+PCR_CLOCK = 27_000_000
+PCR_WRAP = (1 << 33) * 300
+MAX_PCR_INTERVAL = 0.1  # ISO/IEC 13818-1 upper bound between two PCRs
+MAX_PCR_JUMP = 1.0
+
+CHUNK_PACKETS = 1 << 20
+BITRATE_WINDOW = 1.0
+MAX_LISTED_EVENTS = 50
+
+RECORDINGS_DIR = Path.home() / "videos_select"
+SUMMARY_SUFFIX = ".analysis.json"
+
+
+def _check_continuity(pid, cc, discontinuity, last_cc):
+    """
+    Return a mask of continuity errors for one chunk of payload packets.
+
+    Packets are grouped per PID with a stable sort so each counter is
+    compared to the previous packet of the same PID; last_cc carries the
+    last counter of every PID over to the next chunk and is updated in place.
+    """
+    order = np.argsort(pid, kind="stable")
+    pid_sorted = pid[order]
+    cc_sorted = cc[order].astype(np.int16)
+
+    group_start = np.ones(len(pid_sorted), dtype=bool)
+    group_start[1:] = pid_sorted[1:] != pid_sorted[:-1]
+    group_end = np.ones(len(pid_sorted), dtype=bool)
+    group_end[:-1] = group_start[1:]
+
+    previous = np.empty_like(cc_sorted)
+    previous[1:] = cc_sorted[:-1]
+    previous[group_start] = last_cc[pid_sorted[group_start]]
+
+    ok = (
+        (previous < 0)
+        | (cc_sorted == ((previous + 1) & 0x0F))
+        | (cc_sorted == previous)  # a single duplicate packet is allowed
+        | discontinuity[order]
+    )
+
+    last_cc[pid_sorted[group_end]] = cc_sorted[group_end]
+
+    errors = np.zeros(len(pid), dtype=bool)
+    errors[order] = ~ok
+    return errors
+
+
+def _decode_pcr(fields):
+    """Decode the 6 PCR bytes of each row into 27 MHz ticks."""
+    fields = fields.astype(np.uint64)
+    base = (
+        (fields[:, 0] << 25)
+        | (fields[:, 1] << 17)
+        | (fields[:, 2] << 9)
+        | (fields[:, 3] << 1)
+        | (fields[:, 4] >> 7)
+    )
+    extension = ((fields[:, 4] & 1) << 8) | fields[:, 5]
+    return (base * 300 + extension).astype(np.int64)
+
+
+def _bitrate_timeline(pcr_index, pcr_values, pcr_discontinuity, window=BITRATE_WINDOW):
+    """Return PCR gaps, unsignalled jumps and the bitrate per time window."""
+    if len(pcr_values) < 2:
+        return [], [], 0.0, []
+
+    delta = np.diff(pcr_values)
+    delta = np.where(delta < -PCR_WRAP // 2, delta + PCR_WRAP, delta) / PCR_CLOCK
+
+    signalled = pcr_discontinuity[1:]
+    jumps = ~signalled & ((delta < 0) | (delta > MAX_PCR_JUMP))
+    gaps = ~signalled & ~jumps & (delta > MAX_PCR_INTERVAL)
+
+    usable = ~signalled & ~jumps & (delta > 0)
+    elapsed = np.concatenate(([0.0], np.cumsum(np.where(usable, delta, 0.0))))
+
+    bins = (elapsed[:-1] // window).astype(np.int64)
+    sent = np.diff(pcr_index) * TS_PACKET_SIZE * 8
+    bits = np.bincount(bins[usable], weights=sent[usable], minlength=int(bins[-1]) + 1)
+    timeline = [
+        [round(i * window, 3), round(b / window / 1000, 1)] for i, b in enumerate(bits)
+    ]
+
+    gap_events = [
+        {"packet": int(pcr_index[i + 1]), "at": round(float(elapsed[i]), 3),
+         "interval": round(float(delta[i]), 3)}
+        for i in np.nonzero(gaps)[0]
+    ]
+    jump_events = [
+        {"packet": int(pcr_index[i + 1]), "at": round(float(elapsed[i]), 3),
+         "jump": round(float(delta[i]), 3)}
+        for i in np.nonzero(jumps)[0]
+    ]
+    return gap_events, jump_events, float(elapsed[-1]), timeline
+
+
+def analyse(path, chunk_packets=CHUNK_PACKETS):
+    """Analyse one recording and return its summary as a dict."""
+    size = os.path.getsize(path)
+    packets = size // TS_PACKET_SIZE
+    trailing = size % TS_PACKET_SIZE
+
+    summary = {
+        "file": str(path),
+        "size": size,
+        "packets": packets,
+        "trailing_bytes": trailing,
+        "truncated": trailing != 0,
+    }
+
+    if packets == 0:
+        summary["valid"] = False
+        return summary
+
+    mm = np.memmap(path, dtype=np.uint8, mode="r", shape=(packets, TS_PACKET_SIZE))
+
+    last_cc = np.full(PID_COUNT, -1, dtype=np.int16)
+    pid_packets = np.zeros(PID_COUNT, dtype=np.int64)
+    pid_cc_errors = np.zeros(PID_COUNT, dtype=np.int64)
+    sync_errors = 0
+    transport_errors = 0
+    cc_events = []
+    pcr_index, pcr_pid, pcr_values, pcr_discontinuity = [], [], [], []
+
+    for start in range(0, packets, chunk_packets):
+        chunk = mm[start:start + chunk_packets]
+        header = np.array(chunk[:, :6])
+
+        sync = header[:, 0] == SYNC_BYTE
+        sync_errors += int(np.count_nonzero(~sync))
+        transport_errors += int(np.count_nonzero(sync & (header[:, 1] & 0x80 != 0)))
+
+        pid = ((header[:, 1].astype(np.uint16) & 0x1F) << 8) | header[:, 2]
+        control = (header[:, 3] >> 4) & 0x03
+        cc = header[:, 3] & 0x0F
+
+        has_flags = ((control & 0x02) != 0) & (header[:, 4] > 0)
+        discontinuity = has_flags & (header[:, 5] & 0x80 != 0)
+        has_pcr = sync & has_flags & (header[:, 4] >= 7) & (header[:, 5] & 0x10 != 0)
+
+        pid_packets += np.bincount(pid[sync], minlength=PID_COUNT)
+
+        counted = np.nonzero(sync & (pid != NULL_PID) & ((control & 0x01) != 0))[0]
+        errors = _check_continuity(pid[counted], cc[counted], discontinuity[counted], last_cc)
+        error_index = counted[errors]
+        pid_cc_errors += np.bincount(pid[error_index], minlength=PID_COUNT)
+        for i in error_index[:max(0, MAX_LISTED_EVENTS - len(cc_events))]:
+            cc_events.append({"packet": int(start + i), "pid": int(pid[i])})
+
+        pcr_rows = np.nonzero(has_pcr)[0]
+        if len(pcr_rows):
+            pcr_index.append(pcr_rows + start)
+            pcr_pid.append(pid[pcr_rows])
+            pcr_values.append(_decode_pcr(np.array(chunk[pcr_rows, 6:12])))
+            pcr_discontinuity.append(discontinuity[pcr_rows])
+
+    del mm
+
+    summary["sync_errors"] = sync_errors
+    summary["transport_errors"] = transport_errors
+    summary["cc_errors"] = int(pid_cc_errors.sum())
+    summary["cc_error_events"] = cc_events
+    summary["pids"] = {
+        f"0x{p:04x}": {"packets": int(pid_packets[p]), "cc_errors": int(pid_cc_errors[p])}
+        for p in np.nonzero(pid_packets)[0]
+    }
+
+    if pcr_index:
+        pcr_index = np.concatenate(pcr_index)
+        pcr_pid = np.concatenate(pcr_pid)
+        pcr_values = np.concatenate(pcr_values)
+        pcr_discontinuity = np.concatenate(pcr_discontinuity)
+
+        main_pid = int(np.bincount(pcr_pid).argmax())
+        on_pid = pcr_pid == main_pid
+        gaps, jumps, duration, timeline = _bitrate_timeline(
+            pcr_index[on_pid], pcr_values[on_pid], pcr_discontinuity[on_pid]
+        )
+        rates = [kbps for _, kbps in timeline]
+
+        summary["pcr_pid"] = f"0x{main_pid:04x}"
+        summary["pcr_gaps"] = len(gaps)
+        summary["pcr_gap_events"] = gaps[:MAX_LISTED_EVENTS]
+        summary["pcr_discontinuities"] = len(jumps)
+        summary["pcr_discontinuity_events"] = jumps[:MAX_LISTED_EVENTS]
+        summary["duration"] = round(duration, 3)
+        summary["bitrate_kbps"] = {
+            "mean": round(packets * TS_PACKET_SIZE * 8 / duration / 1000, 1) if duration else 0.0,
+            "min": min(rates, default=0.0),
+            "max": max(rates, default=0.0),
+            "window": BITRATE_WINDOW,
+            "timeline": timeline,
+        }
+    else:
+        summary["pcr_pid"] = None
+
+    summary["valid"] = not (
+        summary["truncated"]
+        or sync_errors
+        or transport_errors
+        or summary["cc_errors"]
+        or summary.get("pcr_gaps")
+        or summary.get("pcr_discontinuities")
+    )
+    return summary
+
+
+def summary_path(path, output_dir=None):
+    path = Path(path)
+    directory = Path(output_dir) if output_dir else path.parent
+    return directory / (path.name + SUMMARY_SUFFIX)
+
+
+def analyse_to_file(path, output_dir=None):
+    """Analyse path and write its JSON summary, returning the summary."""
+    summary = analyse(path)
+    destination = summary_path(path, output_dir)
+    tmp = destination.with_name(destination.name + ".tmp")
+
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=4, ensure_ascii=False)
+    os.replace(tmp, destination)
+
+    return summary
+
+
+def analyse_files(paths, jobs=None, output_dir=None):
+    """Analyse several recordings in parallel, one process per file."""
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=min(jobs, max(len(paths), 1))) as pool:
+        return list(pool.map(analyse_to_file, paths, [output_dir] * len(paths)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check MPEG-TS recordings.")
+    parser.add_argument("files", nargs="*", help="recordings (default: ~/videos_select/*.ts)")
+    parser.add_argument("--jobs", type=int, default=None, help="parallel processes")
+    parser.add_argument("--output-dir", default=None, help="where to write the JSON summaries")
+    args = parser.parse_args(argv)
+
+    paths = args.files or sorted(str(p) for p in RECORDINGS_DIR.glob("*.ts"))
+    if not paths:
+        print("No recording to analyse.")
+        return 0
+
+    register_background("ts_analyser")
+
+    status = 0
+    for summary in analyse_files(paths, args.jobs, args.output_dir):
+        if not summary["valid"]:
+            status = 1
+        print(
+            f"{'OK ' if summary['valid'] else 'BAD'} {summary['file']}: "
+            f"{summary['packets']} packets, "
+            f"{summary.get('cc_errors', 0)} CC errors, "
+            f"{summary.get('pcr_gaps', 0)} PCR gaps, "
+            f"{summary.get('pcr_discontinuities', 0)} PCR jumps, "
+            f"{summary['trailing_bytes']} trailing bytes"
+        )
+
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())